@@ -4,6 +4,7 @@ The functions are several categories:
 
 1) Class Specific to XNAT and Spiders:
 InterfaceTemp to create an interface with XNAT using a tempfolder
+ProjectListingContext to list each project only once per run
 AssessorHandler to handle assessor label string and access object
 SpiderProcessHandler to handle results at the end of any spider
 
@@ -31,6 +32,7 @@ from past.builtins import basestring
 
 import collections
 import csv
+import json
 from datetime import datetime
 from pydicom.dataset import Dataset, FileDataset
 import pydicom
@@ -38,7 +40,9 @@ import fnmatch
 import getpass
 import glob
 import gzip
+import hashlib
 from lxml import etree
+from multiprocessing.pool import ThreadPool
 import nibabel as nib
 import numpy as np
 from pyxnat import Interface
@@ -49,6 +53,7 @@ import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
 import xlrd
 import xml.etree.cElementTree as ET
@@ -56,6 +61,7 @@ import yaml
 import zipfile
 
 from . import utilities
+from .listing_cache import ProjectSnapshotCache
 from .task import (JOB_FAILED, JOB_RUNNING, JOB_PENDING, READY_TO_UPLOAD,
                    NEEDS_QA, RERUN, REPROC, FAILED_NEEDS_REPROC, BAD_QA_STATUS)
 from .errors import (XnatUtilsError, XnatAccessError,
@@ -70,9 +76,9 @@ except NameError:
     basestring = str
 
 __copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
-__all__ = ["InterfaceTemp", "AssessorHandler", "SpiderProcessHandler",
-           "CachedImageSession", "CachedImageScan", "CachedImageAssessor",
-           "CachedResource"]
+__all__ = ["InterfaceTemp", "ProjectListingContext", "AssessorHandler",
+           "SpiderProcessHandler", "SessionPrefetcher", "CachedImageSession",
+           "CachedImageScan", "CachedImageAssessor", "CachedResource"]
 DAX_SETTINGS = DAX_Settings()
 NS = {'xnat': 'http://nrg.wustl.edu/xnat',
       'proc': 'http://nrg.wustl.edu/proc',
@@ -108,12 +114,13 @@ A_RESOURCE_URI = '%s/{resource}' % A_RESOURCES_URI
 # List post URI variables for XNAT:
 SUBJECT_POST_URI = '''?columns=ID,project,label,URI,last_modified,src,\
 handedness,gender,yob,dob'''
-SESSION_POST_URI = '''?xsiType={stype}&columns=ID,URI,subject_label,subject_ID\
-,modality,project,date,xsiType,{stype}/age,label,{stype}/meta/last_modified\
-,{stype}/original'''
-NO_MOD_SESSION_POST_URI = '''?xsiType={stype}&columns=ID,URI,subject_label,\
-subject_ID,project,date,xsiType,{stype}/age,label,{stype}/meta/last_modified,\
-{stype}/original'''
+SESSION_TYPES_POST_URI = '?columns=xsiType'
+# Sessions of all the types in one search, with the columns of each type
+# (SESSION_TYPE_COLUMNS) joined in type_columns:
+SESSION_POST_URI = '''?columns=ID,URI,subject_label,subject_ID,modality,\
+project,date,xsiType,label,{type_columns}'''
+SESSION_TYPE_COLUMNS = '''{stype}/age,{stype}/meta/last_modified,\
+{stype}/meta/insert_date,{stype}/original'''
 SCAN_POST_URI = '''?columns=ID,URI,label,subject_label,project,\
 xnat:imagesessiondata/scans/scan/id,\
 xnat:imagesessiondata/scans/scan/type,\
@@ -155,6 +162,21 @@ xnat:imagesessiondata/id,xnat:imagesessiondata/label,{pstype}/procstatus,\
 {pstype}/jobid,{pstype}/jobnode,{pstype}/inputs,{pstype}/out/file/label'''
 EXPERIMENT_POST_URI = '''?columns=ID,URI,subject_label,subject_ID,modality,\
 project,date,xsiType,label,xnat:subjectdata/meta/last_modified'''
+# Light query used to find the sessions changed since they were cached, with
+# the last_modified column of each type joined in mod_columns:
+SESSION_STAMP_POST_URI = '?columns=ID,subject_ID,xsiType{mod_columns}'
+# Above this number of subjects with sessions changed, the cached sessions
+# are queried again as a whole instead of subject by subject:
+LISTING_CACHE_MAX_REFRESH = 20
+ASSESSOR_SYNC_POST_URI = '''?project={project}&xsiType={atype}&columns=ID,\
+session_ID,{atype}/meta/last_modified'''
+# File written in a folder uploaded file by file to resume the upload:
+UPLOAD_PROGRESS_FILENAME = '.dax_upload_progress.txt'
+# Manifest of the files downloaded in a folder (path, size, digest, date):
+DOWNLOAD_MANIFEST_FILENAME = '.dax_download_manifest.txt'
+DOWNLOAD_PART_EXT = '.part'
+# Compiled regexes of the lists of types (see compile_type_matcher):
+TYPE_MATCHERS = dict()
 
 ###############################################################################
 #                                    1) CLASS                                 #
@@ -210,6 +232,13 @@ class InterfaceTemp(Interface):
         if not os.path.exists(temp_dir):
             os.mkdir(temp_dir)
         self.temp_dir = temp_dir
+        self.listing_context = None
+        self.listing_cache = None
+        if DAX_SETTINGS.get_use_listing_cache():
+            try:
+                self.listing_cache = ProjectSnapshotCache()
+            except Exception as err:
+                print('Warning: listing cache disabled: %s' % err)
         self.authenticate()
 
     def __enter__(self, xnat_host=None, xnat_user=None, xnat_pass=None,
@@ -340,23 +369,100 @@ class InterfaceTemp(Interface):
     def get_projects(self):
         return self._getjson(PROJECTS_URI)
 
+    def get_sessions_last_modified(self, project_id):
+        """
+        Get the image sessions of a project with the latest last_modified
+         date of each session and of its assessors (light queries).
+
+        :param project_id: ID of a project on XNAT
+        :return: list of dictionaries (ID, label, subject_label, xsiType,
+                 last_modified)
+        """
+        post_uri = ALL_SESS_PROJ_URI.format(project=project_id)
+        sessions = collections.OrderedDict()
+        for sess in self._get_sessions_by_type(post_uri, image_only=True):
+            sessions[sess['ID']] = {
+                'ID': sess['ID'], 'label': sess['label'],
+                'subject_label': sess['subject_label'],
+                'xsiType': sess['xsiType'],
+                'last_modified': sess['last_modified'] or ''}
+
+        datatypes = self.inspect.datatypes()
+        for atype in [DEFAULT_FS_DATATYPE, DEFAULT_DATATYPE]:
+            if atype not in datatypes:
+                continue
+            atype = atype.lower()
+            post_uri = SE_ARCHIVE_URI + ASSESSOR_SYNC_POST_URI.format(
+                project=project_id, atype=atype)
+            mod_key = '%s/meta/last_modified' % atype
+            for asse in self._get_json(post_uri):
+                sess = sessions.get(asse.get('session_ID'))
+                if sess and asse.get(mod_key):
+                    sess['last_modified'] = max(sess['last_modified'],
+                                                asse[mod_key])
+
+        return list(sessions.values())
+
+    def _cached_listing(self, project_id, datatype, fetch_func,
+                        cache_key=None, cached_func=None):
+        """
+        Return a project listing, memoized in the current listing context.
+         The listings with a cached_func are read through the listing cache
+         on disk when it is enabled (see _get_cached_sessions).
+
+        :param project_id: ID of a project on XNAT
+        :param datatype: listing type
+        :param fetch_func: function without arguments querying XNAT
+        :param cache_key: key in the context if different from datatype
+        :param cached_func: function without arguments reading the listing
+                            through the listing cache
+        :return: list of dictionaries
+        """
+        if not project_id:
+            return fetch_func()
+
+        def snapshot_func():
+            if self.listing_cache and cached_func is not None:
+                return cached_func()
+            return fetch_func()
+
+        if self.listing_context is not None:
+            return self.listing_context.memoize(
+                project_id, cache_key or datatype, snapshot_func)
+        return snapshot_func()
+
     def get_project_scans(self, project_id, include_shared=True):
         """
         List all the scans that you have access to based on passed project.
 
         :param intf: pyxnat.Interface object
+        :param projectid: ID of a project on XNAT
+        :param include_shared: include the shared data in this project
+        :return: List of all the scans for the project
+        """
+        cache_key = 'scans_shared' if include_shared else 'scans'
+        return self._cached_listing(
+            project_id, 'scans',
+            lambda: self._get_project_scans(project_id, include_shared),
+            cache_key=cache_key)
+
+    def _get_project_scans(self, project_id, include_shared=True):
+        """
+        Query XNAT for all the scans of a project (see get_project_scans).
+
         :param projectid: ID of a project on XNAT
         :param include_shared: include the shared data in this project
         :return: List of all the scans for the project
         """
         scans_dict = dict()
 
-        # Get the sessions list to get the modality:
-        session_list = self.get_sessions(project_id)
-        sess_id2mod = dict((sess['session_id'], [sess['handedness'],
-                                                 sess['gender'], sess['yob'], sess['age'],
-                                                 sess['last_modified'], sess['last_updated']])
-                           for sess in session_list)
+        # Get the sessions index to get the modality:
+        sess_id2mod = dict((sess_id, [sess['handedness'], sess['gender'],
+                                      sess['yob'], sess['age'],
+                                      sess['last_modified'],
+                                      sess['last_updated']])
+                           for sess_id, sess in
+                           self.get_sessions_index(project_id).items())
 
         post_uri = SE_ARCHIVE_URI
         post_uri += SCAN_PROJ_POST_URI.format(project=project_id)
@@ -457,17 +563,31 @@ class InterfaceTemp(Interface):
         """
         List all the assessors that you have access to based on passed project.
 
+        :param projectid: ID of a project on XNAT
+        :return: List of all the assessors for the project
+        """
+        return self._cached_listing(
+            projectid, 'assessors',
+            lambda: self._get_project_assessors(projectid))
+
+    def _get_project_assessors(self, projectid):
+        """
+        Query XNAT for all the assessors of a project
+         (see get_project_assessors).
+
         :param projectid: ID of a project on XNAT
         :return: List of all the assessors for the project
         """
         assessors_dict = dict()
 
         # Get the sessions list to get the different variables needed:
-        session_list = self.get_sessions(projectid)
-        sess_id2mod = dict((sess['session_id'], [sess['subject_label'],
-                            sess['type'], sess['handedness'], sess['gender'],
-                            sess['yob'], sess['age'], sess['last_modified'],
-                            sess['last_updated']]) for sess in session_list)
+        sess_id2mod = dict((sess_id, [sess['subject_label'], sess['type'],
+                                      sess['handedness'], sess['gender'],
+                                      sess['yob'], sess['age'],
+                                      sess['last_modified'],
+                                      sess['last_updated']])
+                           for sess_id, sess in
+                           self.get_sessions_index(projectid).items())
 
         if has_fs_datatypes(self):
             # First get FreeSurfer
@@ -521,6 +641,7 @@ class InterfaceTemp(Interface):
                         anew['last_modified'] = sess_id2mod[asse['session_ID']][6]
                         anew['last_updated'] = sess_id2mod[asse['session_ID']][7]
                         anew['resources'] = [asse['%s/out/file/label' % pfix]]
+                        anew['inputs'] = asse.get('%s/inputs' % pfix)
                         assessors_dict[key] = anew
 
         if has_genproc_datatypes(self):
@@ -576,6 +697,16 @@ class InterfaceTemp(Interface):
         return sorted(list(assessors_dict.values()), key=lambda k: k['label'])
 
     def get_subjects(self, project_id):
+        """
+        List all the subjects that you have access to or in a project.
+
+        :param project_id: ID of a project on XNAT
+        :return: List of subjects
+        """
+        return self._cached_listing(
+            project_id, 'subjects', lambda: self._get_subjects(project_id))
+
+    def _get_subjects(self, project_id):
         if project_id:
             post_uri = SUBJECTS_URI.format(project=project_id)
         else:
@@ -618,9 +749,24 @@ class InterfaceTemp(Interface):
         :param subjectid: ID/label of a subject
         :return: List of sessions
         """
-        type_list = []
-        full_sess_list = []
+        if projectid and subjectid is None:
+            return self._cached_listing(
+                projectid, 'sessions', lambda: self._get_sessions(projectid),
+                cached_func=lambda: self._add_sessions_info(
+                    self._get_cached_sessions(projectid), projectid))
+        return self._get_sessions(projectid, subjectid)
+
+    def _get_sessions(self, projectid=None, subjectid=None):
+        """
+        Query XNAT for the list of sessions (see get_sessions).
 
+        The sessions of all the types are queried in one search (see
+         _get_sessions_by_type) and the subjects list gives the demographics.
+
+        :param projectid: ID of a project on XNAT
+        :param subjectid: ID/label of a subject
+        :return: List of sessions
+        """
         if projectid and subjectid:
             post_uri = SESSIONS_URI.format(project=projectid, subject=subjectid)
         elif projectid is None and subjectid is None:
@@ -630,69 +776,187 @@ class InterfaceTemp(Interface):
         else:
             return None
 
-        # First get a list of all experiment types
-        post_uri_types = '%s?columns=xsiType' % post_uri
-        sess_list = self._get_json(post_uri_types)
-        for sess in sess_list:
-            sess_type = sess['xsiType'].lower()
-            if sess_type not in type_list:
-                type_list.append(sess_type)
+        return self._add_sessions_info(self._get_sessions_by_type(post_uri),
+                                       projectid)
+
+    def _add_sessions_info(self, sess_list, projectid=None):
+        """
+        Add the project/subject/session keys and the subject demographics
+         to the sessions returned by XNAT (see _get_sessions_by_type).
+
+        :param sess_list: list of sessions
+        :param projectid: ID of the project queried
+        :return: List of sessions sorted by label
+        """
+        sess_dict = collections.OrderedDict(
+            (sess['ID'], sess) for sess in sess_list)
 
-        # Get the subjects list to get the subject ID:
+        # Get the subjects list to get the subject demographics:
         subj_list = self.get_subjects(projectid)
         subj_id2lab = dict((subj['ID'], [subj['handedness'], subj['gender'],
-                                         subj['yob'], subj['dob']]) for subj in subj_list)
+                                         subj['yob'], subj['dob']])
+                           for subj in subj_list)
 
-        # Get list of sessions for each type since we have to specific
-        # about last_modified field
-        for sess_type in type_list:
-            if sess_type.startswith('xnat:') and 'session' in sess_type:
-                add_uri_str = SESSION_POST_URI.format(stype=sess_type)
-            else:
-                add_uri_str = NO_MOD_SESSION_POST_URI.format(stype=sess_type)
-            post_uri_type = '%s%s' % (post_uri, add_uri_str)
-            sess_list = self._get_json(post_uri_type)
+        for sess in list(sess_dict.values()):
+            # Override the project returned to be the one we queried
+            if projectid:
+                sess['project'] = projectid
 
-            for sess in sess_list:
-                # Override the project returned to be the one we queried
-                if projectid:
-                    sess['project'] = projectid
-
-                sess['project_id'] = sess['project']
-                sess['project_label'] = sess['project']
-                sess['subject_id'] = sess['subject_ID']
-                sess['session_id'] = sess['ID']
-                sess['session_label'] = sess['label']
-                if sess_type.startswith('xnat:') and 'session' in sess_type:
-                    sess['session_type'] = sess_type.split('xnat:')[1] \
-                        .split('session')[0] \
-                        .upper()
-                    sess['type'] = sess_type.split('xnat:')[1] \
-                        .split('session')[0] \
-                        .upper()
-                else:
-                    sess['session_type'] = sess_type
-                    sess['type'] = sess_type
-                last_modified_str = '%s/meta/last_modified' % sess_type
-                sess['last_modified'] = sess.get(last_modified_str, None)
-                sess['last_updated'] = sess.get('%s/original' % sess_type, None)
-                sess['age'] = sess.get('%s/age' % sess_type, None)
-                try:
-                    sess['handedness'] = subj_id2lab[sess['subject_ID']][0]
-                    sess['gender'] = subj_id2lab[sess['subject_ID']][1]
-                    sess['yob'] = subj_id2lab[sess['subject_ID']][2]
-                    sess['dob'] = subj_id2lab[sess['subject_ID']][3]
-                except KeyError as KE:
-                    sess['handedness'] = 'UNK'
-                    sess['gender'] = 'UNK'
-                    sess['yob'] = 'UNK'
-                    sess['dob'] = 'UNK'
-
-            # Add sessions of this type to full list
-            full_sess_list.extend(sess_list)
+            sess_type = sess['xsiType'].lower()
+            sess['project_id'] = sess['project']
+            sess['project_label'] = sess['project']
+            sess['subject_id'] = sess['subject_ID']
+            sess['session_id'] = sess['ID']
+            sess['session_label'] = sess['label']
+            if is_image_session_type(sess_type):
+                sess['session_type'] = sess_type.split('xnat:')[1] \
+                    .split('session')[0] \
+                    .upper()
+                sess['type'] = sess['session_type']
+            else:
+                sess['session_type'] = sess_type
+                sess['type'] = sess_type
+            try:
+                sess['handedness'] = subj_id2lab[sess['subject_ID']][0]
+                sess['gender'] = subj_id2lab[sess['subject_ID']][1]
+                sess['yob'] = subj_id2lab[sess['subject_ID']][2]
+                sess['dob'] = subj_id2lab[sess['subject_ID']][3]
+            except KeyError as KE:
+                sess['handedness'] = 'UNK'
+                sess['gender'] = 'UNK'
+                sess['yob'] = 'UNK'
+                sess['dob'] = 'UNK'
 
         # Return list sorted by label
-        return sorted(full_sess_list, key=lambda k: k['session_label'])
+        return sorted(list(sess_dict.values()),
+                      key=lambda k: k['session_label'])
+
+    def _get_sessions_by_type(self, post_uri, image_only=False,
+                              sess_types=None):
+        """
+        Query XNAT for the sessions with the columns specific to their type.
+
+        The columns have to be specific to the type for last_modified (e.g.
+         xnat:mrsessiondata/meta/last_modified): the types are listed first,
+         then the sessions of all the types are queried in one search with
+         the columns of each type (two queries whatever the number of types).
+
+        :param post_uri: URI of the experiments to list
+        :param image_only: only list the image sessions
+        :param sess_types: xsiTypes of the sessions if already known (the
+                           types are not listed)
+        :return: list of sessions with last_modified, last_updated, age and
+                 insert_date set
+        """
+        if sess_types is None:
+            sess_types = self._get_session_types(post_uri)
+        if image_only:
+            sess_types = [stype for stype in sess_types
+                          if is_image_session_type(stype)]
+        if not sess_types:
+            return []
+
+        type_columns = ','.join(SESSION_TYPE_COLUMNS.format(stype=stype)
+                                for stype in sess_types)
+        sess_list = []
+        for sess in self._get_json(
+                post_uri + SESSION_POST_URI.format(type_columns=type_columns)):
+            sess_type = sess['xsiType'].lower()
+            if image_only and not is_image_session_type(sess_type):
+                continue
+            sess['last_modified'] = sess.get(
+                '%s/meta/last_modified' % sess_type, None)
+            sess['last_updated'] = sess.get('%s/original' % sess_type, None)
+            sess['age'] = sess.get('%s/age' % sess_type, None)
+            sess['insert_date'] = sess.get(
+                '%s/meta/insert_date' % sess_type, None)
+            sess_list.append(sess)
+
+        return sess_list
+
+    def _get_cached_sessions(self, projectid):
+        """
+        Get the sessions of a project through the listing cache.
+
+        One light query gets the last_modified date of the sessions on XNAT
+         (columns of the types of the cached sessions, the sessions of a new
+         type being new sessions). Only the sessions of the subjects with
+         sessions added, changed or removed are queried again, subject by
+         subject, unless there are more than LISTING_CACHE_MAX_REFRESH such
+         subjects.
+
+        :param projectid: ID of a project on XNAT
+        :return: list of sessions (see _get_sessions_by_type)
+        """
+        post_uri = ALL_SESS_PROJ_URI.format(project=projectid)
+        sess_list = self.listing_cache.get(projectid, 'sessions')
+        if sess_list is None:
+            sess_list = self._get_sessions_by_type(post_uri)
+            self.listing_cache.put(projectid, 'sessions', sess_list)
+            return sess_list
+
+        cached = dict((sess['ID'], sess) for sess in sess_list)
+        sess_types = sorted(set(sess['xsiType'].lower()
+                                for sess in sess_list))
+        mod_columns = ''.join(',%s/meta/last_modified' % stype
+                              for stype in sess_types)
+        stamps = self._get_json(
+            post_uri + SESSION_STAMP_POST_URI.format(mod_columns=mod_columns))
+
+        changed_subjects = set()
+        for stamp in stamps:
+            sess_type = stamp['xsiType'].lower()
+            if sess_type not in sess_types:
+                sess_types.append(sess_type)
+            sess = cached.pop(stamp['ID'], None)
+            last_modified = stamp.get('%s/meta/last_modified' % sess_type)
+            if sess is None or sess['last_modified'] != last_modified:
+                changed_subjects.add(stamp['subject_ID'])
+        # Sessions removed or moved to another subject:
+        changed_subjects.update(sess['subject_ID'] for sess in cached.values())
+
+        if not changed_subjects:
+            return sess_list
+
+        if len(changed_subjects) > LISTING_CACHE_MAX_REFRESH:
+            sess_list = self._get_sessions_by_type(post_uri,
+                                                   sess_types=sess_types)
+        else:
+            sess_list = [sess for sess in sess_list
+                         if sess['subject_ID'] not in changed_subjects]
+            for subjectid in sorted(changed_subjects):
+                sess_list.extend(self._get_sessions_by_type(
+                    SESSIONS_URI.format(project=projectid, subject=subjectid),
+                    sess_types=sess_types))
+        self.listing_cache.put(projectid, 'sessions', sess_list)
+        return sess_list
+
+    def _get_session_types(self, post_uri):
+        """
+        Query XNAT for the xsiTypes of the experiments
+
+        :param post_uri: URI of the experiments to list
+        :return: list of the xsiTypes (lower case)
+        """
+        type_list = []
+        for sess in self._get_json(post_uri + SESSION_TYPES_POST_URI):
+            sess_type = sess['xsiType'].lower()
+            if sess_type not in type_list:
+                type_list.append(sess_type)
+        return type_list
+
+    def get_sessions_index(self, projectid):
+        """
+        Index the sessions of a project by session ID.
+
+        Used by the project listings of scans/assessors to add the session
+         information (type, demographics, dates) to each row.
+
+        :param projectid: ID of a project on XNAT
+        :return: dictionary session ID -> session dictionary
+        """
+        return dict((sess['session_id'], sess)
+                    for sess in self.get_sessions(projectid))
 
     def get_session_resources(self, projectid, subjectid, sessionid):
         """
@@ -792,6 +1056,100 @@ class InterfaceTemp(Interface):
 
 
 # TODO: BenM/assessor_of_assessor/should be able to go
+class ProjectListingContext(object):
+    """
+    Memoize the project listings (subjects, sessions, scans, assessors) of an
+     InterfaceTemp for one pass of the launcher or of dax upload.
+
+    While the context is attached to the interface (with statement), every
+    listing of a project is queried on XNAT (or read from the listing cache)
+    only once, including the sessions listing used internally by
+    get_project_scans and get_project_assessors.
+    """
+    def __init__(self, intf):
+        """
+        Entry point for the ProjectListingContext class
+
+        :param intf: InterfaceTemp object
+        :return: None
+        """
+        self.intf = intf
+        self.listings = dict()
+
+    def __enter__(self):
+        """Attach the context to the interface."""
+        self.intf.listing_context = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Detach the context from the interface and forget the listings."""
+        if self.intf.listing_context is self:
+            self.intf.listing_context = None
+        self.listings = dict()
+
+    def memoize(self, project_id, key, fetch_func):
+        """
+        Get the listing from memory or call fetch_func and keep the result
+
+        :param project_id: ID of a project on XNAT
+        :param key: name of the listing
+        :param fetch_func: function without arguments returning the listing
+        :return: list of dictionaries (shallow copy)
+        """
+        if (project_id, key) not in self.listings:
+            self.listings[(project_id, key)] = fetch_func()
+        return list(self.listings[(project_id, key)])
+
+    def invalidate(self, project_id=None):
+        """
+        Forget the listings of a project (all projects if None)
+
+        :param project_id: ID of a project on XNAT
+        :return: None
+        """
+        if project_id is None:
+            self.listings = dict()
+        else:
+            for key in [k for k in self.listings if k[0] == project_id]:
+                del self.listings[key]
+
+    def get_subjects(self, project_id):
+        """Subjects of the project (see InterfaceTemp.get_subjects)."""
+        return self.memoize(project_id, 'subjects',
+                            lambda: self.intf.get_subjects(project_id))
+
+    def get_sessions(self, project_id):
+        """Sessions of the project (see InterfaceTemp.get_sessions)."""
+        return self.memoize(project_id, 'sessions',
+                            lambda: self.intf.get_sessions(project_id))
+
+    def get_project_scans(self, project_id):
+        """Scans of the project (see InterfaceTemp.get_project_scans)."""
+        return self.memoize(project_id, 'scans_shared',
+                            lambda: self.intf.get_project_scans(project_id))
+
+    def get_project_assessors(self, project_id):
+        """Assessors of the project (see get_project_assessors)."""
+        return self.memoize(
+            project_id, 'assessors',
+            lambda: self.intf.get_project_assessors(project_id))
+
+    def get_assessor(self, project_id, assessor_label):
+        """
+        Get the assessor dictionary from the project listing
+
+        :param project_id: ID of a project on XNAT
+        :param assessor_label: label of the assessor
+        :return: dictionary for the assessor, None if not on XNAT
+        """
+        key = (project_id, 'assessors_index')
+        if key not in self.listings:
+            self.listings[key] = dict(
+                (assr['label'], assr)
+                for assr in self.get_project_assessors(project_id))
+        return self.listings[key].get(assessor_label)
+
+
 class AssessorHandler(object):
     """
     Class to intelligently deal with the Assessor labels.
@@ -1348,122 +1706,7 @@ def list_project_assessors(intf, projectid):
     :param projectid: ID of a project on XNAT
     :return: List of all the assessors for the project
     """
-    assessors_dict = dict()
-
-    # Get the sessions list to get the different variables needed:
-    session_list = intf.get_sessions(projectid)
-    sess_id2mod = dict((sess['session_id'], [sess['subject_label'],
-                        sess['type'], sess['handedness'], sess['gender'],
-                        sess['yob'], sess['age'], sess['last_modified'],
-                        sess['last_updated']]) for sess in session_list)
-
-    if has_fs_datatypes(intf):
-        # First get FreeSurfer
-        post_uri = SE_ARCHIVE_URI
-        post_uri += ASSESSOR_FS_PROJ_POST_URI.format(
-            project=projectid, fstype=DEFAULT_FS_DATATYPE)
-        assessor_list = intf._get_json(post_uri)
-
-        pfix = DEFAULT_FS_DATATYPE.lower()
-        for asse in assessor_list:
-            if asse['label']:
-                key = asse['label']
-                if assessors_dict.get(key):
-                    res = '%s/out/file/label' % pfix
-                    assessors_dict[key]['resources'].append(asse[res])
-                else:
-                    anew = {}
-                    anew['ID'] = asse['ID']
-                    anew['label'] = asse['label']
-                    anew['uri'] = asse['URI']
-                    anew['assessor_id'] = asse['ID']
-                    anew['assessor_label'] = asse['label']
-                    anew['assessor_uri'] = asse['URI']
-                    anew['project_id'] = projectid
-                    anew['project_label'] = projectid
-                    sfix = 'xnat:imagesessiondata'
-                    anew['subject_id'] = asse['%s/subject_id' % sfix]
-                    anew['subject_label'] = asse['subject_label']
-                    anew['session_type'] = sess_id2mod[asse['session_ID']][1]
-                    anew['session_id'] = asse['session_ID']
-                    anew['session_label'] = asse['session_label']
-                    anew['procstatus'] = asse['%s/procstatus' % pfix]
-                    anew['qcstatus'] = asse['%s/validation/status' % pfix]
-                    anew['proctype'] = 'FreeSurfer'
-
-                    if len(asse['label'].rsplit('-x-FS')) > 1:
-                        anew['proctype'] = (anew['proctype'] +
-                                            asse['label'].rsplit('-x-FS')[1])
-
-                    anew['version'] = asse.get('%s/procversion' % pfix)
-                    anew['xsiType'] = asse['xsiType']
-                    anew['jobid'] = asse.get('%s/jobid' % pfix)
-                    anew['jobstartdate'] = asse.get('%s/jobstartdate' % pfix)
-                    anew['memused'] = asse.get('%s/memused' % pfix)
-                    anew['walltimeused'] = asse.get('%s/walltimeused' % pfix)
-                    anew['jobnode'] = asse.get('%s/jobnode' % pfix)
-                    anew['handedness'] = sess_id2mod[asse['session_ID']][2]
-                    anew['gender'] = sess_id2mod[asse['session_ID']][3]
-                    anew['yob'] = sess_id2mod[asse['session_ID']][4]
-                    anew['age'] = sess_id2mod[asse['session_ID']][5]
-                    anew['last_modified'] = sess_id2mod[asse['session_ID']][6]
-                    anew['last_updated'] = sess_id2mod[asse['session_ID']][7]
-                    anew['resources'] = [asse['%s/out/file/label' % pfix]]
-                    anew['inputs'] = asse.get('%s/inputs' % pfix)
-                    assessors_dict[key] = anew
-
-    if has_genproc_datatypes(intf):
-        # Then add genProcData
-        post_uri = SE_ARCHIVE_URI
-        post_uri += ASSESSOR_PR_PROJ_POST_URI.format(project=projectid,
-                                                     pstype=DEFAULT_DATATYPE)
-        assessor_list = intf._get_json(post_uri)
-
-        pfix = DEFAULT_DATATYPE.lower()
-        for asse in assessor_list:
-            if asse['label']:
-                key = asse['label']
-                if assessors_dict.get(key):
-                    res = '%s/out/file/label' % pfix
-                    assessors_dict[key]['resources'].append(asse[res])
-                else:
-                    anew = {}
-                    anew['ID'] = asse['ID']
-                    anew['label'] = asse['label']
-                    anew['uri'] = asse['URI']
-                    anew['assessor_id'] = asse['ID']
-                    anew['assessor_label'] = asse['label']
-                    anew['assessor_uri'] = asse['URI']
-                    anew['project_id'] = projectid
-                    anew['project_label'] = projectid
-                    sfix = 'xnat:imagesessiondata'
-                    anew['subject_id'] = asse['%s/subject_id' % sfix]
-                    anew['subject_label'] = sess_id2mod[asse['session_ID']][0]
-                    anew['session_type'] = sess_id2mod[asse['session_ID']][1]
-                    anew['session_id'] = asse['session_ID']
-                    anew['session_label'] = asse['session_label']
-                    anew['procstatus'] = asse['%s/procstatus' % pfix]
-                    anew['proctype'] = asse['%s/proctype' % pfix]
-                    anew['qcstatus'] = asse['%s/validation/status' % pfix]
-                    anew['version'] = asse['%s/procversion' % pfix]
-                    anew['xsiType'] = asse['xsiType']
-                    anew['jobid'] = asse.get('%s/jobid' % pfix)
-                    anew['jobnode'] = asse.get('%s/jobnode' % pfix)
-                    anew['jobstartdate'] = asse.get('%s/jobstartdate' % pfix)
-                    anew['memused'] = asse.get('%s/memused' % pfix)
-                    anew['walltimeused'] = asse.get('%s/walltimeused' % pfix)
-                    anew['handedness'] = sess_id2mod[asse['session_ID']][2]
-                    anew['gender'] = sess_id2mod[asse['session_ID']][3]
-                    anew['yob'] = sess_id2mod[asse['session_ID']][4]
-                    anew['age'] = sess_id2mod[asse['session_ID']][5]
-                    anew['last_modified'] = sess_id2mod[asse['session_ID']][6]
-                    anew['last_updated'] = sess_id2mod[asse['session_ID']][7]
-                    anew['resources'] = [asse['%s/out/file/label' % pfix]]
-                    anew['inputs'] = asse.get('%s/inputs' % pfix)
-                    assessors_dict[key] = anew
-
-    return sorted(list(assessors_dict.values()), key=lambda k: k['label'])
-
+    return intf.get_project_assessors(projectid)
 
 def list_assessor_out_resources(intf, projectid, subjectid, sessionid,
                                 assessorid):
@@ -1704,6 +1947,17 @@ def has_genproc_datatypes(intf):
     return True
 
 
+def is_image_session_type(sess_type):
+    """
+    Check if an experiment xsiType is an image session type
+
+    :param sess_type: xsiType of the experiment (e.g. xnat:mrSessionData)
+    :return: True if it is an image session type, False otherwise
+    """
+    sess_type = sess_type.lower()
+    return sess_type.startswith('xnat:') and 'session' in sess_type
+
+
 ###############################################################################
 #                     Functions to access/check object                        #
 ###############################################################################
@@ -1739,11 +1993,8 @@ def is_cscan_good_type(cscan, types_list, full_regex=False):
     :return: True if type is in the list, False if not.
 
     """
-    for exp in types_list:
-        regex = extract_exp(exp, full_regex)
-        if regex.match(cscan.info()['type']):
-            return True
-    return False
+    type_matcher = compile_type_matcher(types_list, full_regex)
+    return type_matcher.match(cscan.info()['type']) is not None
 
 
 def is_scan_unusable(scan_obj):
@@ -1783,6 +2034,19 @@ def parse_assessor_inputs(inputs):
         return None
 
 
+def serialize_inputs(inputs):
+    """
+    Serialize the inputs of an assessor into a canonical string (sorted keys)
+     to compare or index them
+
+    :param inputs: dictionary of the inputs (see parse_assessor_inputs)
+    :return: string, None if inputs is None
+    """
+    if inputs is None:
+        return None
+    return json.dumps(inputs, sort_keys=True)
+
+
 def get_assessor_inputs(assessor):
     datatype = assessor.datatype()
     inputs = assessor.attrs.get(datatype + '/inputs')
@@ -1831,11 +2095,10 @@ def get_cassr_on_same_session(cobj, proctype, is_scan_proc=False):
                                      obj_info['subject_label'],
                                      obj_info['session_label'],
                                      proctype])
-        cassr_list = [cassr for cassr in cobj.parent().assessors()
-                      if cassr.info()['label'] == assr_label]
+        cassr_list = list(cobj.parent().assessors_by_label().get(
+            assr_label, list()))
     elif isinstance(cobj, CachedImageSession):
-        cassr_list = [cassr for cassr in cobj.assessors()
-                      if cassr.info()['proctype'] == proctype]
+        cassr_list = list(cobj.assessors_by_proctype().get(proctype, list()))
     return cassr_list
 
 
@@ -1991,9 +2254,12 @@ def get_good_cscans(csess, scantypes, needs_qc=True):
      are usable
 
     """
+    type_matcher = compile_type_matcher(scantypes)
+    good_types = set(scantype for scantype in csess.scans_by_type()
+                     if type_matcher.match(scantype))
     cscans_list = list()
     for cscan in csess.scans():
-        if is_cscan_good_type(cscan, scantypes) and \
+        if cscan.type() in good_types and \
            (not needs_qc or not is_cscan_unusable(cscan)):
             cscans_list.append(cscan)
     return cscans_list
@@ -2030,11 +2296,15 @@ def get_good_cassr(csess, proctypes, needs_qc=True):
      one of the proctype(s) specified.
 
     """
+    type_matcher = compile_type_matcher(proctypes)
+    good_types = set(proctype for proctype in csess.assessors_by_proctype()
+                     if type_matcher.match(proctype))
     cassr_list = list()
     for cassr in csess.assessors():
+        if cassr.type() not in good_types:
+            continue
         usable_status = is_cassessor_usable(cassr)
-        if is_cassessor_good_type(cassr, proctypes) and \
-           (not needs_qc or usable_status == 1) and \
+        if (not needs_qc or usable_status == 1) and \
            cassr.info()['procstatus'] != 'NEED_INPUTS':
             cassr_list.append(cassr)
     return cassr_list
@@ -2576,6 +2846,140 @@ def upload_folder_to_obj(directory, resource_obj, resource_label, remove=False,
     return True
 
 
+def list_folder_files(directory, skip=None):
+    """
+    Recursively list the files of a folder with their path relative to it
+
+    :param directory: Full path of the directory
+    :param skip: list of relative paths to ignore
+    :return: sorted list of the relative paths of the files
+    """
+    skip = skip or list()
+    files = list()
+    for root, _, fnames in os.walk(directory):
+        for fname in fnames:
+            fpath = os.path.relpath(os.path.join(root, fname), directory)
+            if fpath not in skip:
+                files.append(fpath)
+    return sorted(files)
+
+
+def read_upload_progress(progress_path):
+    """
+    Read the files already uploaded from a progress file written by
+     upload_folder_files_to_obj
+
+    :param progress_path: path to the progress file
+    :return: set of (relative path, size) already uploaded
+    """
+    done = set()
+    if not os.path.isfile(progress_path):
+        return done
+    with open(progress_path, 'r') as f_obj:
+        for line in f_obj:
+            fpath, _, size = line.rstrip('\n').rpartition('\t')
+            if fpath:
+                done.add((fpath, size))
+    return done
+
+
+def upload_folder_files_to_obj(directory, resource_obj, removeall=False,
+                               nb_threads=1):
+    """
+    Upload the files of a folder one by one to a resource, streaming each
+     file from the disk (no temporary zip).
+
+    The files uploaded are recorded in UPLOAD_PROGRESS_FILENAME in the
+     folder: if the upload is interrupted, the next call only uploads the
+     files missing (and does not remove the resource). The progress file is
+     removed once all the files are uploaded.
+
+    :param directory: Full path of the directory to upload
+    :param resource_obj: pyxnat EObject of the resource to upload the data to
+    :param removeall: Remove the resource before uploading (not when resuming)
+    :param nb_threads: number of files uploaded in parallel, each worker with
+     its own connection to XNAT
+    :return: True if all the files were uploaded, False otherwise
+    """
+    if not os.path.isdir(directory):
+        err = '%s: directory %s does not exist.'
+        raise XnatUtilsError(err % ('upload_folder_files_to_obj', directory))
+
+    progress_path = os.path.join(directory, UPLOAD_PROGRESS_FILENAME)
+    done = read_upload_progress(progress_path)
+    if done:
+        print('Resuming upload of %s: %d files already uploaded.'
+              % (directory, len(done)))
+    elif removeall and resource_obj.exists():
+        resource_obj.delete()
+    if not resource_obj.exists():
+        resource_obj.create()
+
+    todo = list()
+    for fpath in list_folder_files(directory, [UPLOAD_PROGRESS_FILENAME]):
+        size = str(os.path.getsize(os.path.join(directory, fpath)))
+        if (fpath, size) not in done:
+            todo.append((fpath, size))
+
+    progress_lock = threading.Lock()
+    worker_local = threading.local()
+    worker_intfs = list()
+    intf = resource_obj._intf
+    nb_threads = min(max(1, int(nb_threads)), len(todo))
+
+    def upload_one(file_info):
+        fpath, size = file_info
+        res_obj = resource_obj
+        if nb_threads > 1:
+            if getattr(worker_local, 'intf', None) is None:
+                worker_local.intf = get_interface(intf.host, intf.user,
+                                                  intf.pwd)
+                with progress_lock:
+                    worker_intfs.append(worker_local.intf)
+            res_obj = worker_local.intf.select(resource_obj._uri)
+        try:
+            res_obj.file(str(fpath)).put(
+                str(os.path.join(directory, fpath)), overwrite=True,
+                params={"event_reason": "DAX uploading file"})
+        except Exception as err:
+            print('Warning: upload_folder_files_to_obj in XnatUtils: failed \
+to upload %s: %s' % (fpath, err))
+            return False
+        with progress_lock:
+            with open(progress_path, 'a') as f_obj:
+                f_obj.write('%s\t%s\n' % (fpath, size))
+        return True
+
+    if nb_threads > 1:
+        pool = ThreadPool(processes=nb_threads)
+        try:
+            status = pool.map(upload_one, todo)
+        finally:
+            pool.close()
+            pool.join()
+            for worker_intf in worker_intfs:
+                worker_intf.disconnect()
+    else:
+        status = [upload_one(file_info) for file_info in todo]
+
+    if not all(status):
+        return False
+    if os.path.isfile(progress_path):
+        os.remove(progress_path)
+    return True
+
+
+def get_folder_size(directory):
+    """
+    Get the total size of the files in a folder
+
+    :param directory: Full path of the directory
+    :return: size in bytes
+    """
+    return sum(os.path.getsize(os.path.join(directory, fpath))
+               for fpath in list_folder_files(directory))
+
+
 def upload_folder(directory, project_id=None, subject_id=None, session_id=None,
                   scan_id=None, assessor_id=None, resource=None, remove=False,
                   removeall=False, extract=True):
@@ -2625,6 +3029,286 @@ def upload_reference(reference, assessor_obj, resource):
         err = 'bad response on put:{}'.format(_resp.content)
         raise XnatUtilsError(err)
 
+def get_resource_files_size(resource_obj):
+    """
+    Get the number of files and their total size from the catalog of a
+     resource on XNAT
+
+    :param resource_obj: pyxnat EObject of the resource
+    :return: tuple (number of files, total size in bytes)
+    """
+    files = resource_obj._intf._get_json('%s/files' % resource_obj._uri)
+    return len(files), sum(int(f.get('Size') or 0) for f in files)
+
+
+def check_reference_upload(directory, resource_obj):
+    """
+    Check that the catalog of a resource uploaded by reference has the same
+     number of files and total size as the local folder
+
+    :param directory: Full path of the local directory
+    :param resource_obj: pyxnat EObject of the resource
+    :return: True if the number of files and the size match, False otherwise
+    """
+    local_files = list_folder_files(directory)
+    local_size = get_folder_size(directory)
+    nb_files, size = get_resource_files_size(resource_obj)
+    if nb_files != len(local_files) or size != local_size:
+        print('Warning: check_reference_upload in XnatUtils: %s has %d files \
+(%d bytes) on XNAT, %d files (%d bytes) locally.'
+              % (resource_obj.label(), nb_files, size, len(local_files),
+                 local_size))
+        return False
+    return True
+
+
+def get_resource_catalog(resource_obj):
+    """
+    Get the catalog of a resource on XNAT with one request
+
+    :param resource_obj: pyxnat EObject of the resource
+    :return: dictionary of the catalog entries keyed by the path of the file
+     in the resource (Name, Size, digest, file_format, ... from XNAT)
+    """
+    if not resource_obj.exists():
+        return dict()
+    catalog = dict()
+    for f_info in resource_obj._intf._get_json('%s/files' % resource_obj._uri):
+        uri = f_info.get('URI', '')
+        if '/files/' in uri:
+            fpath = uri.split('/files/', 1)[1]
+        else:
+            fpath = f_info.get('Name')
+        catalog[fpath] = f_info
+    return catalog
+
+
+def diff_resource_catalogs(src_catalog, dst_catalog):
+    """
+    Get the files of a source catalog missing or different in a destination
+     catalog, comparing the size and the digest of the files (the digest only
+     if both catalogs have one)
+
+    :param src_catalog: catalog of the source resource (get_resource_catalog)
+    :param dst_catalog: catalog of the destination resource
+    :return: sorted list of the paths of the files to copy
+    """
+    fpaths = list()
+    for fpath, src_info in src_catalog.items():
+        dst_info = dst_catalog.get(fpath)
+        if dst_info is None:
+            fpaths.append(fpath)
+        elif str(src_info.get('Size')) != str(dst_info.get('Size')):
+            fpaths.append(fpath)
+        elif src_info.get('digest') and dst_info.get('digest') and \
+                src_info['digest'] != dst_info['digest']:
+            fpaths.append(fpath)
+    return sorted(fpaths)
+
+
+def read_download_manifest(path):
+    """
+    Read the manifest of the files downloaded in a folder
+
+    :param path: path to the manifest file
+    :return: dictionary path -> (size, digest, timestamp), the last entry of
+     a path winning
+    """
+    manifest = dict()
+    if os.path.isfile(path):
+        with open(path, 'r') as f_obj:
+            for line in f_obj:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 4:
+                    manifest[fields[0]] = tuple(fields[1:])
+    return manifest
+
+
+def diff_download_manifest(catalog, manifest):
+    """
+    Get the files of a resource not recorded in the manifest of a download
+     folder with their size and digest in the catalog (files not downloaded,
+     failed or changed on XNAT since)
+
+    :param catalog: catalog of the resource (get_resource_catalog)
+    :param manifest: manifest of the folder (read_download_manifest)
+    :return: sorted list of the paths of the files
+    """
+    fpaths = list()
+    for fpath, f_info in catalog.items():
+        size = str(f_info.get('Size') or '')
+        digest = f_info.get('digest') or ''
+        entry = manifest.get(fpath)
+        if not entry or entry[:2] != (size, digest):
+            fpaths.append(fpath)
+    return sorted(fpaths)
+
+
+def download_file_resume(intf, uri, fpath, size=None, digest=None):
+    """
+    Download a file from XNAT to fpath through a DOWNLOAD_PART_EXT file,
+     resuming a partial file from a previous call with a Range request
+
+    If size and digest (MD5) are given, the file downloaded is checked
+     against them before being renamed to fpath: a resumed file that does
+     not match (partial file of an older version of the file) is downloaded
+     again from the start.
+
+    :param intf: pyxnat Interface
+    :param uri: URI of the file on XNAT
+    :param fpath: local path of the file
+    :param size: size of the file in the catalog of the resource
+    :param digest: digest of the file in the catalog of the resource
+    :return: None
+    """
+    part_path = fpath + DOWNLOAD_PART_EXT
+    offset = 0
+    if os.path.isfile(part_path):
+        offset = os.path.getsize(part_path)
+    headers = {'Range': 'bytes=%d-' % offset} if offset else None
+    response = intf.get(uri, stream=True, headers=headers)
+    try:
+        if response.status_code == 416:
+            # Partial file already complete
+            response.close()
+            response = intf.get(uri, stream=True)
+            offset = 0
+        response.raise_for_status()
+        # 200 if the server ignored the Range: restart the file
+        mode = 'ab' if offset and response.status_code == 206 else 'wb'
+        with open(part_path, mode) as f_obj:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                if chunk:
+                    f_obj.write(chunk)
+    finally:
+        response.close()
+    error = None
+    part_size = os.path.getsize(part_path)
+    if size and part_size != int(size):
+        error = '%d bytes instead of %s' % (part_size, size)
+    elif digest and get_file_md5(part_path) != digest:
+        error = 'digest different from %s' % digest
+    if error:
+        os.remove(part_path)
+        if offset:
+            # Stale partial file: start over
+            return download_file_resume(intf, uri, fpath, size, digest)
+        raise XnatUtilsError('download of %s: %s' % (uri, error))
+    os.rename(part_path, fpath)
+
+
+def get_file_md5(fpath):
+    """
+    Compute the MD5 digest of a file (digest of the files on XNAT)
+
+    :param fpath: path of the file
+    :return: hexadecimal MD5 digest
+    """
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as f_obj:
+        for chunk in iter(lambda: f_obj.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def download_resource_files(directory, resource_obj, nb_threads=1,
+                            catalog=None):
+    """
+    Download the files of a resource in a folder (keeping their path in the
+     resource) with nb_threads workers.
+
+    The files downloaded are recorded in DOWNLOAD_MANIFEST_FILENAME in the
+     folder with their size and digest on XNAT: a file is only downloaded
+     again if it is missing locally or if it changed in the catalog of the
+     resource (one request for the resource, none per file). A transfer
+     interrupted is resumed from its partial file at the next call.
+
+    :param directory: Full path of the download directory
+    :param resource_obj: pyxnat EObject of the resource
+    :param nb_threads: number of files downloaded in parallel, each worker
+     with its own connection to XNAT
+    :param catalog: catalog of the resource if already queried
+     (get_resource_catalog)
+    :return: list of the paths of the files downloaded (not the files
+     skipped)
+    """
+    if catalog is None:
+        catalog = get_resource_catalog(resource_obj)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    manifest_path = os.path.join(directory, DOWNLOAD_MANIFEST_FILENAME)
+    manifest = read_download_manifest(manifest_path)
+    todo = list()
+    for fpath, f_info in sorted(catalog.items()):
+        size = str(f_info.get('Size') or '')
+        digest = f_info.get('digest') or ''
+        local_path = os.path.join(directory, fpath)
+        entry = manifest.get(fpath)
+        if entry and entry[:2] == (size, digest) and \
+                os.path.isfile(local_path) and \
+                str(os.path.getsize(local_path)) == size:
+            continue
+        todo.append((fpath, f_info['URI'], size, digest))
+
+    manifest_lock = threading.Lock()
+    worker_local = threading.local()
+    worker_intfs = list()
+    intf = resource_obj._intf
+    nb_threads = min(max(1, int(nb_threads)), len(todo))
+
+    def download_one(file_info):
+        fpath, uri, size, digest = file_info
+        local_path = os.path.join(directory, fpath)
+        dl_intf = intf
+        if nb_threads > 1:
+            if getattr(worker_local, 'intf', None) is None:
+                worker_local.intf = get_interface(intf.host, intf.user,
+                                                  intf.pwd)
+                with manifest_lock:
+                    worker_intfs.append(worker_local.intf)
+            dl_intf = worker_local.intf
+        try:
+            if not os.path.exists(os.path.dirname(local_path)):
+                try:
+                    os.makedirs(os.path.dirname(local_path))
+                except OSError:
+                    # Created by another worker
+                    pass
+            download_file_resume(dl_intf, uri, local_path, size, digest)
+        except Exception as err:
+            print('Warning: download_resource_files in XnatUtils: failed to \
+download %s: %s' % (fpath, err))
+            return None
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        with manifest_lock:
+            with open(manifest_path, 'a') as f_obj:
+                f_obj.write('%s\t%s\t%s\t%s\n'
+                            % (fpath, size, digest, timestamp))
+        return local_path
+
+    if nb_threads > 1:
+        pool = ThreadPool(processes=nb_threads)
+        try:
+            fpaths = pool.map(download_one, todo)
+        finally:
+            pool.close()
+            pool.join()
+            for worker_intf in worker_intfs:
+                worker_intf.disconnect()
+    else:
+        fpaths = [download_one(file_info) for file_info in todo]
+
+    if todo:
+        # Compact the manifest: one line per file
+        manifest = read_download_manifest(manifest_path)
+        with open(manifest_path, 'w') as f_obj:
+            for fpath in sorted(manifest):
+                f_obj.write('%s\t%s\n' % (fpath, '\t'.join(manifest[fpath])))
+
+    return [fpath for fpath in fpaths if fpath]
+
+
 def copy_resource_from_obj(directory, xnat_obj, old_res, new_res):
     """
     Copy a resource from an old location to a new location,
@@ -2736,13 +3420,11 @@ def filter_list_dicts_regex(list_dicts, key, expressions, nor=False,
 found, <type 'str'> or <type 'list'> required." % type(expressions)
         raise XnatUtilsError(err)
 
-    for exp in expressions:
-        regex = extract_exp(exp, full_regex)
-        if nor:
-            flist = [d for d in flist if not regex.match(d[key])]
-        else:
-            flist.extend([d for d in list_dicts
-                          if regex.match(d[key])])
+    type_matcher = compile_type_matcher(expressions, full_regex)
+    if nor:
+        flist = [d for d in flist if not type_matcher.match(d[key])]
+    else:
+        flist = [d for d in list_dicts if type_matcher.match(d[key])]
     return flist
 
 
@@ -2753,11 +3435,44 @@ def extract_exp(expression, full_regex=False):
     :param full_regex: using full regex
     :return: regex Object from re package
     """
+    exp = expression
     if not full_regex:
         exp = fnmatch.translate(expression)
     return re.compile(exp)
 
 
+def compile_type_matcher(expressions, full_regex=False):
+    """Compile a list of expressions into one regex (alternation).
+
+    The regex matches a value if any of the expressions matches it (as
+     extract_exp().match). The compiled regexes are cached by expressions.
+
+    :param expressions: list of expressions (fnmatch patterns by default)
+    :param full_regex: using full regex
+    :return: regex Object from re package
+    """
+    key = (tuple(expressions), full_regex)
+    type_matcher = TYPE_MATCHERS.get(key)
+    if type_matcher is None:
+        flags = ''
+        parts = list()
+        for expression in expressions:
+            exp = expression
+            if not full_regex:
+                exp = fnmatch.translate(expression)
+                # python 2 adds the flags at the end of the pattern
+                if exp.endswith('(?ms)'):
+                    exp = exp[:-len('(?ms)')]
+                    flags = '(?ms)'
+            parts.append('(?:%s)' % exp)
+        if not parts:
+            # Nothing matches an empty list of expressions
+            parts.append('(?!)')
+        type_matcher = re.compile(flags + '|'.join(parts))
+        TYPE_MATCHERS[key] = type_matcher
+    return type_matcher
+
+
 def clean_directory(directory):
     """
     Remove a directory tree or file
@@ -3043,6 +3758,157 @@ def get_random_sessions(xnat, project_id, num_sessions):
 ###############################################################################
 #                                5) Cached Class                              #
 ###############################################################################
+def get_element_datatype(element):
+    """
+    Get the xsiType of an XNAT element from its XML root element
+
+    The xsi:type attribute is used when present, otherwise the type is
+     derived from the tag (e.g: xnat:MRSession -> xnat:mrSessionData).
+
+    :param element: ElementTree element of the XNAT object
+    :return: string of the xsiType
+    """
+    xsi_type = element.get('{http://www.w3.org/2001/XMLSchema-instance}type')
+    if xsi_type:
+        return xsi_type
+
+    namespace, _, name = element.tag[1:].partition('}')
+    prefix = next((key for key, value in list(NS.items())
+                   if value == namespace), 'xnat')
+    match = re.match(r'^([A-Z]*)([A-Z][a-z].*)$', name)
+    if match:
+        name = match.group(1).lower() + match.group(2)
+    else:
+        name = name[0].lower() + name[1:]
+    return '%s:%sData' % (prefix, name)
+
+
+def _set_child_text(element, tag, text):
+    """
+    Set the text of the child of an element, creating the child if needed
+
+    :param element: ElementTree element
+    :param tag: tag of the child with its namespace
+    :param text: text to set
+    :return: None
+    """
+    child = element.find(tag)
+    if child is None:
+        child = ET.SubElement(element, tag)
+    child.text = text
+
+
+class SessionPrefetcher(object):
+    """
+    Class to load the CachedImageSession of a list of sessions with the XML
+     of the sessions queried in parallel.
+
+    XNAT does not give the full XML of several sessions in a single request,
+     so the requests are sent concurrently from a pool of workers, each one
+     with its own connection to XNAT (pyxnat interfaces are not thread safe).
+     The datatype and the creation date come from the XML and the listing of
+     the sessions so no other request is needed per session.
+    """
+    def __init__(self, intf, nb_threads=1):
+        """
+        Entry point for the SessionPrefetcher class
+
+        :param intf: InterfaceTemp object used to open the workers connection
+        :param nb_threads: number of sessions fetched in parallel
+        :return: None
+        """
+        self.intf = intf
+        self.nb_threads = max(1, int(nb_threads))
+        self.pool = None
+        self.worker_intfs = list()
+        self.worker_lock = threading.Lock()
+        self.worker_local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _worker_intf(self):
+        """
+        Get the connection to XNAT of the current worker
+
+        :return: InterfaceTemp object
+        """
+        if getattr(self.worker_local, 'intf', None) is None:
+            self.worker_local.intf = get_interface(
+                self.intf.host, self.intf.user, self.intf.pwd)
+            with self.worker_lock:
+                self.worker_intfs.append(self.worker_local.intf)
+        return self.worker_local.intf
+
+    def _fetch_xml(self, sess_info):
+        """
+        Query the XML of a session with the connection of the worker
+
+        :param sess_info: dictionary of the session (see get_sessions)
+        :return: XML string of the session
+        """
+        experiment = self._worker_intf().select_experiment(
+            sess_info['project_label'], sess_info['subject_label'],
+            sess_info['session_label'])
+        return experiment.get()
+
+    def load(self, intf, sessions, prefetch=None):
+        """
+        Get the CachedImageSession for a list of sessions
+
+        The sessions not in prefetch are lazy: their XML is only queried the
+         first time it is needed.
+
+        :param intf: InterfaceTemp object given to the CachedImageSession
+        :param sessions: list of session dictionaries (see get_sessions)
+        :param prefetch: IDs of the sessions to fetch now, all if None
+        :return: list of CachedImageSession in the order of sessions
+        """
+        if prefetch is None:
+            to_fetch = list(sessions)
+        else:
+            to_fetch = [sess for sess in sessions if sess['ID'] in prefetch]
+
+        xml_dict = dict()
+        if self.nb_threads > 1 and len(to_fetch) > 1:
+            # the prefetcher is shared by the build threads: only one of
+            # them creates the pool
+            with self.worker_lock:
+                if self.pool is None:
+                    self.pool = ThreadPool(processes=self.nb_threads)
+                pool = self.pool
+            xml_list = pool.map(self._fetch_xml, to_fetch)
+            xml_dict = dict((sess['ID'], xml_str)
+                            for sess, xml_str in zip(to_fetch, xml_list))
+
+        fetch_ids = set(sess['ID'] for sess in to_fetch)
+        return [CachedImageSession.from_listing(
+            intf, sess, xml_str=xml_dict.get(sess['ID']),
+            lazy=sess['ID'] not in fetch_ids)
+            for sess in sessions]
+
+    def close(self):
+        """
+        Stop the workers and close their connections to XNAT
+
+        :return: None
+        """
+        with self.worker_lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for worker_intf in self.worker_intfs:
+            try:
+                worker_intf.disconnect()
+            except Exception as err:
+                print('Warning: failed to disconnect worker: %s' % err)
+        self.worker_intfs = list()
+
+
 class CachedImageSession(object):
     """
     Enumeration for assessors function, to control what assessors are returned
@@ -3058,7 +3924,8 @@ class CachedImageSession(object):
     """
     Class to cache the XML information for a session on XNAT
     """
-    def __init__(self, intf, proj, subj, sess):
+    def __init__(self, intf, proj, subj, sess, xml_str=None, datatype=None,
+                 creation_timestamp=None, lazy=False, last_modified=None):
         """
         Entry point for the CachedImageSession class
 
@@ -3066,36 +3933,212 @@ class CachedImageSession(object):
         :param proj: XNAT project ID
         :param subj: XNAT subject ID/label
         :param sess: XNAT session ID/label
+        :param xml_str: XML of the session if already fetched (see
+                        SessionPrefetcher), queried on XNAT otherwise
+        :param datatype: xsiType of the session, read from the XML if None
+        :param creation_timestamp: insert_date of the session if known
+        :param lazy: if True, wait for the first access to the XML to query it
+        :param last_modified: last_modified date of the session when the XML
+                              was (or will be) fetched, if known
         :return: None
 
         """
-        experiment = intf.select_experiment(proj, subj, sess)
-        self.datatype_ = experiment.datatype()
-        xml_str = experiment.get()
-        self.creation_timestamp_ =\
-            experiment.attrs.get(self.datatype_+'/meta/insert_date')
-        self.sess_element = ET.fromstring(xml_str)
         self.project = proj
         self.subject = subj
         self.session = sess
         self.intf = intf  # cache for later usage
-        self.full_object_ = experiment
+        self.full_object_ = None
+        self.sess_element_ = None
+        self.label_ = None
+        self.datatype_ = datatype
+        self.creation_timestamp_ = creation_timestamp
+        self.last_modified_ = last_modified
         self.sess_info_ = None
         self.scans_ = None
         self.assessors_ = None
+        self.indexes_ = dict()
+
+        if xml_str is not None:
+            self.sess_element_ = ET.fromstring(xml_str)
+        elif not lazy:
+            self._load()
+        if not lazy:
+            self.datatype()
+            self.creation_timestamp()
+
+    @classmethod
+    def from_listing(cls, intf, sess_info, xml_str=None, lazy=True):
+        """
+        Create the CachedImageSession of a row of the sessions listing
+
+        The label, ID, xsiType and insert date come from the listing so the
+         XML of a lazy session is only queried when scans(), assessors(),
+         info(), get() or resources() is called.
+
+        :param intf: pyxnat Interface object
+        :param sess_info: dictionary of the session (see get_sessions)
+        :param xml_str: XML of the session if already fetched
+        :param lazy: if True, wait for the first access to the XML to query it
+        :return: CachedImageSession object
+        """
+        csess = cls(intf, sess_info['project_label'],
+                    sess_info['subject_label'], sess_info['session_label'],
+                    xml_str=xml_str, datatype=sess_info.get('xsiType'),
+                    creation_timestamp=sess_info.get('insert_date'),
+                    lazy=lazy, last_modified=sess_info.get('last_modified'))
+        csess.label_ = sess_info['session_label']
+        return csess
+
+    @property
+    def sess_element(self):
+        """
+        XML element of the session, queried on XNAT on the first access
+
+        :return: ElementTree element of the session
+        """
+        if self.sess_element_ is None:
+            self._load()
+        return self.sess_element_
+
+    def is_loaded(self):
+        """
+        Check if the XML of the session has been queried
+
+        :return: True if the XML is cached, False otherwise
+        """
+        return self.sess_element_ is not None
 
     def entity_type(self):
         return 'session'
 
-    def reload(self):
+    def _load(self):
+        """
+        Query the XML of the session and clear the cached objects
+
+        :return: None
+        """
         experiment = self.intf.select_experiment(self.project,
                                               self.subject,
                                               self.session)
-        self.sess_element = ET.fromstring(experiment.get())
+        self.sess_element_ = ET.fromstring(experiment.get())
         self.full_object_ = experiment
         self.sess_info_ = None
         self.scans_ = None
         self.assessors_ = None
+        self.indexes_ = dict()
+
+    def reload(self):
+        """
+        Query the last_modified date and the XML of the session
+
+        :return: None
+        """
+        self.last_modified_ = self.query_last_modified()
+        self._load()
+
+    def query_last_modified(self):
+        """
+        Query the last_modified date of the session on XNAT
+
+        :return: string of the last_modified date
+        """
+        return self.full_object().attrs.get(
+            self.datatype() + '/meta/last_modified')
+
+    def last_modified(self):
+        """
+        Get the last_modified date of the session when the XML was cached
+
+        :return: string of the last_modified date, None if unknown
+        """
+        return self.last_modified_
+
+    def refresh_last_modified(self):
+        """
+        Set the last_modified date to the one on XNAT without reloading.
+
+        Used after the cached XML was patched with the changes made to the
+         session (see add_assessor) so they don't trigger a reload.
+
+        :return: None
+        """
+        self.last_modified_ = self.query_last_modified()
+
+    def reload_if_modified(self):
+        """
+        Reload the XML of the session only if it was modified on XNAT since
+         it was cached
+
+        :return: True if the session was reloaded, False otherwise
+        """
+        last_modified = self.query_last_modified()
+        if self.is_loaded() and self.last_modified_ and last_modified and \
+           last_modified[0:19] == self.last_modified_[0:19]:
+            return False
+
+        self.last_modified_ = last_modified
+        self._load()
+        return True
+
+    def add_assessor(self, xsitype, assessor_id, label, fields):
+        """
+        Add a new assessor to the cached XML of the session without
+         querying XNAT again.
+
+        :param xsitype: xsiType of the assessor (e.g: proc:genProcData)
+        :param assessor_id: ID of the assessor
+        :param label: label of the assessor
+        :param fields: dictionary of the assessor fields set at creation,
+                       keys like '<xsitype>/proctype' or 'proctype'
+        :return: None
+        """
+        prefix = xsitype.split(':')[0]
+        assr_elements = self.sess_element.find('xnat:assessors', NS)
+        if assr_elements is None:
+            assr_elements = ET.SubElement(self.sess_element,
+                                          '{%s}assessors' % NS['xnat'])
+        assr = ET.SubElement(assr_elements, '{%s}assessor' % NS['xnat'])
+        assr.set('{%s}type' % NS['xsi'], xsitype)
+        assr.set('ID', assessor_id)
+        assr.set('label', label)
+        assr.set('project', self.project)
+        for key, value in list(fields.items()):
+            name = key.split('/', 1)[-1]
+            namespace = NS['xnat'] if name == 'date' else NS[prefix]
+            ET.SubElement(assr, '{%s}%s' % (namespace, name)).text = str(value)
+        self.assessors_ = None
+        self.indexes_ = dict()
+
+    def update_assessor(self, label, procstatus=None, qcstatus=None):
+        """
+        Set the statuses of an assessor in the cached XML of the session
+
+        :param label: label or full label (proj-x-subj-x-sess-x-label) of
+                      the assessor
+        :param procstatus: new procstatus, unchanged if None
+        :param qcstatus: new qcstatus, unchanged if None
+        :return: None
+        """
+        assr_elements = self.sess_element.find('xnat:assessors', NS)
+        if assr_elements is None:
+            return
+        for assr in assr_elements:
+            assr_label = assr.get('label')
+            if label != assr_label and \
+               not label.endswith('-x-%s' % assr_label):
+                continue
+            prefix = assr.get('{%s}type' % NS['xsi']).split(':')[0]
+            if procstatus is not None:
+                _set_child_text(assr, '{%s}procstatus' % NS[prefix],
+                                procstatus)
+            if qcstatus is not None:
+                validation = assr.find('xnat:validation', NS)
+                if validation is None:
+                    validation = ET.SubElement(
+                        assr, '{%s}validation' % NS['xnat'])
+                validation.set('status', qcstatus)
+        self.assessors_ = None
+        self.indexes_ = dict()
 
     def label(self):
         """
@@ -3104,6 +4147,8 @@ class CachedImageSession(object):
         :return: String of the session label
 
         """
+        if self.label_ is not None and not self.is_loaded():
+            return self.label_
         return self.sess_element.get('label')
 
     def full_path(self):
@@ -3210,6 +4255,64 @@ class CachedImageSession(object):
 
         return self.assessors_
 
+    def _index(self, name, objects, key_func):
+        """
+        Get an index of the scans/assessors of the session, built on the
+         first call and cleared when the XML changes
+
+        :param name: name of the index
+        :param objects: list of the objects to index
+        :param key_func: function returning the key of an object, the
+                         objects with a None key are not indexed
+        :return: OrderedDict key -> list of objects (in the session order)
+        """
+        index = self.indexes_.get(name)
+        if index is None:
+            index = collections.OrderedDict()
+            for obj in objects:
+                key = key_func(obj)
+                if key is not None:
+                    index.setdefault(key, list()).append(obj)
+            self.indexes_[name] = index
+        return index
+
+    def scans_by_type(self):
+        """
+        Get the CachedImageScan objects of the session by scan type
+
+        :return: OrderedDict scan type -> list of CachedImageScan objects
+        """
+        return self._index('scans_by_type', self.scans(),
+                           lambda cscan: cscan.type())
+
+    def assessors_by_proctype(self):
+        """
+        Get the CachedImageAssessor objects of the session by proctype
+
+        :return: OrderedDict proctype -> list of CachedImageAssessor objects
+        """
+        return self._index('assessors_by_proctype', self.assessors(),
+                           lambda cassr: cassr.type())
+
+    def assessors_by_label(self):
+        """
+        Get the CachedImageAssessor objects of the session by label
+
+        :return: OrderedDict label -> list of CachedImageAssessor objects
+        """
+        return self._index('assessors_by_label', self.assessors(),
+                           lambda cassr: cassr.info()['label'])
+
+    def assessors_by_inputs(self):
+        """
+        Get the CachedImageAssessor objects of the session by their inputs
+         (see serialize_inputs), assessors without inputs are not indexed
+
+        :return: OrderedDict serialized inputs -> list of CachedImageAssessor
+        """
+        return self._index('assessors_by_inputs', self.assessors(),
+                           lambda cassr: serialize_inputs(cassr.get_inputs()))
+
     def info(self):
         """
         Get a dictionary of lots of variables that correspond to the session
@@ -3283,10 +4386,15 @@ class CachedImageSession(object):
 
 
     def creation_timestamp(self):
+        if self.creation_timestamp_ is None:
+            self.creation_timestamp_ = self.full_object().attrs.get(
+                self.datatype() + '/meta/insert_date')
         return self.creation_timestamp_
 
 
     def datatype(self):
+        if not self.datatype_:
+            self.datatype_ = get_element_datatype(self.sess_element)
         return self.datatype_
 
 
@@ -3746,8 +4854,13 @@ class CachedResource(object):
         return self.res_element.get('label')
 
     def file_count(self):
-        file_count = self.get('filecount')
-        return file_count if file_count != '' else 0
+        """
+        Get the number of files of the resource from the XML
+
+        :return: int, None if the file_count is not set in the XML
+        """
+        file_count = self.get('file_count')
+        return int(file_count) if file_count != '' else None
 
     def get(self, name):
         """
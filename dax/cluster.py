@@ -10,6 +10,7 @@ from builtins import str
 from builtins import object
 
 import os
+import re
 import time
 import logging
 import subprocess as sb
@@ -22,6 +23,15 @@ from .errors import ClusterError
 __copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
 DAX_SETTINGS = DAX_Settings()
 MAX_TRACE_DAYS = 30
+# Index of the element in a job array for slurm, SGE and Torque/MOAB
+ARRAY_INDEX_VAR = '${SLURM_ARRAY_TASK_ID:-${SGE_TASK_ID:-${PBS_ARRAYID:-\
+${MOAB_JOBARRAYINDEX}}}}'
+ARRAY_MANIFEST = 'manifest.txt'
+# SGE prints "Your job-array <jobid>.<first>-<last>:<step> ..." when
+# submitting a job array instead of "Your job <jobid> ..."
+SGE_ARRAY_JOBID = re.compile(r'Your job-array (\d+)\.\d+-\d+:\d+')
+COUNT_JOBS_TRIES = 5
+COUNT_JOBS_WAIT = 2
 # Logger to print logs
 LOGGER = logging.getLogger('dax')
 
@@ -46,21 +56,24 @@ def count_jobs():
     """
     Count the number of jobs in the queue on the cluster
 
-    :return: number of jobs in the queue
+    :return: number of jobs in the queue, -1 if the scheduler did not
+             answer after COUNT_JOBS_TRIES tries
     """
     if command_found(cmd=DAX_SETTINGS.get_cmd_submit()):
         cmd = DAX_SETTINGS.get_cmd_count_nb_jobs()
-        output = sb.check_output(cmd, shell=True)
-        error = c_output(output)
-        while error:
-            LOGGER.info('    try again to access number of jobs in 2 seconds.')
-            time.sleep(2)
-            output = sb.check_output(cmd, shell=True)
-            error = c_output(output)
-        if int(output) < 0:
-            return 0
-        else:
-            return int(output)
+        for ntry in range(COUNT_JOBS_TRIES):
+            if ntry > 0:
+                LOGGER.info('    try again to access number of jobs in %d \
+seconds.' % COUNT_JOBS_WAIT)
+                time.sleep(COUNT_JOBS_WAIT)
+            try:
+                output = sb.check_output(cmd, shell=True)
+            except sb.CalledProcessError as err:
+                LOGGER.error(err)
+                continue
+            if not c_output(output):
+                return max(int(output), 0)
+        return -1
     else:
         LOGGER.info(' Running locally. No queue with jobs.')
         return 0
@@ -79,18 +92,120 @@ def job_status(jobid):
     try:
         output = sb.check_output(cmd, stderr=sb.STDOUT, shell=True)
         output = output.strip()
-        if output == DAX_SETTINGS.get_running_status():
-            return 'R'
-        elif output == DAX_SETTINGS.get_queue_status():
-            return 'Q'
-        elif output == DAX_SETTINGS.get_complete_status() or len(output) == 0:
+        if len(output) == 0:
             return 'C'
-        else:
-            return None
+        return job_state(output)
     except sb.CalledProcessError:
         return None
 
 
+def job_state(state):
+    """
+    Convert a state from the scheduler to the job status used by dax
+
+    :param state: state string printed by the scheduler
+    :return: 'R', 'Q', 'C' or None (unknown, considered running)
+    """
+    if state == DAX_SETTINGS.get_running_status():
+        return 'R'
+    elif state == DAX_SETTINGS.get_queue_status():
+        return 'Q'
+    elif state == DAX_SETTINGS.get_complete_status():
+        return 'C'
+    else:
+        return None
+
+
+def short_jobid(jobid):
+    """
+    Remove the server name from a job id (e.g: 1234.server -> 1234), keeping
+     the index of an element of a SGE job array (e.g: 1234.5)
+
+    :param jobid: job id
+    :return: job id without the server name
+    """
+    fields = str(jobid).strip().split('.')
+    if len(fields) > 1 and fields[1].isdigit():
+        return '.'.join(fields[:2])
+    return fields[0]
+
+
+def list_jobs():
+    """
+    Get the status of all the jobs of the user with one call to the scheduler
+     (cmd_list_jobs printing one "jobid state" per line, or "jobid state
+     task" when the scheduler prints the index of the elements of a job
+     array apart, e.g. the ja-task-ID column of SGE)
+
+    :return: dictionary jobid -> status (see job_state), None if the command
+             is not set or failed
+    """
+    cmd = DAX_SETTINGS.get_cmd_list_jobs()
+    if not cmd or not command_found(cmd=DAX_SETTINGS.get_cmd_submit()):
+        return None
+
+    try:
+        output = sb.check_output(cmd, stderr=sb.STDOUT, shell=True)
+    except sb.CalledProcessError as err:
+        LOGGER.error('failed to list the jobs on the cluster: %s' % err)
+        return None
+
+    jobs = dict()
+    for line in output.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        state = fields[1] if len(fields) > 1 else ''
+        jobid = short_jobid(fields[0])
+        if len(fields) > 2:
+            jobid = '%s.%s' % (jobid, fields[2])
+        jobs[jobid] = job_state(state)
+    return jobs
+
+
+class ClusterJobs(object):
+    """
+    Snapshot of the jobs of the user on the cluster, queried once per pass
+     of dax update instead of once per job.
+    """
+    def __init__(self):
+        """
+        Entry point for the ClusterJobs class
+
+        :return: None
+        """
+        self.jobs = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Query the scheduler for the status of all the jobs
+
+        :return: None
+        """
+        self.jobs = list_jobs()
+        if self.jobs is None:
+            LOGGER.debug('cmd_list_jobs not available, querying each job')
+        else:
+            LOGGER.info('%d jobs found on the cluster' % len(self.jobs))
+
+    def job_status(self, jobid):
+        """
+        Get the status of a job from the snapshot.
+
+        A job missing from the listing is confirmed with a query for this
+         job only (it might have been submitted after the snapshot), as well
+         as every job when cmd_list_jobs is not set.
+
+        :param jobid: job id to check
+        :return: job status (see job_status)
+        """
+        jobid = short_jobid(jobid)
+        if self.jobs is None or jobid not in self.jobs:
+            return job_status(jobid)
+        return self.jobs[jobid]
+
+
 def is_traceable_date(jobdate):
     """
     Check if the job is traceable on the cluster
@@ -239,6 +354,21 @@ def get_specific_str(big_str, prefix, suffix):
         return ''
 
 
+def get_submitted_jobid(output, prefix, suffix):
+    """
+    Extract the job id from the output of cmd_submit
+
+    :param output: output of cmd_submit
+    :param prefix: prefix_jobid (printed before the job id)
+    :param suffix: suffix_jobid (printed after the job id)
+    :return: job id, empty string if not found
+    """
+    match = SGE_ARRAY_JOBID.search(output)
+    if match:
+        return match.group(1)
+    return get_specific_str(output, prefix, suffix)
+
+
 def command_found(cmd='qsub'):
     """ Return True if the command was found."""
     if True in [os.path.isfile(os.path.join(path, cmd)) and
@@ -322,16 +452,122 @@ class PBS(object):   # The script file generator class
         return submit_job(self.filename, outlog=outlog,
                           force_no_qsub=force_no_qsub)
 
+    def get_params(self):
+        """
+        Get the parameters of the job other than the commands/files
+
+        :return: dictionary of the keyword arguments of PBS
+        """
+        return {'walltime_str': self.walltime_str,
+                'mem_mb': self.mem_mb,
+                'ppn': self.ppn,
+                'env': self.env,
+                'email': self.email,
+                'email_options': self.email_options,
+                'xnat_host': self.xnat_host,
+                'job_template': self.job_template}
+
+
+class PBSArray(PBS):
+    """ PBS class to generate/submit a job array, one element per task """
+    def __init__(self, filename, outfile, elements, walltime_str, **kwargs):
+        """
+        Entry point for the PBSArray class
+
+        The script is generated once from the job template and runs the
+         script of the element (<index>.sh next to the script), writing the
+         outlog of the element.
+
+        :param filename: filename for the script
+        :param outfile: filepath for the outlogs of the array
+        :param elements: list of (label, outlog, cmds) for each element
+        :param walltime_str: walltime to set for the script
+        :param kwargs: other parameters of the PBS class (mem_mb, ppn, ...)
+        :return: None
+        """
+        self.elements = elements
+        self.array_dir = os.path.dirname(filename)
+        cmds = ['bash %s/%s.sh' % (self.array_dir, ARRAY_INDEX_VAR)]
+        super(PBSArray, self).__init__(filename, outfile, cmds, walltime_str,
+                                       **kwargs)
+
+    def write(self):
+        """
+        Write the script, the script of each element and the manifest
+         (index label)
+
+        :return: None
+        """
+        if not os.path.exists(self.array_dir):
+            os.makedirs(self.array_dir)
+        manifest = list()
+        for index, (label, outlog, cmds) in enumerate(self.elements, 1):
+            element_file = os.path.join(self.array_dir, '%d.sh' % index)
+            with open(element_file, 'w') as f_obj:
+                f_obj.write('#!/bin/bash\n')
+                f_obj.write('# %s\n' % label)
+                f_obj.write('mkdir -p %s\n' % os.path.dirname(outlog))
+                f_obj.write('exec > %s 2>&1\n' % outlog)
+                f_obj.write('\n'.join(cmds))
+                f_obj.write('\n')
+            manifest.append('%d %s\n' % (index, label))
+
+        with open(os.path.join(self.array_dir, ARRAY_MANIFEST), 'w') as f_obj:
+            f_obj.writelines(manifest)
+
+        super(PBSArray, self).write()
+
+    def submit(self, outlog=None, force_no_qsub=False):
+        """
+        Submit the job array to the cluster
+
+        :return: jobid of the array and False (see submit_job)
+        """
+        option = DAX_SETTINGS.get_job_array_option()\
+                             .safe_substitute({'array_size':
+                                               len(self.elements)})
+        return submit_job(self.filename, options=option)
+
+    def element_jobids(self, jobid):
+        """
+        Get the job id of each element of the array
+
+        :param jobid: job id of the array returned by submit
+        :return: list of the job ids in the order of the elements
+        """
+        jobid = jobid.replace('[]', '')
+        template = DAX_SETTINGS.get_job_array_jobid()
+        return [template.safe_substitute({'jobid': jobid, 'index': index})
+                for index in range(1, len(self.elements) + 1)]
+
+
+def job_array_enabled():
+    """
+    Check if the tasks can be submitted as job arrays (job_array_option set
+     and the submit command found)
 
-def submit_job(filename, outlog=None, force_no_qsub=False):
+    :return: True if job arrays can be submitted, False otherwise
+    """
+    return DAX_SETTINGS.get_job_array_option() is not None and \
+        command_found(cmd=DAX_SETTINGS.get_cmd_submit())
+
+
+def submit_job(filename, outlog=None, force_no_qsub=False, options=None):
     """
     Submit the file to the cluster
+
+    :param filename: batch file to submit
+    :param outlog: outlog file when running locally
+    :param force_no_qsub: run the job locally
+    :param options: options given to cmd_submit (e.g. job array)
     :return: jobid and error if the job failed when running locally
     """
     failed = False
     submit_cmd = DAX_SETTINGS.get_cmd_submit()
     if command_found(cmd=submit_cmd) and not force_no_qsub:
         try:
+            if options:
+                submit_cmd = '%s %s' % (submit_cmd, options)
             cmd = '%s %s' % (submit_cmd, filename)
             proc = sb.Popen(cmd.split(), stdout=sb.PIPE, stderr=sb.PIPE)
             output, error = proc.communicate()
@@ -339,8 +575,9 @@ def submit_job(filename, outlog=None, force_no_qsub=False):
                 LOGGER.info(output)
             if error:
                 LOGGER.error(error)
-            jobid = get_specific_str(output, DAX_SETTINGS.get_prefix_jobid(),
-                                     DAX_SETTINGS.get_suffix_jobid())
+            jobid = get_submitted_jobid(output,
+                                        DAX_SETTINGS.get_prefix_jobid(),
+                                        DAX_SETTINGS.get_suffix_jobid())
         except sb.CalledProcessError as err:
             LOGGER.error(err)
             jobid = '0'
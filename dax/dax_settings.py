@@ -428,6 +428,24 @@ class DAX_Settings(object):
             return ''
         return self.read_file_and_return_template(filepath)
 
+    def get_cmd_list_jobs(self):
+        """Get the cmd_list_jobs value from the cluster section.
+
+        NOTE: The command prints one line "jobid state" per job of the user,
+         or "jobid state task" with the index of the element of a job array
+         if the scheduler prints it apart (ja-task-ID column of SGE)
+
+        :return: String of the command, empty string if not set
+        """
+        filepath = self.get('cluster', 'cmd_list_jobs')
+        if filepath is None:
+            return ''
+        if filepath.startswith('~/'):
+            filepath = os.path.join(self.get_user_home(), filepath)
+        if not os.path.isfile(filepath):
+            return ''
+        return self.read_file_and_return_string(filepath)
+
     def get_queue_status(self):
         """Get the queue_status value from the cluster section.
 
@@ -510,6 +528,33 @@ class DAX_Settings(object):
         """
         return self.get('cluster', 'job_extension_file')
 
+    def get_job_array_option(self):
+        """Get the job_array_option value from the cluster section.
+
+        NOTE: option given to cmd_submit to submit a job array, using
+         ${array_size} for the number of elements
+         (e.g. --array=1-${array_size})
+
+        :return: Template class of the option, None if empty (no job array)
+        """
+        option = self.get('cluster', 'job_array_option')
+        if not option:
+            return None
+        return Template(option)
+
+    def get_job_array_jobid(self):
+        """Get the job_array_jobid value from the cluster section.
+
+        NOTE: job id of an element of a job array using ${jobid} and
+         ${index} (e.g. ${jobid}_${index} for slurm)
+
+        :return: Template class of the job id, ${jobid}_${index} if empty
+        """
+        jobid = self.get('cluster', 'job_array_jobid')
+        if not jobid:
+            jobid = '${jobid}_${index}'
+        return Template(jobid)
+
     def get_job_template(self, filepath=None):
         """Get the job_template value from the cluster section.
 
@@ -609,6 +654,62 @@ class DAX_Settings(object):
         """
         return self.get('cluster', 'upload_threads')
 
+    def get_upload_file_threads(self):
+        """
+        Get the number of files of a resource uploaded in parallel by
+         dax upload (large resources uploaded file by file)
+
+        :return: number of upload file threads, 1 if not set
+        """
+        if self.get('cluster', 'upload_file_threads'):
+            return int(self.get('cluster', 'upload_file_threads'))
+        else:
+            return 1
+
+    def get_build_threads(self):
+        """
+        Get the number of subjects built in parallel by dax build
+
+        :return: number of build threads, 1 if not set
+        """
+        if self.get('cluster', 'build_threads'):
+            return int(self.get('cluster', 'build_threads'))
+        else:
+            return 1
+
+    def get_prefetch_threads(self):
+        """
+        Get the number of sessions XML fetched in parallel by dax build
+
+        :return: number of prefetch threads, 1 if not set
+        """
+        if self.get('cluster', 'prefetch_threads'):
+            return int(self.get('cluster', 'prefetch_threads'))
+        else:
+            return 1
+
+    def get_update_threads(self):
+        """
+        Get the number of tasks updated in parallel by dax update
+
+        :return: number of update threads, 1 if not set
+        """
+        if self.get('cluster', 'update_threads'):
+            return int(self.get('cluster', 'update_threads'))
+        else:
+            return 1
+
+    def get_diskq_backend(self):
+        """
+        Get the backend used to store the DISKQ tasks attributes
+
+        :return: files or sqlite, files if not set
+        """
+        if self.get('cluster', 'diskq_backend'):
+            return self.get('cluster', 'diskq_backend').strip().lower()
+        else:
+            return 'files'
+
     def get_api_url(self):
         """Get the api_url value from the dax_manager section.
 
@@ -635,6 +736,19 @@ class DAX_Settings(object):
         else:
             return False
 
+    def get_use_listing_cache(self):
+        """
+        Get use_listing_cache from the cluster
+
+        :return: True or False
+        """
+        _ulc = self.get('cluster', 'use_listing_cache')
+        if _ulc and (_ulc.lower().startswith('y') or
+                     _ulc.lower().startswith('t')):
+            return True
+        else:
+            return False
+
     def get_reference_dir(self):
         """Get the reference_dir value from the cluster section.
 
@@ -642,6 +756,26 @@ class DAX_Settings(object):
         """
         return self.get('cluster', 'reference_dir')
 
+    def get_reference_mounts(self):
+        """Get the mounts shared with the XNAT server.
+
+        NOTE: reference_mounts is a comma separated list of local=server
+         paths of the same storage on the station and on the XNAT server.
+         The results_dir=reference_dir pair is added if reference_dir is set.
+
+        :return: list of (local path, server path)
+        """
+        mounts = list()
+        value = self.get('cluster', 'reference_mounts')
+        if value:
+            for mount in value.split(','):
+                if '=' in mount:
+                    local, server = mount.split('=', 1)
+                    mounts.append((local.strip(), server.strip()))
+        if self.get_reference_dir():
+            mounts.append((self.get_results_dir(), self.get_reference_dir()))
+        return mounts
+
     @staticmethod
     def read_file_and_return_template(filepath):
         """Reads a a file and returns the string as a string Template.
@@ -44,6 +44,7 @@ else:
     import configparser
 
 from multiprocessing import Pool
+from multiprocessing import util as mp_util
 
 from . import bin
 from . import launcher
@@ -100,6 +101,7 @@ CLUSTER_DEFAULTS = OrderedDict([
     ('suffix_jobid', ''),
     ('cmd_count_nb_jobs', ''),
     ('cmd_get_job_status', ''),
+    ('cmd_list_jobs', ''),
     ('queue_status', ''),
     ('running_status', ''),
     ('complete_status', ''),
@@ -108,6 +110,8 @@ CLUSTER_DEFAULTS = OrderedDict([
     ('cmd_get_job_node', ''),
     ('job_extension_file', '.pbs'),
     ('job_template', ''),
+    ('job_array_option', ''),
+    ('job_array_jobid', ''),
     ('email_opts', 'a'),
     ('gateway', socket.gethostname()),
     ('root_job_dir', '/tmp'),
@@ -116,7 +120,14 @@ CLUSTER_DEFAULTS = OrderedDict([
                                  'RESULTS_XNAT_SPIDER')),
     ('max_age', '14'),
     ('launcher_type', 'xnatq-combined'),
-    ('skip_lastupdate', '')])
+    ('skip_lastupdate', ''),
+    ('use_listing_cache', 'false'),
+    ('build_threads', '1'),
+    ('prefetch_threads', '4'),
+    ('update_threads', '1'),
+    ('upload_file_threads', '4'),
+    ('reference_mounts', ''),
+    ('diskq_backend', 'files')])
 
 CODE_PATH_DEFAULTS = OrderedDict([
     ('processors_path', ''),
@@ -205,6 +216,9 @@ containing the command used to count the number of jobs in the queue: ',
     'cmd_get_job_status': {'msg': 'Please enter the full path to text file \
 containing the command used to check the running status of a job: ',
                            'is_path': True},
+    'cmd_list_jobs': {'msg': 'Please enter the full path to text file \
+containing the command used to list the jobs of the user with their status \
+(one "jobid status" per line): ', 'is_path': True},
     'queue_status': {'msg': 'Please enter the string the job scheduler would \
 use to indicate that a job is "in the queue": ', 'is_path': False},
     'running_status': {'msg': 'Please enter the string the job scheduler \
@@ -225,6 +239,11 @@ batch file: ', 'is_path': False},
     'job_template': {'msg': 'Please enter the full path to the text file \
 containing the template used to generate the batch script: ',
                      'is_path': True},
+    'job_array_option': {'msg': 'Please enter the option to submit a job \
+array with ${array_size} elements (empty to submit one job per task): ',
+                         'is_path': False},
+    'job_array_jobid': {'msg': 'Please enter the job id of the element \
+${index} of the job array ${jobid}: ', 'is_path': False},
     'email_opts': {'msg': 'Please provide the options for the email \
 notification for a job as defined by your grid scheduler: ', 'is_path': False},
     'gateway': {'msg': 'Please enter the hostname of the server \
@@ -282,17 +301,22 @@ ${job_cmds}\n"""
 DEFAULT_SGE_DICT = {'cmd_submit': 'qsub',
                     'prefix_jobid': 'Your job ',
                     'suffix_jobid': '("',
-                    'cmd_count_nb_jobs': 'expr `qstat -u $USER | wc -l` - 2\n',
+                    'cmd_count_nb_jobs': 'expr `qstat -g d -u $USER | wc -l` - 2\n',
                     'queue_status': 'qw',
                     'running_status': 'r',
                     'complete_status': '',
                     'cmd_get_job_memory': "echo ''\n",
                     'cmd_get_job_node': "echo ''\n",
-                    'cmd_get_job_status': "qstat -u $USER | grep ${jobid} \
-| awk {'print $5'}\n",
+                    'cmd_get_job_status': """qstat -g d -u $USER \
+| tail -n +3 | awk '{t = ($8 ~ /@/) ? $10 : $9; \
+if ($1 == "${jobid}" || $1 "." t == "${jobid}") print $5}'\n""",
+                    'cmd_list_jobs': """qstat -g d -u $USER | tail -n +3 \
+| awk '{if ($8 ~ /@/) print $1, $5, $10; else print $1, $5, $9}'\n""",
                     'cmd_get_job_walltime': "echo ''\n",
                     'job_extension_file': '.pbs',
                     'job_template': SGE_TEMPLATE,
+                    'job_array_option': '-t 1-${array_size}',
+                    'job_array_jobid': '${jobid}.${index}',
                     'email_opts': 'a'}
 
 SLURM_TEMPLATE = """#!/bin/bash
@@ -321,7 +345,7 @@ ${job_cmds}\n"""
 DEFAULT_SLURM_DICT = {'cmd_submit': 'sbatch',
                       'prefix_jobid': 'Submitted batch job ',
                       'suffix_jobid': '\n',
-                      'cmd_count_nb_jobs': 'squeue -u masispider,vuiiscci \
+                      'cmd_count_nb_jobs': 'squeue -r -u masispider,vuiiscci \
 --noheader | wc -l\n',
                       'queue_status': 'Q',
                       'running_status': 'R',
@@ -333,10 +357,14 @@ MaxRss --noheader | awk '{print $1+0}'\n",
 NodeList --noheader\n',
                       'cmd_get_job_status': 'slurm_load_jobs error: Invalid \
 job id specified\n',
+                      'cmd_list_jobs': "squeue -r -u $USER --noheader \
+-o '%i %t'\n",
                       'cmd_get_job_walltime': 'sacct -j ${jobid}.batch \
 --format CPUTime --noheader\n',
                       'job_extension_file': '.slurm',
                       'job_template': SLURM_TEMPLATE,
+                      'job_array_option': '--array=1-${array_size}',
+                      'job_array_jobid': '${jobid}_${index}',
                       'email_opts': 'FAIL'}
 
 MOAB_TEMPLATE = """#!/bin/bash
@@ -366,7 +394,7 @@ DEFAULT_MOAB_DICT = {
     'cmd_submit': 'qsub',
     'prefix_jobid': '',
     'suffix_jobid': '.',
-    'cmd_count_nb_jobs': 'qstat | grep $USER | wc -l\n',
+    'cmd_count_nb_jobs': 'qstat -t | grep $USER | wc -l\n',
     'queue_status': 'Q',
     'running_status': 'R',
     'complete_status': 'C',
@@ -376,11 +404,15 @@ ${jobid}'2> /dev/null | awk -v FS='(resources_used.mem=|kb)' '{print $2}' \
     'cmd_get_job_node': "echo ''\n",
     'cmd_get_job_status': "qstat -f ${jobid} | grep job_state \
 | awk {'print $3'}\n",
+    'cmd_list_jobs': "qstat -t -u $USER | tail -n +6 \
+| awk {'print $1, $10'}\n",
     'cmd_get_job_walltime': "rsh vmpsched 'tracejob -n ${numberofdays} \
 ${jobid}' 2> /dev/null | awk -v FS='(resources_used.walltime=|\n)' \
 '{print $2}' | sort -u | tail -1\n",
     'job_extension_file': '.pbs',
     'job_template': MOAB_TEMPLATE,
+    'job_array_option': '-t 1-${array_size}',
+    'job_array_jobid': '${jobid}[${index}]',
     'email_opts': 'a'}
 
 # Variables for upload
@@ -406,6 +438,10 @@ FLAGFILE_TEMPLATE = os.path.join(RESULTS_DIR, _FLAG_FILES,
                                  'Process_Upload_running')
 SNAPSHOTS_ORIGINAL = 'snapshot_original.png'
 SNAPSHOTS_PREVIEW = 'snapshot_preview.png'
+# Resources larger than this are uploaded file by file instead of zipped
+STREAM_UPLOAD_MIN_SIZE = 512 * 1024 * 1024
+# Reference mounts not seen by XNAT (upload by reference failed)
+REFERENCE_MOUNTS_FAILED = set()
 DEFAULT_HEADER = ['host', 'username', 'password', 'projects']
 
 # Cmd:
@@ -1103,12 +1139,17 @@ def upload_resource(assessor_obj, resource, resource_path):
         rfiles_list = os.listdir(resource_path)
         if not rfiles_list:
             LOGGER.warn('No files in {}'.format(resource_path))
-        elif DAX_SETTINGS.get_use_reference():
-            try:
-                ref_path = get_reference_path(resource_path)
-                XnatUtils.upload_reference(ref_path, assessor_obj, resource)
-            except XnatUtilsError as err:
-                raise err
+        elif upload_resource_by_reference(assessor_obj, resource,
+                                          resource_path):
+            pass
+        elif is_stream_upload(resource_path):
+            status = XnatUtils.upload_folder_files_to_obj(
+                resource_path, assessor_obj.out_resource(resource),
+                removeall=True,
+                nb_threads=DAX_SETTINGS.get_upload_file_threads())
+            if not status:
+                err = 'failed to upload all the files of %s'
+                raise XnatUtilsError(err % resource_path)
         elif len(rfiles_list) > 1 or os.path.isdir(rfiles_list[0]):
             try:
                 XnatUtils.upload_folder_to_obj(
@@ -1125,10 +1166,95 @@ def upload_resource(assessor_obj, resource, resource_path):
             except XnatUtilsError as err:
                 print(ERR_MSG % err)
 
+def is_stream_upload(resource_path):
+    """
+    Check if a resource folder is uploaded file by file (large folder or
+     upload interrupted) instead of zipped
+
+    :param resource_path: resource path on the station
+    :return: True if the folder needs to be uploaded file by file
+    """
+    progress_path = os.path.join(resource_path,
+                                 XnatUtils.UPLOAD_PROGRESS_FILENAME)
+    if os.path.isfile(progress_path):
+        return True
+    return XnatUtils.get_folder_size(resource_path) >= STREAM_UPLOAD_MIN_SIZE
+
+
+def get_mount_point(path):
+    """
+    Get the mount point of a path
+
+    :param path: path on the station
+    :return: mount point containing the path
+    """
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
 def get_reference_path(resource_path):
-    return resource_path.replace(
-        DAX_SETTINGS.get_results_dir(),
-        DAX_SETTINGS.get_reference_dir())
+    """
+    Get the path of a resource folder as seen by the XNAT server, using the
+     longest matching local path of the reference mounts
+
+    :param resource_path: resource path on the station
+    :return: path on the XNAT server, None if not on a shared mount
+    """
+    matches = [(local, server) for local, server
+               in DAX_SETTINGS.get_reference_mounts()
+               if resource_path == local or
+               resource_path.startswith(local.rstrip('/') + '/')]
+    if not matches:
+        return None
+    local, server = max(matches, key=lambda mount: len(mount[0]))
+    return server.rstrip('/') + resource_path[len(local.rstrip('/')):]
+
+
+def upload_resource_by_reference(assessor_obj, resource, resource_path):
+    """
+    Upload a resource folder by reference if it is on a mount shared with
+     the XNAT server, and check the files count and size in the catalog.
+
+    With use_reference, a failure raises an error. Otherwise the mount is
+     not used anymore by this process and the files are uploaded.
+
+    :param assessor_obj: pyxnat assessor Eobject
+    :param resource: resource to upload
+    :param resource_path: resource path on the station
+    :return: True if uploaded by reference, False otherwise
+    """
+    ref_path = get_reference_path(resource_path)
+    if ref_path is None:
+        if DAX_SETTINGS.get_use_reference():
+            err = 'no reference mount for %s'
+            raise XnatUtilsError(err % resource_path)
+        return False
+
+    mount = get_mount_point(resource_path)
+    if mount in REFERENCE_MOUNTS_FAILED:
+        return False
+
+    try:
+        XnatUtils.upload_reference(ref_path, assessor_obj, resource)
+        verified = XnatUtils.check_reference_upload(
+            resource_path, assessor_obj.out_resource(resource))
+    except XnatUtilsError as err:
+        LOGGER.warn('upload by reference failed for %s: %s'
+                    % (resource_path, err))
+        verified = False
+
+    if not verified:
+        if DAX_SETTINGS.get_use_reference():
+            err = 'upload by reference not verified for %s'
+            raise XnatUtilsError(err % resource_path)
+        LOGGER.warn('mount %s not seen by XNAT, uploading the files' % mount)
+        REFERENCE_MOUNTS_FAILED.add(mount)
+        return False
+
+    LOGGER.debug('    +uploaded %s by reference: %s' % (resource, ref_path))
+    return True
 
 def upload_snapshots(assessor_obj, resource_path):
     """
@@ -1169,60 +1295,142 @@ def upload_assessors(xnat, projects):
     """
     Upload all assessors to XNAT
 
+    The assessors are uploaded by upload_threads worker processes, each
+     with its own connection to XNAT. The result of each upload is
+     collected by the main process.
+
     :param xnat: pyxnat.Interface object
     :param projects: list of projects to upload to XNAT
-    :return: None
+    :return: list of warnings for the assessors not uploaded
     """
     # Get the assessor label from the directory :
     assessors_list = get_assessor_list(projects)
     number_of_processes = len(assessors_list)
     warnings = list()
+    if not assessors_list:
+        return warnings
+
+    num_threads = min(int(DAX_SETTINGS.get_upload_threads() or 1),
+                      number_of_processes)
+    upload_args = [(index, assessor_label, number_of_processes)
+                   for index, assessor_label in enumerate(assessors_list)]
+
+    if num_threads <= 1:
+        results = [upload_thread(*args, xnat=xnat) for args in upload_args]
+    else:
+        LOGGER.info('Starting pool with: %d processes' % num_threads)
+        pool = Pool(processes=num_threads, initializer=init_upload_worker,
+                    initargs=(xnat.host, xnat.user, xnat.pwd))
+        try:
+            async_results = [pool.apply_async(upload_thread, args)
+                             for args in upload_args]
+            pool.close()
+            results = list()
+            for args, async_result in zip(upload_args, async_results):
+                try:
+                    results.append(async_result.get())
+                except Exception as E:
+                    results.append((args[1], None, str(E)))
+        except BaseException:
+            # Kill the workers: their connections are not closed
+            pool.terminate()
+            raise
+        finally:
+            # Workers exiting normally run their Finalize (disconnect)
+            pool.join()
+
+    nb_errors = 0
+    for assessor_label, warning, error in results:
+        if warning:
+            warnings.append(warning)
+        if error:
+            nb_errors += 1
+            LOGGER.error('failed to upload %s: %s' % (assessor_label, error))
+            mess = """    - Assessor label : {label} (error: {error})\n"""
+            warnings.append(mess.format(label=assessor_label, error=error))
+
+    LOGGER.info('%d assessors processed, %d not uploaded, %d errors'
+                % (len(results), len(warnings), nb_errors))
+    return warnings
 
-    num_threads = int(DAX_SETTINGS.get_upload_threads())
 
-    print('Starting pool with: ' + str(num_threads) + ' threads')
-    sys.stdout.flush()
+# Connection to XNAT of an upload worker process (see init_upload_worker)
+UPLOAD_WORKER = dict()
 
-    pool = Pool(processes=num_threads) 
-    for index, assessor_label in enumerate(assessors_list):
-        print(index)
-        sys.stdout.flush()
 
-        pool.apply_async(upload_thread,[xnat, index, assessor_label, number_of_processes])
-    
-    print('Waiting for pool to finish...')
-    sys.stdout.flush()
+def init_upload_worker(host, user, pwd):
+    """
+    Open the connection to XNAT of an upload worker process, closed when
+     the process exits
 
-    pool.close()
-    pool.join()
+    :param host: XNAT host
+    :param user: XNAT user
+    :param pwd: XNAT password
+    :return: None
+    """
+    intf = XnatUtils.get_interface(host, user, pwd)
+    UPLOAD_WORKER['intf'] = intf
+    mp_util.Finalize(None, intf.disconnect, exitpriority=10)
 
-    print('Pool finished')
-    sys.stdout.flush()    
 
-    return warnings
+def upload_thread(index, assessor_label, number_of_processes, xnat=None):
+    """
+    Upload one assessor folder
 
-def upload_thread(xnat, index, assessor_label, number_of_processes):
+    :param index: index of the assessor in the list
+    :param assessor_label: label of the assessor (folder in RESULTS_DIR)
+    :param number_of_processes: number of assessors to upload
+    :param xnat: pyxnat.Interface object, connection of the worker if None
+    :return: tuple (assessor_label, warning, error), warning/error are None
+     if the assessor was uploaded
+    """
+    if xnat is None:
+        xnat = UPLOAD_WORKER['intf']
     assessor_path = os.path.join(RESULTS_DIR, assessor_label)
     msg = "    *Process: %s/%s -- label: %s / time: %s"
     LOGGER.info(msg % (str(index + 1), str(number_of_processes),
                        assessor_label, str(datetime.now())))
 
-    #assessor_dict = get_assessor_dict(assessor_label, assessor_path)
     assessor_dict = assessor_utils.parse_full_assessor_name(assessor_label)
-    if assessor_dict:
-        uploaded = upload_assessor(xnat, assessor_dict, assessor_path)
-        if not uploaded:
-            mess = """    - Assessor label : {label}\n"""
-            warnings.append(mess.format(label=assessor_dict['label']))
-    else:
+    if not assessor_dict:
         LOGGER.warn('     --> wrong label')
+        return assessor_label, None, None
 
-def upload_pbs(xnat, projects):
+    try:
+        uploaded = upload_assessor(xnat, assessor_dict, assessor_path)
+    except Exception as E:
+        LOGGER.critical(traceback.format_exc())
+        return assessor_label, None, '%s: %s' % (E.__class__.__name__, E)
+
+    if not uploaded:
+        mess = """    - Assessor label : {label}\n"""
+        return assessor_label, mess.format(label=assessor_dict['label']), None
+    return assessor_label, None, None
+
+
+def assessor_exists(assessor_obj, assessor_dict, context=None):
+    """
+    Check if the assessor exists on XNAT, using the project listing of the
+     context if given instead of one request per assessor
+
+    :param assessor_obj: pyxnat assessor Eobject
+    :param assessor_dict: assessor dictionary
+    :param context: XnatUtils.ProjectListingContext for this upload
+    :return: True if the assessor exists, False otherwise
+    """
+    if context is None:
+        return assessor_obj.exists()
+    return context.get_assessor(assessor_dict['project_id'],
+                                assessor_dict['label']) is not None
+
+
+def upload_pbs(xnat, projects, context=None):
     """
     Upload all pbs files to XNAT
 
     :param xnat: pyxnat.Interface object
     :param projects: list of projects to upload to XNAT
+    :param context: XnatUtils.ProjectListingContext for this upload
     :return: None
     """
     pbs_list = get_pbs_list(projects)
@@ -1241,7 +1449,7 @@ def upload_pbs(xnat, projects):
             os.rename(pbs_fpath, os.path.join(RESULTS_DIR, _TRASH, pbsfile))
         else:
             assessor_obj = select_assessor(xnat, assessor_dict)
-            if not assessor_obj.exists():
+            if not assessor_exists(assessor_obj, assessor_dict, context):
                 LOGGER.warn('assessor does not exist for %s' % (pbsfile))
                 new_location = os.path.join(RESULTS_DIR, _TRASH, pbsfile)
                 os.rename(pbs_fpath, new_location)
@@ -1274,12 +1482,13 @@ def upload_pbs(xnat, projects):
                         os.remove(pbs_fpath)
 
 
-def upload_outlog(xnat, projects):
+def upload_outlog(xnat, projects, context=None):
     """
     Upload all outlog files to XNAT
 
     :param xnat: pyxnat.Interface object
     :param projects: list of projects to upload to XNAT
+    :param context: XnatUtils.ProjectListingContext for this upload
     :return: None
     """
     outlogs_list = os.listdir(os.path.join(RESULTS_DIR, _OUTLOG))
@@ -1302,13 +1511,20 @@ def upload_outlog(xnat, projects):
         else:
             assessor_obj = select_assessor(xnat, assessor_dict)
             #xtp = get_xsitype(assessor_dict)
-            if not assessor_obj.exists():
+            if not assessor_exists(assessor_obj, assessor_dict, context):
                 msg = '     no assessor on XNAT -- moving file to trash.'
                 LOGGER.warn(msg)
                 new_location = os.path.join(RESULTS_DIR, _TRASH, outlogfile)
                 os.rename(outlog_fpath, new_location)
             else:
-                if assessor_obj.attrs.get(assessor_obj.datatype() + '/procstatus') == JOB_FAILED:
+                if context:
+                    procstatus = context.get_assessor(
+                        assessor_dict['project_id'],
+                        assessor_dict['label'])['procstatus']
+                else:
+                    procstatus = assessor_obj.attrs.get(
+                        assessor_obj.datatype() + '/procstatus')
+                if procstatus == JOB_FAILED:
                     resource_obj = assessor_obj.out_resource(_OUTLOG)
                     if resource_obj.exists():
                         pass
@@ -1433,14 +1649,17 @@ def upload_results(upload_settings, emailaddress):
 
                 warnings.extend(upload_assessors(intf, upload_dict['projects']))
 
-                # 2) Upload the PBS files
-                # For each file, upload it to the PBS resource
-                LOGGER.info('Uploading PBS files ...')
-                upload_pbs(intf, upload_dict['projects'])
-
-                # 3) Upload the OUTLOG files not uploaded with processes
-                LOGGER.info('Checking OUTLOG files for JOB_FAILED jobs ...')
-                upload_outlog(intf, upload_dict['projects'])
+                # Assessors listings are read once per project after the
+                # assessors upload for the PBS/OUTLOG checks
+                with XnatUtils.ProjectListingContext(intf) as context:
+                    # 2) Upload the PBS files
+                    # For each file, upload it to the PBS resource
+                    LOGGER.info('Uploading PBS files ...')
+                    upload_pbs(intf, upload_dict['projects'], context)
+
+                    # 3) Upload the OUTLOG files not uploaded with processes
+                    LOGGER.info('Checking OUTLOG files for JOB_FAILED jobs ...')
+                    upload_outlog(intf, upload_dict['projects'], context)
         except DaxNetrcError as e:
             msg = e.msg
             LOGGER.error(e.msg)
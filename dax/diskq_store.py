@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" diskq_store.py
+
+Storage of the attributes of the DISKQ tasks (procstatus, jobid, memused...).
+
+Two backends are available (see cluster/diskq_backend in the settings):
+
+files: the historical layout, one small file per attribute and per task
+       under DISKQ/<attr>/<label>. A task is in the queue when its batch file
+       exists in DISKQ/BATCH. The tasks are indexed by procstatus and project
+       with empty files DISKQ/INDEX/<status|project>/<value>/<label>.
+sqlite: one SQLite database DISKQ/diskq.db with a row per task, indexed by
+        procstatus and project. A task is in the queue when it was added to
+        the database (done when the batch file is written).
+
+Use migrate_diskq() (dax diskq_migrate) to copy an existing DISKQ from the
+files layout to the SQLite database.
+"""
+
+from builtins import str
+from builtins import object
+
+import logging
+import os
+import sqlite3
+import threading
+
+from .dax_settings import DAX_Settings
+from .errors import DiskqError
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+__all__ = ['FileDiskqStore', 'SqliteDiskqStore', 'get_store',
+           'migrate_diskq']
+DAX_SETTINGS = DAX_Settings()
+LOGGER = logging.getLogger('dax')
+
+DISKQ_ATTRS = ['procstatus', 'jobid', 'jobnode', 'memused', 'walltimeused',
+               'jobstartdate']
+JOB_EXTENSION_FILE = DAX_SETTINGS.get_job_extension_file()
+BATCH_DIRNAME = 'BATCH'
+INDEX_DIRNAME = 'INDEX'
+INDEX_COMPLETE_FLAG = 'INDEX_COMPLETE.txt'
+# index key of the tasks without procstatus
+UNSET_STATUS = '_UNSET'
+DISKQ_DB_FILENAME = 'diskq.db'
+SQLITE_TIMEOUT = 60
+TASK_SCHEMA = '''CREATE TABLE IF NOT EXISTS task (
+    label TEXT PRIMARY KEY,
+    project TEXT,
+    %s)''' % ',\n    '.join('%s TEXT' % attr for attr in DISKQ_ATTRS)
+TASK_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS task_procstatus ON task (procstatus)',
+    'CREATE INDEX IF NOT EXISTS task_project ON task (project)']
+
+_STORES = dict()
+_STORES_LOCK = threading.Lock()
+
+
+def label_project(label):
+    """
+    Get the project of a task from its assessor label
+
+    :param label: assessor label (proj-x-subj-x-sess-x-...)
+    :return: project ID
+    """
+    return label.split('-x-')[0]
+
+
+def check_attrs(names):
+    """
+    Check that the attributes are DISKQ attributes
+
+    :param names: list of attribute names
+    :raises: DiskqError if one of the attributes is not supported
+    :return: None
+    """
+    for name in names:
+        if name not in DISKQ_ATTRS:
+            raise DiskqError('unknown task attribute: %s' % name)
+
+
+class FileDiskqStore(object):
+    """ DISKQ attributes stored as one file per attribute and task """
+    def __init__(self, diskq):
+        """
+        Entry point for the FileDiskqStore class
+
+        :param diskq: path to the DISKQ directory
+        :return: None
+        """
+        self.diskq = diskq
+
+    def attr_path(self, label, name):
+        return os.path.join(self.diskq, name, label)
+
+    def batch_path(self, label):
+        return os.path.join(self.diskq, BATCH_DIRNAME,
+                            '%s%s' % (label, JOB_EXTENSION_FILE))
+
+    def index_dir(self, kind, key):
+        return os.path.join(self.diskq, INDEX_DIRNAME, kind, key or UNSET_STATUS)
+
+    def index_add(self, kind, key, label):
+        """
+        Add a task to the index kind (status/project) for the value key
+
+        :param kind: status or project
+        :param key: value of the status/project
+        :param label: assessor label of the task
+        :return: None
+        """
+        index_dir = self.index_dir(kind, key)
+        if not os.path.isdir(index_dir):
+            try:
+                os.makedirs(index_dir)
+            except OSError:
+                if not os.path.isdir(index_dir):
+                    raise
+        open(os.path.join(index_dir, label), 'w').close()
+
+    def index_remove(self, kind, key, label):
+        """
+        Remove a task from the index kind (status/project) for the value key
+
+        :param kind: status or project
+        :param key: value of the status/project
+        :param label: assessor label of the task
+        :return: None
+        """
+        try:
+            os.remove(os.path.join(self.index_dir(kind, key), label))
+        except OSError:
+            pass
+
+    def index_list(self, kind, key):
+        """
+        List the tasks of the index kind (status/project) for the value key
+
+        :param kind: status or project
+        :param key: value of the status/project
+        :return: set of assessor labels
+        """
+        index_dir = self.index_dir(kind, key)
+        if not os.path.isdir(index_dir):
+            return set()
+        return set(os.listdir(index_dir))
+
+    def check_index(self):
+        """
+        Build the status/project indexes from the batch files if they were
+         never built (DISKQ created before the indexes)
+
+        :return: None
+        """
+        flag = os.path.join(self.diskq, INDEX_DIRNAME, INDEX_COMPLETE_FLAG)
+        if os.path.exists(flag):
+            return
+
+        LOGGER.info('indexing DISKQ tasks in %s' % self.diskq)
+        for batch_file in os.listdir(os.path.join(self.diskq, BATCH_DIRNAME)):
+            label = os.path.splitext(batch_file)[0]
+            self.index_add('project', label_project(label), label)
+            self.index_add('status', self.get(label, 'procstatus'), label)
+        open(flag, 'w').close()
+
+    def add(self, label):
+        """
+        Add a task to the queue (the batch file is the task) and index it
+
+        :param label: assessor label of the task
+        :return: None
+        """
+        self.index_add('project', label_project(label), label)
+        self.index_add('status', self.get(label, 'procstatus'), label)
+
+    def get(self, label, name):
+        """
+        Get an attribute of a task
+
+        :param label: assessor label of the task
+        :param name: name of the attribute
+        :return: value of the attribute, None if not set
+        """
+        apath = self.attr_path(label, name)
+
+        if not os.path.exists(apath):
+            return None
+
+        with open(apath, 'r') as f:
+            return f.read().strip()
+
+    def mget(self, label, names):
+        """
+        Get several attributes of a task
+
+        :param label: assessor label of the task
+        :param names: list of attribute names
+        :return: dictionary name -> value (None if not set)
+        """
+        return dict((name, self.get(label, name)) for name in names)
+
+    def set(self, label, name, value):
+        """
+        Set an attribute of a task
+
+        :param label: assessor label of the task
+        :param name: name of the attribute
+        :param value: value of the attribute
+        :return: None
+        """
+        self.mset(label, {name: value})
+
+    def mset(self, label, attrs):
+        """
+        Set several attributes of a task.
+
+        Each file is written to a temporary file and renamed so readers never
+        see a partial value.
+
+        :param label: assessor label of the task
+        :param attrs: dictionary name -> value
+        :return: None
+        """
+        old_status = None
+        if 'procstatus' in attrs:
+            old_status = self.get(label, 'procstatus')
+
+        for name, value in list(attrs.items()):
+            attr_path = self.attr_path(label, name)
+            attr_dir = os.path.dirname(attr_path)
+            if not os.path.isdir(attr_dir):
+                try:
+                    os.makedirs(attr_dir)
+                except OSError:
+                    if not os.path.isdir(attr_dir):
+                        raise
+            tmp_path = '%s.tmp%d' % (attr_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(str(value) + '\n')
+            os.rename(tmp_path, attr_path)
+
+        if 'procstatus' in attrs:
+            new_status = str(attrs['procstatus']).strip()
+            if new_status != old_status:
+                self.index_remove('status', old_status, label)
+            self.index_add('status', new_status, label)
+
+    def delete(self, label, names=None):
+        """
+        Delete attributes of a task
+
+        :param label: assessor label of the task
+        :param names: list of attribute names, all if None
+        :return: None
+        """
+        if names is None or 'procstatus' in names:
+            self.index_remove('status', self.get(label, 'procstatus'), label)
+            if names is None:
+                self.index_remove('project', label_project(label), label)
+            else:
+                self.index_add('status', None, label)
+
+        for name in names or DISKQ_ATTRS:
+            try:
+                os.remove(self.attr_path(label, name))
+            except OSError:
+                pass
+
+    def list_tasks(self, status=None, projects=None, default_status=None):
+        """
+        List the tasks in the queue using the status/project indexes
+
+        :param status: procstatus of the tasks, all if None
+        :param projects: list of projects of the tasks, all if None
+        :param default_status: status of the tasks without procstatus
+        :return: list of assessor labels
+        """
+        if not status and not projects:
+            return [os.path.splitext(batch_file)[0] for batch_file
+                    in os.listdir(os.path.join(self.diskq, BATCH_DIRNAME))]
+
+        self.check_index()
+        labels = None
+        index_keys = list()
+        if status:
+            index_keys.append(('status', status))
+            if status == default_status:
+                index_keys.append(('status', None))
+            labels = set()
+            for kind, key in index_keys:
+                labels.update(self.index_list(kind, key))
+        if projects:
+            proj_labels = set()
+            for project in projects:
+                index_keys.append(('project', project))
+                proj_labels.update(self.index_list('project', project))
+            if labels is None:
+                labels = proj_labels
+            else:
+                labels.intersection_update(proj_labels)
+
+        # Drop the entries of the tasks deleted without the store
+        task_labels = list()
+        for label in sorted(labels):
+            if os.path.exists(self.batch_path(label)):
+                task_labels.append(label)
+            else:
+                LOGGER.debug('removing deleted task from index:' + label)
+                for kind, key in index_keys:
+                    self.index_remove(kind, key, label)
+        return task_labels
+
+
+class SqliteDiskqStore(object):
+    """ DISKQ attributes stored in a SQLite database indexed by status """
+    def __init__(self, diskq, db_path=None):
+        """
+        Entry point for the SqliteDiskqStore class
+
+        :param diskq: path to the DISKQ directory
+        :param db_path: path to the database, default to DISKQ/diskq.db
+        :return: None
+        """
+        self.diskq = diskq
+        if not db_path:
+            db_path = os.path.join(diskq, DISKQ_DB_FILENAME)
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute(TASK_SCHEMA)
+            for index in TASK_INDEXES:
+                conn.execute(index)
+
+    def _connect(self):
+        """
+        Open a new connection to the database (one per call so the store
+        can be shared between threads and processes)
+
+        :return: sqlite3.Connection
+        """
+        return sqlite3.connect(self.db_path, timeout=SQLITE_TIMEOUT)
+
+    def add(self, label):
+        """
+        Add a task to the queue
+
+        :param label: assessor label of the task
+        :return: None
+        """
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO task (label, project) '
+                         'VALUES (?, ?)', (label, label_project(label)))
+
+    def get(self, label, name):
+        """
+        Get an attribute of a task
+
+        :param label: assessor label of the task
+        :param name: name of the attribute
+        :return: value of the attribute, None if not set
+        """
+        return self.mget(label, [name])[name]
+
+    def mget(self, label, names):
+        """
+        Get several attributes of a task with one query
+
+        :param label: assessor label of the task
+        :param names: list of attribute names
+        :return: dictionary name -> value (None if not set)
+        """
+        check_attrs(names)
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                'SELECT %s FROM task WHERE label=?' % ', '.join(names),
+                (label,)).fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            return dict((name, None) for name in names)
+        return dict(zip(names, row))
+
+    def set(self, label, name, value):
+        """
+        Set an attribute of a task
+
+        :param label: assessor label of the task
+        :param name: name of the attribute
+        :param value: value of the attribute
+        :return: None
+        """
+        self.mset(label, {name: value})
+
+    def mset(self, label, attrs):
+        """
+        Set several attributes of a task in a single transaction
+
+        :param label: assessor label of the task
+        :param attrs: dictionary name -> value
+        :return: None
+        """
+        names = list(attrs.keys())
+        check_attrs(names)
+        values = [str(attrs[name]).strip() for name in names]
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO task (label, project) '
+                         'VALUES (?, ?)', (label, label_project(label)))
+            conn.execute(
+                'UPDATE task SET %s WHERE label=?'
+                % ', '.join('%s=?' % name for name in names),
+                values + [label])
+
+    def delete(self, label, names=None):
+        """
+        Delete attributes of a task, or the task if names is None
+
+        :param label: assessor label of the task
+        :param names: list of attribute names, all if None
+        :return: None
+        """
+        with self._connect() as conn:
+            if names is None:
+                conn.execute('DELETE FROM task WHERE label=?', (label,))
+            else:
+                check_attrs(names)
+                conn.execute(
+                    'UPDATE task SET %s WHERE label=?'
+                    % ', '.join('%s=NULL' % name for name in names),
+                    (label,))
+
+    def list_tasks(self, status=None, projects=None, default_status=None):
+        """
+        List the tasks in the queue with the status/project indexes
+
+        :param status: procstatus of the tasks, all if None
+        :param projects: list of projects of the tasks, all if None
+        :param default_status: status of the tasks without procstatus
+        :return: list of assessor labels
+        """
+        clauses = list()
+        values = list()
+        if status:
+            if status == default_status:
+                clauses.append("(procstatus=? OR procstatus IS NULL OR "
+                               "procstatus='')")
+            else:
+                clauses.append('procstatus=?')
+            values.append(status)
+        if projects:
+            clauses.append('project IN (%s)'
+                           % ', '.join('?' for _ in projects))
+            values.extend(projects)
+
+        query = 'SELECT label FROM task'
+        if clauses:
+            query = '%s WHERE %s' % (query, ' AND '.join(clauses))
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute(query, values)]
+        finally:
+            conn.close()
+
+
+def get_store(diskq, backend=None):
+    """
+    Get the store of the DISKQ attributes (one instance per directory)
+
+    :param diskq: path to the DISKQ directory
+    :param backend: files or sqlite, default to cluster/diskq_backend
+    :return: FileDiskqStore or SqliteDiskqStore object
+    """
+    if backend is None:
+        backend = DAX_SETTINGS.get_diskq_backend()
+
+    key = (os.path.abspath(diskq), backend)
+    with _STORES_LOCK:
+        if key not in _STORES:
+            if backend == 'sqlite':
+                _STORES[key] = SqliteDiskqStore(diskq)
+            elif backend == 'files':
+                _STORES[key] = FileDiskqStore(diskq)
+            else:
+                raise DiskqError('unknown DISKQ backend: %s' % backend)
+        return _STORES[key]
+
+
+def migrate_diskq(diskq, db_path=None):
+    """
+    Copy the tasks of a DISKQ from the files layout to the SQLite database
+
+    The flat files are left untouched so the migration can be run again or
+     reverted by setting diskq_backend back to files.
+
+    :param diskq: path to the DISKQ directory
+    :param db_path: path to the database, default to DISKQ/diskq.db
+    :return: number of tasks migrated
+    """
+    src = FileDiskqStore(diskq)
+    dst = SqliteDiskqStore(diskq, db_path)
+    labels = src.list_tasks()
+    for label in labels:
+        attrs = dict((name, value) for name, value
+                     in list(src.mget(label, DISKQ_ATTRS).items())
+                     if value is not None)
+        dst.add(label)
+        if attrs:
+            dst.mset(label, attrs)
+        LOGGER.debug('migrated task:' + label)
+
+    LOGGER.info('%d tasks migrated to %s' % (len(labels), dst.db_path))
+    return len(labels)
@@ -18,7 +18,7 @@ __all__ = ['DaxError', 'DaxXnatError', 'DaxSpiderError', 'DaxProcessorError',
            'XnatAuthentificationError', 'XnatUtilsError', 'XnatAccessError',
            'XnatToolsError', 'XnatToolsUserError',
            'ClusterLaunchException', 'ClusterCountJobsException',
-           'ClusterJobIDException',
+           'ClusterJobIDException', 'DiskqError',
            'SpiderError', 'AutoSpiderError',
            'AutoProcessorError']
 
@@ -132,6 +132,12 @@ class ClusterJobIDException(ClusterError):
         Exception.__init__(self, 'ERROR: Failed to get job id.')
 
 
+class DiskqError(ClusterError):
+    """Custom exception raised with the DISKQ task store."""
+    def __init__(self, message):
+        Exception.__init__(self, 'Error with DISKQ: %s' % message)
+
+
 # Task:
 class NeedInputsException(DaxError):
     def __init__(self, value):
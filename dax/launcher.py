@@ -10,12 +10,14 @@ from past.builtins import basestring
 
 from datetime import datetime, timedelta
 import logging
+from multiprocessing.pool import ThreadPool
 import redcap
 import sys
 import os
+import threading
 import traceback
 
-from . import processors, modules, XnatUtils, task, cluster
+from . import processors, modules, XnatUtils, task, cluster, diskq_store
 from .task import Task, ClusterTask, XnatTask
 from .dax_settings import DAX_Settings, DAX_Netrc
 from .errors import (ClusterCountJobsException, ClusterLaunchException,
@@ -37,6 +39,8 @@ UPDATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 BUILD_SUFFIX = 'BUILD_RUNNING.txt'
 UPDATE_SUFFIX = 'UPDATE_RUNNING.txt'
 LAUNCH_SUFFIX = 'LAUNCHER_RUNNING.txt'
+# Number of jobs submitted between two counts of the jobs on the cluster
+LAUNCH_RECONCILE_EVERY = 50
 # Logger to print logs
 LOGGER = logging.getLogger('dax')
 
@@ -73,6 +77,37 @@ def task_needs_to_run(procstatus, qcstatus):
 def task_needs_status_update(qcstatus):
     return qcstatus in [task.RERUN, task.REPROC]
 
+class SubjectLogBuffer(logging.Filter):
+    """
+    Logger filter holding the records logged by the threads building a
+     subject so they can be printed in order by the main thread.
+    """
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.local = threading.local()
+
+    def start(self):
+        """Start holding the records logged by the current thread."""
+        self.local.records = list()
+
+    def stop(self):
+        """
+        Stop holding the records logged by the current thread
+
+        :return: list of the records held
+        """
+        records = getattr(self.local, 'records', None) or list()
+        self.local.records = None
+        return records
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
 class Launcher(object):
     """ Launcher object to manage a list of projects from a settings file """
 
@@ -86,7 +121,8 @@ class Launcher(object):
                  xnat_user=None, xnat_pass=None, xnat_host=None, cr=None,
                  job_email=None, job_email_options='bae', max_age=7,
                  launcher_type=DAX_SETTINGS.get_launcher_type(),
-                 skip_lastupdate=None):
+                 skip_lastupdate=None, build_threads=None,
+                 prefetch_threads=None, update_threads=None):
 
         """
         Entry point for the Launcher class
@@ -103,10 +139,22 @@ class Launcher(object):
         :param job_email: job email address for report
         :param job_email_options: email options for the jobs
         :param max_age: maximum time before updating again a session
+        :param build_threads: number of subjects built in parallel
+        :param prefetch_threads: number of sessions XML fetched in parallel
+        :param update_threads: number of tasks updated in parallel
         :return: None
         """
         self.queue_limit = queue_limit
         self.root_job_dir = root_job_dir
+        if build_threads is None:
+            build_threads = DAX_SETTINGS.get_build_threads()
+        self.build_threads = int(build_threads)
+        if prefetch_threads is None:
+            prefetch_threads = DAX_SETTINGS.get_prefetch_threads()
+        self.prefetch_threads = int(prefetch_threads)
+        if update_threads is None:
+            update_threads = DAX_SETTINGS.get_update_threads()
+        self.update_threads = int(update_threads)
 
         # Processors:
         if not isinstance(project_process_dict, dict):
@@ -246,10 +294,15 @@ name as a key and list of yaml filepaths as values.'
         if self.launcher_type in ['diskq-cluster', 'diskq-combined']:
             msg = 'Loading task queue from: %s'
             LOGGER.info(msg % os.path.join(res_dir, 'DISKQ'))
+            if project_local:
+                proj_filter = [project_local]
+            else:
+                proj_filter = list(set(
+                    self.project_process_dict.keys() + self.project_modules_dict.keys()))
             task_list = load_task_queue(
                 status=task.NEED_TO_RUN,
-                proj_filter=list(set(
-                    self.project_process_dict.keys() + self.project_modules_dict.keys())))
+                proj_filter=proj_filter,
+                sess_filter=get_sessions_filter(sessions_local))
 
             msg = '%s tasks that need to be launched found'
             LOGGER.info(msg % str(len(task_list)))
@@ -294,12 +347,17 @@ name as a key and list of yaml filepaths as values.'
         Launch tasks from the passed list until the queue is full or
          the list is empty
 
+        The jobs submitted are counted locally and the count is reconciled
+         with the scheduler every LAUNCH_RECONCILE_EVERY jobs or when the
+         queue limit is reached.
+
         :param task_list: list of task to launch
         :param writeonly: write the job files without submitting them
         :param pbsdir: folder to store the pbs file
         :param force_no_qsub: run the job locally on the computer (serial mode)
         :return: None
         """
+        cjobs = 0
         if force_no_qsub:
             LOGGER.info('No qsub - Running job locally on your computer.')
         else:
@@ -312,9 +370,22 @@ name as a key and list of yaml filepaths as values.'
             if cluster.command_found(cmd=DAX_SETTINGS.get_cmd_submit()):
                 LOGGER.info('%s jobs currently in queue' % str(cjobs))
 
+        if self.launcher_type in ['diskq-cluster', 'diskq-combined'] and \
+           not writeonly and not force_no_qsub and \
+           cluster.job_array_enabled():
+            # Submit the tasks with the same job parameters as job arrays
+            task_list = task.group_task_arrays(task_list)
+
         # Launch until we reach cluster limit or no jobs left to launch
+        nb_launched = 0
         while (cjobs < self.queue_limit or writeonly) and len(task_list) > 0:
             cur_task = task_list.pop()
+            nb_jobs = 1
+            if isinstance(cur_task, task.ClusterTaskArray):
+                if cjobs + len(cur_task) > self.queue_limit:
+                    cur_task, rest = cur_task.split(self.queue_limit - cjobs)
+                    task_list.append(rest)
+                nb_jobs = len(cur_task)
 
             # Confirm task is still ready to run
             # I don't think that we need to make this get here.
@@ -355,11 +426,19 @@ cluster queue"
                 LOGGER.error('ERROR: failed to launch job')
                 raise ClusterLaunchException
 
-            cjobs = cluster.count_jobs()
+            if writeonly or force_no_qsub:
+                continue
 
-            if cjobs == -1:
-                LOGGER.error('ERROR: cannot get count of jobs from cluster')
-                raise ClusterCountJobsException
+            cjobs += nb_jobs
+            nb_launched += nb_jobs
+            if nb_launched // LAUNCH_RECONCILE_EVERY != \
+               (nb_launched - nb_jobs) // LAUNCH_RECONCILE_EVERY or \
+               cjobs >= self.queue_limit:
+                cjobs = cluster.count_jobs()
+
+                if cjobs == -1:
+                    LOGGER.error('ERROR: cannot get count of jobs from cluster')
+                    raise ClusterCountJobsException
 
     # UPDATE Main Method
     def update_tasks(self, lockfile_prefix, project_local, sessions_local):
@@ -390,15 +469,19 @@ cluster queue"
         if self.launcher_type in ['diskq-cluster', 'diskq-combined']:
             msg = 'Loading task queue from: %s'
             LOGGER.info(msg % os.path.join(res_dir, 'DISKQ'))
+            if project_local:
+                proj_filter = [project_local]
+            else:
+                proj_filter = list(self.project_process_dict.keys())
             task_list = load_task_queue(
-                proj_filter=list(self.project_process_dict.keys()))
+                proj_filter=proj_filter,
+                sess_filter=get_sessions_filter(sessions_local))
 
             LOGGER.info('%s tasks found.' % str(len(task_list)))
 
             LOGGER.info('Updating tasks...')
-            for cur_task in task_list:
-                LOGGER.info('Updating task: %s' % cur_task.assessor_label)
-                cur_task.update_status()
+            jobs = cluster.ClusterJobs()
+            self.update_task_list(task_list, jobs)
         else:
             LOGGER.info('Connecting to XNAT at %s' % self.xnat_host)
             with XnatUtils.get_interface(self.xnat_host, self.xnat_user,
@@ -416,13 +499,98 @@ cluster queue"
 
                 LOGGER.info('%s open tasks found' % str(len(task_list)))
                 LOGGER.info('Updating tasks...')
-                for cur_task in task_list:
-                    msg = '     Updating task: %s'
-                    LOGGER.info(msg % cur_task.assessor_label)
-                    cur_task.update_status()
+                jobs = cluster.ClusterJobs()
+                self.update_task_list(task_list, jobs)
 
         self.finish_script(flagfile, project_list, 2, 2, project_local)
 
+    def update_task_list(self, task_list, jobs=None):
+        """
+        Update the status of the tasks on a pool of update_threads workers.
+
+        An exception raised by a task is logged and does not stop the update
+         of the other tasks. The logs of each task are printed in the order
+         of the tasks. The XNAT tasks are updated through a connection to
+         XNAT opened by each worker.
+
+        :param task_list: list of Task/ClusterTask to update
+        :param jobs: cluster.ClusterJobs snapshot of the jobs on the cluster
+        :return: dictionary with the number of tasks changed, unchanged,
+                 errored and skipped
+        """
+        summary = {'changed': 0, 'unchanged': 0, 'errored': 0, 'skipped': 0}
+        nb_workers = min(self.update_threads, len(task_list))
+        worker_intfs = list()
+        worker_local = threading.local()
+        log_buffer = SubjectLogBuffer()
+
+        def update_worker(cur_task):
+            log_buffer.start()
+            try:
+                if nb_workers > 1 and not isinstance(cur_task, ClusterTask):
+                    if getattr(worker_local, 'intf', None) is None:
+                        worker_local.intf = XnatUtils.get_interface(
+                            self.xnat_host, self.xnat_user, self.xnat_pass)
+                        worker_intfs.append(worker_local.intf)
+                    cur_task.assessor = worker_local.intf.select(
+                        cur_task.assessor._uri)
+                result = self.update_task(cur_task, jobs)
+            except Exception as E:
+                err1 = 'Caught exception updating task %s'
+                err2 = 'Exception class %s caught with message %s'
+                LOGGER.critical(err1 % cur_task.assessor_label)
+                LOGGER.critical(err2 % (E.__class__, E.message))
+                LOGGER.critical(traceback.format_exc())
+                result = 'errored'
+            return result, log_buffer.stop()
+
+        if nb_workers > 1:
+            LOGGER.info('  * Updating %d tasks with %d workers'
+                        % (len(task_list), nb_workers))
+            LOGGER.addFilter(log_buffer)
+            pool = ThreadPool(processes=nb_workers)
+            try:
+                for result, records in pool.imap(update_worker, task_list):
+                    for record in records:
+                        LOGGER.handle(record)
+                    summary[result] += 1
+            finally:
+                pool.close()
+                pool.join()
+                LOGGER.removeFilter(log_buffer)
+                for worker_intf in worker_intfs:
+                    try:
+                        worker_intf.disconnect()
+                    except Exception as E:
+                        LOGGER.warn('failed to disconnect worker: %s' % E)
+        else:
+            for cur_task in task_list:
+                result, _ = update_worker(cur_task)
+                summary[result] += 1
+
+        LOGGER.info('%(changed)d tasks changed, %(unchanged)d unchanged, '
+                    '%(errored)d errored, %(skipped)d skipped' % summary)
+        return summary
+
+    @staticmethod
+    def update_task(cur_task, jobs=None):
+        """
+        Update the status of a task
+
+        :param cur_task: Task/ClusterTask to update
+        :param jobs: cluster.ClusterJobs snapshot of the jobs on the cluster
+        :return: 'changed', 'unchanged' or 'skipped' (ClusterTask not
+                 running, nothing to update)
+        """
+        LOGGER.info('     Updating task: %s' % cur_task.assessor_label)
+        old_status, new_status = cur_task.update_status(jobs)
+        if new_status != old_status:
+            return 'changed'
+        elif isinstance(cur_task, ClusterTask) and \
+                old_status != task.JOB_RUNNING:
+            return 'skipped'
+        return 'unchanged'
+
     @staticmethod
     def is_updatable_tasks(assr_info):
         """
@@ -478,30 +646,33 @@ cluster queue"
                 project_list = self.get_project_list(list(unique_list))
 
             # Build projects
-            for project_id in project_list:
-                LOGGER.info('===== PROJECT: %s =====' % project_id)
-                try:
-                    if ((proj_lastrun) and
-                            (project_id in proj_lastrun) and
-                            (proj_lastrun[project_id] is not None)):
-                        lastrun = proj_lastrun[project_id]
-                    else:
-                        lastrun = None
+            with XnatUtils.ProjectListingContext(intf) as context:
+                for project_id in project_list:
+                    LOGGER.info('===== PROJECT: %s =====' % project_id)
+                    try:
+                        if ((proj_lastrun) and
+                                (project_id in proj_lastrun) and
+                                (proj_lastrun[project_id] is not None)):
+                            lastrun = proj_lastrun[project_id]
+                        else:
+                            lastrun = None
 
-                    self.build_project(intf, project_id, lockfile_prefix,
-                                       sessions_local,
-                                       mod_delta=mod_delta, lastrun=lastrun)
-                except Exception as E:
-                    err1 = 'Caught exception building project %s'
-                    err2 = 'Exception class %s caught with message %s'
-                    LOGGER.critical(err1 % project_id)
-                    LOGGER.critical(err2 % (E.__class__, E.message))
-                    LOGGER.critical(traceback.format_exc())
+                        self.build_project(intf, project_id, lockfile_prefix,
+                                           sessions_local,
+                                           mod_delta=mod_delta,
+                                           lastrun=lastrun,
+                                           context=context)
+                    except Exception as E:
+                        err1 = 'Caught exception building project %s'
+                        err2 = 'Exception class %s caught with message %s'
+                        LOGGER.critical(err1 % project_id)
+                        LOGGER.critical(err2 % (E.__class__, E.message))
+                        LOGGER.critical(traceback.format_exc())
 
         self.finish_script(flagfile, project_list, 1, 2, project_local)
 
     def build_project(self, intf, project_id, lockfile_prefix, sessions_local,
-                      mod_delta=None, lastrun=None):
+                      mod_delta=None, lastrun=None, context=None):
         """
         Build the project
 
@@ -509,8 +680,15 @@ cluster queue"
         :param project_id: project ID on XNAT
         :param lockfile_prefix: prefix for flag file to lock the launcher
         :param sessions_local: list of sessions to launch tasks
+        :param context: XnatUtils.ProjectListingContext for this run
         :return: None
         """
+        if context is None:
+            with XnatUtils.ProjectListingContext(intf) as context:
+                return self.build_project(intf, project_id, lockfile_prefix,
+                                          sessions_local, mod_delta, lastrun,
+                                          context=context)
+
         # Modules prerun
         LOGGER.info('  * Modules Prerun')
         if sessions_local:
@@ -539,11 +717,12 @@ cluster queue"
         processor_types = set(map(lambda x: x.name, session_procs + scan_procs + auto_procs))
 
         sessions_by_subject = groupby_to_dict(
-            self.get_sessions_list(intf, project_id, sessions_local),
+            self.get_sessions_list(intf, project_id, sessions_local, context),
             lambda x: x['subject_id'])
+        subjects_to_build = list()
 
         # check to see if there are processor types that are new to this project
-        assessors = XnatUtils.list_project_assessors(intf, project_id)
+        assessors = context.get_project_assessors(project_id)
         has_new = self.has_new_processors(assessors, processor_types)
 
         for subject_id, sessions in sessions_by_subject.items():
@@ -596,55 +775,150 @@ cluster queue"
             if len(sessions_to_update) == 0:
                 continue
 
-            # build a full list of sessions for the subject: they may be needed even if not all sessions are getting
-            # updated
-            cached_sessions = [XnatUtils.CachedImageSession(
-                intf, x['project_label'], x['subject_label'], x['session_label']) for x in sessions]
-            cached_sessions = sorted(cached_sessions, key=lambda s: s.creation_timestamp_, reverse=True)
+            subjects_to_build.append((subject_id, sessions,
+                                      sessions_to_update))
 
-            # update each of the sessions that require it
+        build_args = (session_procs, scan_procs, auto_procs,
+                      exp_mods, scan_mods)
+        with XnatUtils.SessionPrefetcher(intf,
+                                         self.prefetch_threads) as prefetcher:
+            if self.build_threads > 1 and not exp_mods and not scan_mods:
+                self.build_subjects_parallel(subjects_to_build, build_args,
+                                             prefetcher=prefetcher)
+            else:
+                for _, sessions, sessions_to_update in subjects_to_build:
+                    self.build_subject(intf, sessions, sessions_to_update,
+                                       *build_args, prefetcher=prefetcher)
 
-            for sess_info in sessions_to_update.values():
+        if not sessions_local or sessions_local.lower() == 'all':
+            # Modules after run
+            LOGGER.debug('* Modules Afterrun')
+            try:
+                self.module_afterrun(intf, project_id)
+            except Exception as E:
+                err2 = 'Exception class %s caught with message %s'
+                LOGGER.critical('Caught exception after running modules')
+                LOGGER.critical(err2 % (E.__class__, E.message))
+                LOGGER.critical(traceback.format_exc())
+
+    def build_subject(self, intf, sessions, sessions_to_update,
+                      session_procs, scan_procs, auto_procs,
+                      exp_mods, scan_mods, prefetcher=None):
+        """
+        Build the sessions of a subject that require an update
 
+        :param intf: pyxnat.Interface object
+        :param sessions: list of all the sessions info for the subject
+        :param sessions_to_update: dictionary of the sessions info to build
+        :param session_procs: list of processors running on a session
+        :param scan_procs: list of processors running on a scan
+        :param auto_procs: list of yaml processors
+        :param exp_mods: list of modules running on a session
+        :param scan_mods: list of modules running on a scan
+        :param prefetcher: XnatUtils.SessionPrefetcher loading the sessions
+        :return: None
+        """
+        # build a full list of sessions for the subject: they may be needed even if not all sessions are getting
+        # updated
+        if prefetcher is None:
+            prefetcher = XnatUtils.SessionPrefetcher(intf)
+        cached_sessions = prefetcher.load(intf, sessions,
+                                          prefetch=sessions_to_update)
+        cached_sessions = sorted(cached_sessions, key=lambda s: s.creation_timestamp(), reverse=True)
+
+        # update each of the sessions that require it
+
+        for sess_info in sessions_to_update.values():
+
+            if not self.skip_lastupdate:
+                update_start_time = datetime.now()
+
+            try:
+                # TODO: BenM - ensure that this code is robust to subjects
+                # without sessions and sessions without assessors / scans
+                self.build_session(
+                    intf, sess_info, session_procs, scan_procs, auto_procs,
+                    exp_mods, scan_mods,
+                    sessions=cached_sessions)
+            except Exception as E:
+                err1 = 'Caught exception building sessions %s'
+                err2 = 'Exception class %s caught with message %s'
+                LOGGER.critical(err1 % sess_info['session_label'])
+                LOGGER.critical(err2 % (E.__class__, E.message))
+                LOGGER.critical(traceback.format_exc())
+
+            try:
                 if not self.skip_lastupdate:
-                    update_start_time = datetime.now()
+                    self.set_session_lastupdated(intf, self.cr, sess_info,
+                                                 update_start_time)
+            except Exception as E:
+                err1 = 'Caught exception setting session timestamp %s'
+                err2 = 'Exception class %s caught with message %s'
+                LOGGER.critical(err1 % sess_info['session_label'])
+                LOGGER.critical(err2 % (E.__class__, E.message))
+                LOGGER.critical(traceback.format_exc())
 
-                try:
-                    # TODO: BenM - ensure that this code is robust to subjects
-                    # without sessions and sessions without assessors / scans
-                    self.build_session(
-                        intf, sess_info, session_procs, scan_procs, auto_procs,
-                        exp_mods, scan_mods,
-                        sessions=cached_sessions)
-                except Exception as E:
-                    err1 = 'Caught exception building sessions %s'
-                    err2 = 'Exception class %s caught with message %s'
-                    LOGGER.critical(err1 % sess_info['session_label'])
-                    LOGGER.critical(err2 % (E.__class__, E.message))
-                    LOGGER.critical(traceback.format_exc())
+    def build_subjects_parallel(self, subjects_to_build, build_args,
+                                prefetcher=None):
+        """
+        Build the subjects on a pool of build_threads workers.
 
-                try:
-                    if not self.skip_lastupdate:
-                        self.set_session_lastupdated(intf, self.cr, sess_info,
-                                                     update_start_time)
-                except Exception as E:
-                    err1 = 'Caught exception setting session timestamp %s'
-                    err2 = 'Exception class %s caught with message %s'
-                    LOGGER.critical(err1 % sess_info['session_label'])
-                    LOGGER.critical(err2 % (E.__class__, E.message))
-                    LOGGER.critical(traceback.format_exc())
+        Each worker opens its own connection to XNAT, so the number of
+        concurrent requests to XNAT is bounded by the size of the pool. The
+        logs of each subject are held by the worker and printed in the
+        order of the subjects once the subject is built.
 
-            if not sessions_local or sessions_local.lower() == 'all':
-                # Modules after run
-                LOGGER.debug('* Modules Afterrun')
+        :param subjects_to_build: list of (subject_id, sessions,
+                                  sessions_to_update)
+        :param build_args: processors/modules lists given to build_subject
+        :param prefetcher: XnatUtils.SessionPrefetcher shared by the workers
+        :return: None
+        """
+        nb_workers = min(self.build_threads, len(subjects_to_build))
+        if nb_workers == 0:
+            return
+
+        LOGGER.info('  * Building %d subjects with %d workers'
+                    % (len(subjects_to_build), nb_workers))
+        worker_intfs = list()
+        worker_local = threading.local()
+        log_buffer = SubjectLogBuffer()
+        LOGGER.addFilter(log_buffer)
+
+        def build_worker(subject_args):
+            subject_id, sessions, sessions_to_update = subject_args
+            log_buffer.start()
+            try:
+                if getattr(worker_local, 'intf', None) is None:
+                    worker_local.intf = XnatUtils.get_interface(
+                        self.xnat_host, self.xnat_user, self.xnat_pass)
+                    worker_intfs.append(worker_local.intf)
+                LOGGER.info('  * Subject %s' % subject_id)
+                self.build_subject(worker_local.intf, sessions,
+                                   sessions_to_update, *build_args,
+                                   prefetcher=prefetcher)
+            except Exception as E:
+                err1 = 'Caught exception building subject %s'
+                err2 = 'Exception class %s caught with message %s'
+                LOGGER.critical(err1 % subject_id)
+                LOGGER.critical(err2 % (E.__class__, E.message))
+                LOGGER.critical(traceback.format_exc())
+            return log_buffer.stop()
+
+        pool = ThreadPool(processes=nb_workers)
+        try:
+            for records in pool.imap(build_worker, subjects_to_build):
+                for record in records:
+                    LOGGER.handle(record)
+        finally:
+            pool.close()
+            pool.join()
+            LOGGER.removeFilter(log_buffer)
+            for worker_intf in worker_intfs:
                 try:
-                    self.module_afterrun(intf, project_id)
+                    worker_intf.disconnect()
                 except Exception as E:
-                    err2 = 'Exception class %s caught with message %s'
-                    LOGGER.critical('Caught exception after running modules')
-                    LOGGER.critical(err2 % (E.__class__, E.message))
-                    LOGGER.critical(traceback.format_exc())
-
+                    LOGGER.warn('failed to disconnect worker: %s' % E)
 
     # TODO:BenM/assessor_of_assessor/modify from here for one to many
     # processor to assessor mapping
@@ -926,11 +1200,14 @@ in session %s'
             if not sess_proc.should_run(sess_info):
                 continue
 
-            # TODO: use mod time to decide if we need to reload
-            csess.reload()
+            # only reload if the session was modified since it was cached
+            csess.reload_if_modified()
+            created = False
 
             # return a mapping between the assessor input sets and existing
             # assessors that map to those input sets
+            # (the parser keeps the results per thread: has_inputs and
+            # build_task below use the results of this session)
             sess_proc.parse_session(csess, sessions)
             mapping = sess_proc.get_assessor_mapping()
 
@@ -940,8 +1217,9 @@ in session %s'
             if self.launcher_type in ['diskq-xnat', 'diskq-combined']:
                 for inputs, p_assrs in mapping:
                     if len(p_assrs) == 0:
-                        assessor = sess_proc.create_assessor(xnat_session,
-                                                             inputs, relabel=True)
+                        assessor = sess_proc.create_assessor(
+                            xnat_session, inputs, relabel=True, csess=csess)
+                        created = True
                         assessors =\
                             [(assessor, task.NEED_TO_RUN, task.DOES_NOT_EXIST)]
                     else:
@@ -972,6 +1250,8 @@ in session %s'
                                 self.job_email_options)
                             deg = 'proc_status=%s, qc_status=%s'
                             LOGGER.debug(deg % (proc_status, qc_status))
+                            csess.update_assessor(
+                                assessor[0].label(), proc_status, qc_status)
                         else:
                             # TODO: check that it actually exists in QUEUE
                             LOGGER.debug(
@@ -980,8 +1260,9 @@ in session %s'
             else:
                 for inputs, p_assrs in mapping:
                     if len(p_assrs) == 0:
-                        assessor = sess_proc.create_assessor(xnat_session,
-                                                             inputs)
+                        assessor = sess_proc.create_assessor(
+                            xnat_session, inputs, csess=csess)
+                        created = True
                         assessors =\
                             [(assessor, task.NEED_TO_RUN, task.DOES_NOT_EXIST)]
                     else:
@@ -1008,12 +1289,21 @@ in session %s'
                                 if has_inputs == 1:
                                     sess_task.set_status(task.NEED_TO_RUN)
                                     sess_task.set_qcstatus(task.JOB_PENDING)
+                                    csess.update_assessor(
+                                        sess_task.assessor_label,
+                                        task.NEED_TO_RUN, task.JOB_PENDING)
                                 else:
                                     errorstr =\
                                         '\n'.join((q[1] for q in qcerrors))
                                     sess_task.set_qcstatus(errorstr)
+                                    csess.update_assessor(
+                                        sess_task.assessor_label,
+                                        qcstatus=errorstr)
                                     if has_inputs == -1:
                                         sess_task.set_status(task.NO_DATA)
+                                        csess.update_assessor(
+                                            sess_task.assessor_label,
+                                            procstatus=task.NO_DATA)
                             except Exception as E:
                                 err1 = 'Caught exception building session %s while \
         setting assessor status'
@@ -1025,6 +1315,9 @@ in session %s'
                             # Other statuses handled by dax_update_tasks
                             pass
 
+            if created:
+                # the new assessors are already in the cached session
+                csess.refresh_last_modified()
 
     def module_prerun(self, project_id, settings_filename=''):
         """
@@ -1174,17 +1467,19 @@ The project is not part of the settings."""
                 project_list = list(projects)
 
         # iterate projects
-        for project_id in project_list:
-            LOGGER.info('===== PROJECT:%s =====' % project_id)
-            task_list.extend(self.get_project_tasks(xnat,
-                                                    project_id,
-                                                    sessions_local,
-                                                    is_valid_assessor))
+        with XnatUtils.ProjectListingContext(xnat) as context:
+            for project_id in project_list:
+                LOGGER.info('===== PROJECT:%s =====' % project_id)
+                task_list.extend(self.get_project_tasks(xnat,
+                                                        project_id,
+                                                        sessions_local,
+                                                        is_valid_assessor,
+                                                        context=context))
 
         return task_list
 
     def get_project_tasks(self, xnat, project_id, sessions_local,
-                          is_valid_assessor):
+                          is_valid_assessor, context=None):
         """
         Get list of tasks for a specific project where each task agrees
          the is_valid_assessor conditions
@@ -1194,6 +1489,7 @@ The project is not part of the settings."""
         :param sessions_local: list of sessions to update tasks associated
          to the project locally
         :param is_valid_assessor: method to validate the assessor
+        :param context: XnatUtils.ProjectListingContext for this run
         :return: list of tasks
         """
         task_list = list()
@@ -1204,7 +1500,8 @@ The project is not part of the settings."""
             processors.processors_by_type(pp_dict)
 
         # Get lists of assessors for this project
-        assr_list = self.get_assessors_list(xnat, project_id, sessions_local)
+        assr_list = self.get_assessors_list(xnat, project_id, sessions_local,
+                                            context)
 
         # Match each assessor to a processor, get a task, and add to list
         for assr_info in assr_list:
@@ -1279,17 +1576,21 @@ The project is not part of the settings."""
             return cur_task
 
     @staticmethod
-    def get_assessors_list(xnat, project_id, slocal):
+    def get_assessors_list(xnat, project_id, slocal, context=None):
         """
         Get the assessor list from XNAT and filter it if necessary
 
         :param xnat: pyxnat.Interface object
         :param project_id: project ID on XNAT
         :param slocal: session selected by user
+        :param context: XnatUtils.ProjectListingContext for this run
         :return: list of assessors for a project
         """
         # Get lists of assessors for this project
-        assr_list = XnatUtils.list_project_assessors(xnat, project_id)
+        if context:
+            assr_list = context.get_project_assessors(project_id)
+        else:
+            assr_list = XnatUtils.list_project_assessors(xnat, project_id)
 
         # filter the assessors to the sessions given as parameters if given
         if slocal and slocal.lower() != 'all':
@@ -1304,7 +1605,7 @@ The project is not part of the settings."""
         return assr_list
 
     @staticmethod
-    def get_sessions_list(xnat, project_id, slocal):
+    def get_sessions_list(xnat, project_id, slocal, context=None):
         """
         Get the sessions list from XNAT and sort it.
          Move the new sessions to the front.
@@ -1312,9 +1613,13 @@ The project is not part of the settings."""
         :param xnat: pyxnat.Interface object
         :param project_id: project ID on XNAT
         :param slocal: session selected by user
+        :param context: XnatUtils.ProjectListingContext for this run
         :return: list of sessions sorted for a project
         """
-        list_sessions = xnat.get_sessions(project_id)
+        if context:
+            list_sessions = context.get_sessions(project_id)
+        else:
+            list_sessions = xnat.get_sessions(project_id)
         if slocal and slocal.lower() != 'all':
             # filter the list and keep the match between both list:
             val = slocal.split(',')
@@ -1423,31 +1728,50 @@ The project is not part of the settings."""
 
 
 # TODO: BenM/assessor_of_assessor/check path.txt to get the project_id
-def load_task_queue(status=None, proj_filter=None):
-    """ Load the task queue for DiskQ"""
+def load_task_queue(status=None, proj_filter=None, sess_filter=None):
+    """
+    Load the task queue for DiskQ
+
+    The status and projects are looked up in the DISKQ indexes so only the
+     matching tasks are read.
+
+    :param status: procstatus of the tasks to load, all if None
+    :param proj_filter: list of projects of the tasks, all if None
+    :param sess_filter: list of session labels of the tasks, all if None
+    :return: list of ClusterTask
+    """
     task_list = list()
     diskq_dir = os.path.join(DAX_SETTINGS.get_results_dir(), 'DISKQ')
     results_dir = DAX_SETTINGS.get_results_dir()
 
-    for t in os.listdir(os.path.join(diskq_dir, 'BATCH')):
-        # TODO:complete filtering by project/subject/session/type
-        if proj_filter:
-            assr = XnatUtils.AssessorHandler(t)
-            if assr.get_project_id() not in proj_filter:
-                LOGGER.debug('ignoring:' + t)
+    # TODO:complete filtering by subject/type
+    store = diskq_store.get_store(diskq_dir)
+    for label in store.list_tasks(status=status, projects=proj_filter,
+                                  default_status=task.NEED_TO_RUN):
+        if sess_filter:
+            assr = XnatUtils.AssessorHandler(label)
+            if assr.get_session_label() not in sess_filter:
+                LOGGER.debug('ignoring:' + label)
                 continue
 
-        LOGGER.debug('loading:' + t)
-        task = ClusterTask(os.path.splitext(t)[0], results_dir, diskq_dir)
-        LOGGER.debug('status = ' + task.get_status())
-
-        if not status or task.get_status() == status:
-            LOGGER.debug('adding task to list:' + t)
-            task_list.append(task)
+        LOGGER.debug('adding task to list:' + label)
+        task_list.append(ClusterTask(label, results_dir, diskq_dir))
 
     return task_list
 
 
+def get_sessions_filter(sessions_local):
+    """
+    Get the list of session labels selected by the user
+
+    :param sessions_local: comma separated session labels or 'all'
+    :return: list of session labels, None for all the sessions
+    """
+    if not sessions_local or sessions_local.lower() == 'all':
+        return None
+    return [sess.strip() for sess in sessions_local.split(',')]
+
+
 def get_sess_lastmod(xnat, sess_info):
     """ Get the session last modified date."""
     xsi_type = sess_info['xsiType']
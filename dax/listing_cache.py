@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" listing_cache.py
+
+Persistent on-disk snapshot of the project listings returned by
+InterfaceTemp (sessions).
+
+Each snapshot is stored per project and datatype in a SQLite database
+under the results directory. The rows keep their last_modified date:
+InterfaceTemp compares them with the dates on XNAT and only queries again
+the rows that changed (see InterfaceTemp._get_cached_sessions).
+"""
+
+from builtins import object
+
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+from .dax_settings import DAX_Settings
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+__all__ = ['ProjectSnapshotCache']
+DAX_SETTINGS = DAX_Settings()
+LOGGER = logging.getLogger('dax')
+
+LISTING_CACHE_DIRNAME = 'LISTING_CACHE'
+LISTING_CACHE_FILENAME = 'snapshot.db'
+SQLITE_TIMEOUT = 60
+SNAPSHOT_SCHEMA = '''CREATE TABLE IF NOT EXISTS listing (
+    project TEXT NOT NULL,
+    datatype TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    rows TEXT NOT NULL,
+    PRIMARY KEY (project, datatype))'''
+
+
+class ProjectSnapshotCache(object):
+    """ Class to store/read the listings of a project on disk """
+    def __init__(self, db_path=None):
+        """
+        Entry point for the ProjectSnapshotCache class
+
+        :param db_path: path to the SQLite database, default to
+                        RESULTS_DIR/LISTING_CACHE/snapshot.db
+        :return: None
+        """
+        if not db_path:
+            db_path = os.path.join(DAX_SETTINGS.get_results_dir(),
+                                   LISTING_CACHE_DIRNAME,
+                                   LISTING_CACHE_FILENAME)
+        self.db_path = db_path
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        with self._connect() as conn:
+            conn.execute(SNAPSHOT_SCHEMA)
+
+    def _connect(self):
+        """
+        Open a new connection to the database (one per call so the cache
+        can be shared between threads and processes)
+
+        :return: sqlite3.Connection
+        """
+        return sqlite3.connect(self.db_path, timeout=SQLITE_TIMEOUT)
+
+    def get(self, project, datatype):
+        """
+        Get the rows stored for a project/datatype
+
+        :param project: project ID
+        :param datatype: name of the listing (sessions, ...)
+        :return: list of dictionaries, None if missing
+        """
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    'SELECT rows FROM listing '
+                    'WHERE project=? AND datatype=?',
+                    (project, datatype)).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error as err:
+            LOGGER.warn('listing cache not readable (%s): %s'
+                        % (self.db_path, err))
+            return None
+
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, project, datatype, rows):
+        """
+        Store the rows for a project/datatype
+
+        :param project: project ID
+        :param datatype: name of the listing (sessions, ...)
+        :param rows: list of dictionaries to store
+        :return: None
+        """
+        updated = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO listing '
+                    '(project, datatype, updated, rows) '
+                    'VALUES (?, ?, ?, ?)',
+                    (project, datatype, updated, json.dumps(rows)))
+        except sqlite3.Error as err:
+            LOGGER.warn('listing cache not writable (%s): %s'
+                        % (self.db_path, err))
+
+    def invalidate(self, project=None, datatype=None):
+        """
+        Remove the snapshots for a project and/or a datatype (all if None)
+
+        :param project: project ID
+        :param datatype: name of the listing
+        :return: None
+        """
+        clauses = list()
+        values = list()
+        if project:
+            clauses.append('project=?')
+            values.append(project)
+        if datatype:
+            clauses.append('datatype=?')
+            values.append(datatype)
+        query = 'DELETE FROM listing'
+        if clauses:
+            query = '%s WHERE %s' % (query, ' AND '.join(clauses))
+        with self._connect() as conn:
+            conn.execute(query, values)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" mirror_state.py
+
+Persistent sync state of Xnatmirror.
+
+The last_modified date of each source subject and session copied to the
+destination is stored in a SQLite database in the mirror directory. The next
+mirror of the project only descends into the subjects and sessions modified
+since then.
+"""
+
+from builtins import object
+
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+__all__ = ['MirrorSyncState']
+LOGGER = logging.getLogger('dax')
+
+MIRROR_STATE_FILENAME = 'sync_state.db'
+SQLITE_TIMEOUT = 60
+SYNC_STATE_SCHEMA = '''CREATE TABLE IF NOT EXISTS sync_state (
+    host TEXT NOT NULL,
+    project TEXT NOT NULL,
+    obj_id TEXT NOT NULL,
+    last_modified TEXT NOT NULL,
+    synced TEXT NOT NULL,
+    PRIMARY KEY (host, project, obj_id))'''
+
+
+class MirrorSyncState(object):
+    """ Class to store/read the objects already mirrored on disk """
+    def __init__(self, db_path):
+        """
+        Entry point for the MirrorSyncState class
+
+        :param db_path: path to the SQLite database
+        :return: None
+        """
+        self.db_path = db_path
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        with self._connect() as conn:
+            conn.execute(SYNC_STATE_SCHEMA)
+
+    def _connect(self):
+        """
+        Open a new connection to the database
+
+        :return: sqlite3.Connection
+        """
+        return sqlite3.connect(self.db_path, timeout=SQLITE_TIMEOUT)
+
+    def get_synced(self, host, project):
+        """
+        Get the last_modified dates of the objects synced for a project
+
+        :param host: source XNAT host
+        :param project: source project ID
+        :return: dictionary subject/session ID -> last_modified when synced
+        """
+        try:
+            conn = self._connect()
+            try:
+                rows = conn.execute(
+                    'SELECT obj_id, last_modified FROM sync_state '
+                    'WHERE host=? AND project=?', (host, project)).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as err:
+            LOGGER.warn('mirror sync state not readable (%s): %s'
+                        % (self.db_path, err))
+            return dict()
+        return dict(rows)
+
+    def set_synced(self, host, project, obj_id, last_modified):
+        """
+        Record that a subject or a session was synced
+
+        :param host: source XNAT host
+        :param project: source project ID
+        :param obj_id: ID of the subject/session on the source
+        :param last_modified: last_modified date of the object on the source
+        :return: None
+        """
+        synced = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO sync_state '
+                '(host, project, obj_id, last_modified, synced) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (host, project, obj_id, last_modified, synced))
+
+    def invalidate(self, host, project):
+        """
+        Remove the sync state of a project (next mirror is a full one)
+
+        :param host: source XNAT host
+        :param project: source project ID
+        :return: None
+        """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM sync_state WHERE host=? AND project=?',
+                         (host, project))
+
+    def modified(self, host, project, rows):
+        """
+        Filter the subjects/sessions modified since they were last synced
+
+        :param host: source XNAT host
+        :param project: source project ID
+        :param rows: list of dictionaries with the keys ID and last_modified
+                     of the subjects/sessions on the source
+        :return: list of the rows never synced or modified since
+        """
+        synced = self.get_synced(host, project)
+        return [row for row in rows
+                if not row.get('last_modified') or
+                synced.get(row['ID']) != row['last_modified']]
@@ -1,8 +1,7 @@
 
-import copy
-import itertools
 import logging
 import sys
+import threading
 from collections import namedtuple
 from . task import NeedInputsException, NoDataException
 from . task import NEED_INPUTS, OPEN_STATUS_LIST, OPEN_QA_LIST, BAD_QA_STATUS,\
@@ -107,7 +106,34 @@ TimestampSession = namedtuple('TimestampSession', 'timestamp, session')
 ArtefactEntry = namedtuple('ArtefactEntry', 'path, type, object')
 
 
-class ProcessorParser:
+def parse_result(name):
+    """
+    Property giving the value of a result of ProcessorParser.parse_session
+     for the calling thread
+
+    :param name: name of the result
+    :return: property
+    """
+    def fget(self):
+        return getattr(self.parse_results_, name, None)
+
+    def fset(self, value):
+        setattr(self.parse_results_, name, value)
+
+    return property(fget, fset)
+
+
+class ProcessorParser(object):
+
+    # The results of parse_session are kept per thread: the processors are
+    # shared by the threads building the sessions, each thread reads the
+    # results of the session it parsed (see Launcher.build_session)
+    csess = parse_result('csess')
+    sessions_ = parse_result('sessions_')
+    artefacts = parse_result('artefacts')
+    artefacts_by_input = parse_result('artefacts_by_input')
+    parameter_matrix = parse_result('parameter_matrix')
+    assessor_parameter_map = parse_result('assessor_parameter_map')
 
     __schema_dict_v1 = {
         'top': set(['schema', 'inputs', 'xnat', 'attrs']),
@@ -131,12 +157,7 @@ class ProcessorParser:
         self.match_filters = ProcessorParser.parse_match_filters(yaml_source)
         self.variables_to_inputs = ProcessorParser.parse_variables(self.inputs)
 
-        self.csess = None
-        self.sessions_ = None
-        self.artefacts = None
-        self.artefacts_by_input = None
-        self.parameter_matrix = None
-        self.assessor_parameter_map = None
+        self.parse_results_ = threading.local()
 
         self.xsitype = yaml_source['attrs'].get('xsitype', 'proc:genProcData')
 
@@ -166,7 +187,7 @@ class ProcessorParser:
         self.assessor_parameter_map = None
 
         for i in range(len(sessions) - 1):
-            if sessions[i].creation_timestamp_ < sessions[i+1].creation_timestamp_:
+            if sessions[i].creation_timestamp() < sessions[i+1].creation_timestamp():
                 raise ValueError("session parameter is not ordered by creation datetime")
 
         index = sessions.index(csess)
@@ -180,25 +201,26 @@ class ProcessorParser:
                                                     self.inputs,
                                                     self.inputs_by_type)
 
+        # the match filters are applied while the matrix is generated
         parameter_matrix = \
             ProcessorParser.generate_parameter_matrix(
                 self.inputs,
                 self.iteration_sources,
                 self.iteration_map,
                 artefacts,
-                artefacts_by_input)
-
-
-        parameter_matrix = ProcessorParser.filter_matrix(
-            parameter_matrix,
-            self.match_filters,
-            artefacts)
+                artefacts_by_input,
+                self.match_filters)
 
         assessor_parameter_map = \
             ProcessorParser.compare_to_existing(relevant_sessions,
                                                 self.proctype,
                                                 parameter_matrix)
 
+        if assessor_parameter_map is not None:
+            parameter_matrix = [p for p, _ in assessor_parameter_map]
+        else:
+            parameter_matrix = None
+
         self.csess = csess
         self.artefacts = artefacts
         self.artefacts_by_input = artefacts_by_input
@@ -223,7 +245,19 @@ class ProcessorParser:
 
         return command_set
 
-    def find_inputs(self, assr):
+    def find_inputs(self, assr, artefacts=None):
+        """
+        Find the values of the variables and the files to download for the
+         inputs of an assessor
+
+        :param assr: pyxnat assessor object
+        :param artefacts: artefacts of the sessions of the assessor (see
+                          parse_artefacts) used instead of querying XNAT,
+                          default to the ones parsed by this thread
+        :return: dictionary variable -> value, list of inputs to download
+        """
+        if artefacts is None:
+            artefacts = self.artefacts
         assr_inputs = XnatUtils.get_assessor_inputs(assr)
         variable_set = {}
         input_list = []
@@ -235,18 +269,21 @@ class ProcessorParser:
             if art_type == 'scan' and not inp['needs_qc']:
                 continue
 
-            # Get status from xnat
-            aobj = assr._intf.select(artv)
+            # Get status from the cached session or from xnat
+            status = ProcessorParser._get_input_status(assr._intf, artv,
+                                                       artefacts)
+            if status is None:
+                raise NeedInputsException(artk + ': Not Found')
+
             if art_type == 'scan':
-                if aobj.attrs.get('quality') == 'unusable':
+                if status['quality'] == 'unusable':
                     raise NeedInputsException(artk + ': Not Usable')
             else:
-                dtype = aobj.datatype()
-                procstatus = aobj.attrs.get(dtype + '/procstatus')
+                procstatus = status['procstatus']
                 if procstatus in OPEN_STATUS_LIST+[NEED_INPUTS]:
                     raise NeedInputsException(artk + ': Not Ready')
 
-                qcstatus = aobj.attrs.get(dtype + '/validation/status')
+                qcstatus = status['qcstatus']
                 if qcstatus in [JOB_PENDING, REPROC, RERUN]:
                     raise NeedInputsException(artk + ': Not Ready')
 
@@ -278,7 +315,8 @@ class ProcessorParser:
                     robj = assr._intf.select(resource_paths[artefact_type].format(
                        vinput, resource))
 
-                    if not robj.exists():
+                    if not ProcessorParser._has_resource(
+                            robj, vinput, resource, artefacts):
                         LOGGER.debug('failed to find resource')
                         raise NeedInputsException('No Resource')
 
@@ -327,7 +365,8 @@ class ProcessorParser:
                 robj = assr._intf.select(resource_paths[artefact_type].format(
                    assr_inputs[v['input']], resource))
 
-                if not robj.exists():
+                if not ProcessorParser._has_resource(
+                        robj, assr_inputs[v['input']], resource, artefacts):
                     LOGGER.debug('failed to find resource')
                     raise NeedInputsException('No Resource')
 
@@ -600,6 +639,7 @@ class ProcessorParser:
 
             inputs[name] = {
                 'types': types,
+                'type_matcher': XnatUtils.compile_type_matcher(types),
                 'select': parsed_select,
                 'select-session': parsed_session_select,
                 'artefact_type': 'scan',
@@ -741,26 +781,45 @@ class ProcessorParser:
                 csess = csesses[0]
 
             if csess is not None:
+                type_matcher = iv.get('type_matcher') or \
+                    XnatUtils.compile_type_matcher(iv['types'])
+                scans_by_type = csess.scans_by_type()
+                good_types = set(t for t in scans_by_type
+                                 if type_matcher.match(t))
                 for cscan in csess.scans():
-                    for expression in iv['types']:
-                        regex = XnatUtils.extract_exp(expression)
-                        if regex.match(cscan.type()):
-                            if iv.get('select')[0] == 'all' and cscan.info().get('quality') == 'unusable':
-                                print('excluding unusable scan')
-                            else:
-                                artefacts_by_input[i].append(cscan.full_path())
-                            # Break here so we don't match multiple times
-                            break
-
+                    if cscan.type() in good_types:
+                        if iv.get('select')[0] == 'all' and cscan.info().get('quality') == 'unusable':
+                            print('excluding unusable scan')
+                        else:
+                            artefacts_by_input[i].append(cscan.full_path())
+
+                # keep the session order of the assessors: select one/some
+                # and the stored inputs of select all depend on it
+                proctypes = set(iv['types'])
                 for cassr in csess.assessors():
-                    if cassr.type() in iv['types']:
+                    if cassr.type() in proctypes:
                         artefacts_by_input[i].append(cassr.full_path())
 
         return artefacts_by_input
 
 
-    def has_inputs(self, assr):
-
+    def has_inputs(self, assr, artefacts=None):
+        """
+        Check that the inputs of an assessor exist, are usable and have
+         files in the resources needed by the processor
+
+        The inputs that are part of the artefacts are checked from their
+         cached XML, only the other inputs and the resources without a
+         file_count are queried on XNAT.
+
+        :param assr: pyxnat assessor object
+        :param artefacts: artefacts of the sessions of the assessor (see
+                          parse_artefacts), default to the ones parsed by
+                          this thread (see parse_session)
+        :return: 1 if the inputs are ready, 0 otherwise, list of errors
+        """
+        if artefacts is None:
+            artefacts = self.artefacts
         input_entries = XnatUtils.get_assessor_inputs(assr)
         errors = []
         for artefact_input_k, input_entry\
@@ -776,43 +835,50 @@ class ProcessorParser:
                 artefact_input_paths = [input_entry]
 
             for artefact_input_path in artefact_input_paths:
-                a = assr._intf.select(artefact_input_path)
+                status = ProcessorParser._get_input_status(
+                    assr._intf, artefact_input_path, artefacts)
                 # check for existence. Note, an assessor is created if the
                 # appropriate combination of inputs is present. If one or more of
                 # those inputs is subsequently removed from the session, the
                 # assessor now has a missing input
-                if not a.exists():
+                if status is None:
                     errors.append((artefact_input_k,' does not exist'))
                     continue
 
-                artefact_type = assr._intf.object_type_from_path(
-                    artefact_input_path)
+                artefact_type = status['type']
                 if artefact_type not in ['scan', 'assessor']:
                     errors.append((artefact_input_k,' must be scan or assr'))
                     continue
 
                 if processor_inputs['needs_qc'] == True:
                     if artefact_type == 'scan':
-                        usable = a.attrs.get('quality') == 'usable'
+                        usable = status['quality'] == 'usable'
                     else:
-                        status = a.attrs.get(a.datatype()+'/validation/status')
-                        usable = XnatUtils.is_bad_qa(status) == 1
+                        usable = XnatUtils.is_bad_qa(status['qcstatus']) == 1
 
                     if not usable:
                         errors.append((artefact_input_k, ' not usable'))
                         continue
 
-                resource_dict = {}
-
-                for robj in a.resources():
-                    resource_dict[robj.label()] = len(list(robj.files()))
+                resource_dict = status['resources']
+                if resource_dict is None:
+                    aobj = assr._intf.select(artefact_input_path)
+                    resource_dict = dict((robj.label(), None)
+                                         for robj in aobj.resources())
 
                 for r in processor_inputs['resources']:
                     if r['resource'] not in resource_dict:
                         errors.append((artefact_input_k,
                             'missing resource {}'.format(r['resource'])))
                         continue
-                    elif resource_dict[r['resource']] < 1:
+
+                    file_count = resource_dict[r['resource']]
+                    if file_count is None:
+                        robj = assr._intf.select(
+                            resource_paths[artefact_type].format(
+                                artefact_input_path, r['resource']))
+                        file_count = len(list(robj.files()))
+                    if file_count < 1:
                         errors.append((artefact_input_k,
                             'missing files from {}'.format(r['resource'])))
                         continue
@@ -820,6 +886,67 @@ class ProcessorParser:
         return 1 if len(errors) == 0 else 0, errors
 
 
+    @staticmethod
+    def _has_resource(robj, path, resource, artefacts):
+        """
+        Check that a resource of an input exists, from the cached XML when
+         the input is part of the artefacts
+
+        :param robj: pyxnat resource object
+        :param path: path of the scan/assessor on XNAT
+        :param resource: label of the resource
+        :param artefacts: dictionary artefact path -> ParserArtefact or None
+        :return: True if the resource exists, False otherwise
+        """
+        artefact = (artefacts or dict()).get(path)
+        if artefact is not None:
+            return resource in [cres.label()
+                                for cres in artefact.entity.resources()]
+        return robj.exists()
+
+
+    @staticmethod
+    def _get_input_status(intf, path, artefacts):
+        """
+        Get the status of an input of an assessor, from the cached XML when
+         the input is part of the artefacts, from XNAT otherwise
+
+        :param intf: pyxnat.Interface object
+        :param path: path of the scan/assessor on XNAT
+        :param artefacts: dictionary artefact path -> ParserArtefact or None
+        :return: dictionary with the keys type, quality, procstatus, qcstatus
+                 and resources (label -> file_count, None if not cached),
+                 None if the input does not exist
+        """
+        artefact = (artefacts or dict()).get(path)
+        if artefact is not None:
+            cart = artefact.entity
+            info = cart.info()
+            return {'type': cart.entity_type(),
+                    'quality': info.get('quality'),
+                    'procstatus': info.get('procstatus'),
+                    'qcstatus': info.get('qcstatus'),
+                    'resources': dict((cres.label(), cres.file_count())
+                                      for cres in cart.resources())}
+
+        aobj = intf.select(path)
+        if not aobj.exists():
+            return None
+
+        status = {'type': intf.object_type_from_path(path),
+                  'quality': None,
+                  'procstatus': None,
+                  'qcstatus': None,
+                  'resources': None}
+        if status['type'] == 'scan':
+            status['quality'] = aobj.attrs.get('quality')
+        elif status['type'] == 'assessor':
+            dtype = aobj.datatype()
+            status['procstatus'] = aobj.attrs.get(dtype + '/procstatus')
+            status['qcstatus'] = aobj.attrs.get(dtype + '/validation/status')
+        return status
+
+
     # TODO: BenM/assessor_of_assessors/improve name of generate_parameter_matrix
     # TODO: BenM/assessor_of_assessors/handle multiple args disallowed / allowed
     # scenarios
@@ -828,7 +955,25 @@ class ProcessorParser:
                                   iteration_sources,
                                   iteration_map,
                                   artefacts,
-                                  artefacts_by_input):
+                                  artefacts_by_input,
+                                  match_filters=None):
+        """
+        Generate the sets of inputs of the processor for a session
+
+        The rows are the cartesian product of the input vectors of the
+         iteration sources. They are generated lazily and the match filters
+         are checked as soon as all the inputs they refer to are set, so that
+         the partial combinations failing a filter are pruned before being
+         expanded.
+
+        :param inputs: dictionary of the inputs of the processor
+        :param iteration_sources: set of the inputs iterated on
+        :param iteration_map: dictionary input -> iteration source
+        :param artefacts: dictionary artefact path -> artefact
+        :param artefacts_by_input: dictionary input -> list of artefact paths
+        :param match_filters: list of match filters (see parse_match_filters)
+        :return: iterator of dictionaries input -> artefact path(s)
+        """
         # generate n dimensional input matrix based on iteration sources
         all_inputs = []
         input_dimension_map = []
@@ -919,43 +1064,94 @@ class ProcessorParser:
                 all_inputs.append(mapped_inputs)
                 input_dimension_map.append(cur_input_vector)
 
-        # perform a cartesian product of the dimension map entries to get the
-        # final input combinations
-        matrix = map(lambda x: list(itertools.chain.from_iterable(x)),
-                     itertools.product(*input_dimension_map))
+        # assign each match filter to the first dimension of the cartesian
+        # product at which all the inputs it refers to are set
+        input_dimensions = dict()
+        for dimension, mapped_inputs in enumerate(all_inputs):
+            for i in mapped_inputs:
+                input_dimensions[i] = dimension
+        last_dimension = max(len(all_inputs) - 1, 0)
+        filters_by_dimension = [[] for _ in range(last_dimension + 1)]
+        for cur_filter in match_filters or []:
+            dimension = max(
+                input_dimensions.get(i.split('/')[0], last_dimension)
+                for i in cur_filter)
+            filters_by_dimension[dimension].append(cur_filter)
+
+        return ProcessorParser._expand_parameter_matrix(
+            all_inputs, input_dimension_map, filters_by_dimension, artefacts,
+            dict(), 0)
 
-        matrix_headers = list(itertools.chain.from_iterable(all_inputs))
 
-        # rebuild the matrix to order the inputs consistently
-        final_matrix = []
-        for r in matrix:
-            row = dict()
-            for i in range(len(matrix_headers)):
-                row[matrix_headers[i]] = r[i]
-            final_matrix.append(row)
+    @staticmethod
+    def _expand_parameter_matrix(all_inputs, input_dimension_map,
+                                 filters_by_dimension, artefacts, row,
+                                 dimension):
+        """
+        Expand the cartesian product of the input vectors depth first
+
+        :param all_inputs: list of the input names of each dimension
+        :param input_dimension_map: list of the input vectors of each dimension
+        :param filters_by_dimension: list of the match filters checked once
+                                     each dimension is set
+        :param artefacts: dictionary artefact path -> artefact
+        :param row: partial row with the inputs of the previous dimensions
+        :param dimension: index of the dimension to expand
+        :return: generator of the rows passing all the match filters
+        """
+        if dimension == len(input_dimension_map):
+            yield dict(row)
+            return
 
-        return final_matrix
+        for entry in input_dimension_map[dimension]:
+            for name, value in zip(all_inputs[dimension], entry):
+                row[name] = value
+
+            if all(ProcessorParser.filter_matches(cur_filter, row, artefacts)
+                   for cur_filter in filters_by_dimension[dimension]):
+                for full_row in ProcessorParser._expand_parameter_matrix(
+                        all_inputs, input_dimension_map, filters_by_dimension,
+                        artefacts, row, dimension + 1):
+                    yield full_row
 
 
     @staticmethod
     def compare_to_existing(csesses, processor_type, parameter_matrix):
-
+        """
+        Map each set of inputs of the parameter matrix to the existing
+         assessors of the processor type on the session with the same inputs
+
+        The inputs are looked up by their canonical signature (see
+         XnatUtils.serialize_inputs) in the index of the assessors of the
+         session by inputs instead of comparing every assessor to every row.
+
+        :param csesses: list of CachedImageSession, the first one holds the
+                        assessors
+        :param processor_type: proctype of the assessors
+        :param parameter_matrix: iterable of dictionaries of inputs
+        :return: list of (inputs, list of CachedImageAssessor), None if an
+                 assessor of the processor type has no inputs
+        """
         csess = csesses[0]
 
-        assessors = [[] for _ in range(len(parameter_matrix))]
-        for casr in filter(lambda a: a.type() == processor_type,
-                           csess.assessors()):
-            inputs = casr.get_inputs()
-
-            if inputs is None:
+        for casr in csess.assessors_by_proctype().get(processor_type, []):
+            if casr.get_inputs() is None:
                 LOGGER.warn('skipping, inputs field is empty:' + casr.label())
                 return None
 
-            for pi, p in enumerate(parameter_matrix):
-                if inputs == p:
-                    assessors[pi].append(casr)
+        assessors_by_inputs = csess.assessors_by_inputs()
+        mapping = []
+        # the parameter matrix can be a generator: consume it once
+        for p in parameter_matrix:
+            signature = XnatUtils.serialize_inputs(p)
+            p_assrs = [casr for casr in assessors_by_inputs.get(signature, [])
+                       if casr.type() == processor_type]
+            if len(p_assrs) > 1:
+                LOGGER.warn('duplicate assessors with the same inputs: ' +
+                            ', '.join(casr.label() for casr in p_assrs))
+            mapping.append((p, p_assrs))
 
-        return zip(copy.deepcopy(parameter_matrix), assessors)
+        return mapping
 
 
     @staticmethod
@@ -977,29 +1173,18 @@ class ProcessorParser:
 
 
     @staticmethod
-    def filter_matrix(parameter_matrix, match_filters, artefacts):
-        filtered_matrix = []
-        for cur_param in parameter_matrix:
-            # Reset matching for this param set
-            all_match = True
-
-            for cur_filter in match_filters:
-                # Get the first value to compare with others
-                first_val = ProcessorParser.get_input_value(
-                    cur_filter[0], cur_param, artefacts)
-
-                # Compare other values with first value
-                for cur_input in cur_filter[1:]:
-                    cur_val = ProcessorParser.get_input_value(
-                        cur_input, cur_param, artefacts)
-
-                    if cur_val != first_val:
-                        # A single non-match breaks the whole thing
-                        all_match = False
-                        break
-
-            if all_match:
-                # Keep this param set if everything matches
-                filtered_matrix.append(cur_param)
-
-        return filtered_matrix
+    def filter_matches(cur_filter, cur_param, artefacts):
+        # Get the first value to compare with others
+        first_val = ProcessorParser.get_input_value(
+            cur_filter[0], cur_param, artefacts)
+
+        # Compare other values with first value
+        for cur_input in cur_filter[1:]:
+            cur_val = ProcessorParser.get_input_value(
+                cur_input, cur_param, artefacts)
+
+            if cur_val != first_val:
+                # A single non-match breaks the whole thing
+                return False
+
+        return True
@@ -185,7 +185,17 @@ class Processor(object):
         """
         raise NotImplementedError()
 
-    def create_assessor(self, xnatsession, inputs, relabel=False):
+    def create_assessor(self, xnatsession, inputs, relabel=False,
+                        csess=None):
+        """
+        Create a new assessor on XNAT for a set of inputs
+
+        :param xnatsession: pyxnat session object
+        :param inputs: dictionary of the assessor inputs
+        :param relabel: use the full label (proj-x-subj-x-sess-x-proc-x-guid)
+        :param csess: CachedImageSession patched with the new assessor
+        :return: pyxnat assessor object
+        """
         attempts = 0
         while attempts < 100:
             guid = str(uuid4())
@@ -219,6 +229,8 @@ class Processor(object):
                 assessor.create(assessors=self.xsitype.lower(),
                                 ID=guid, label=label,
                                 **kwargs)
+                if csess is not None:
+                    csess.add_assessor(self.xsitype, guid, label, kwargs)
                 return assessor
 
             attempts += 1
@@ -304,13 +316,11 @@ class ScanProcessor(Processor):
 
         # Look for existing assessor
         assr_label = assr_name
-        for assr in csess.assessors():
-            if assr_name_shared is not None and \
-               assr.info()['label'] == assr_name_shared:
-                assr_label = assr_name_shared
-                break
-            if assr.info()['label'] == assr_name:
-                break
+        assrs_by_label = csess.assessors_by_label()
+        if assr_name_shared is not None and \
+           assr_name not in assrs_by_label and \
+           assr_name_shared in assrs_by_label:
+            assr_label = assr_name_shared
 
         return assr_label
 
@@ -327,10 +337,9 @@ class ScanProcessor(Processor):
         # Look for existing assessor
         csess = cscan.parent()
         p_assr = None
-        for assr in csess.assessors():
-            if assr.info()['label'] == assessor_name:
-                p_assr = assr
-                break
+        assrs = csess.assessors_by_label().get(assessor_name)
+        if assrs:
+            p_assr = assrs[0]
 
         return p_assr, assessor_name
 
@@ -434,13 +443,11 @@ class SessionProcessor(Processor):
 
         # Look for existing assessor
         assr_label = assr_name
-        for assr in csess.assessors():
-            if assr_name_shared is not None and \
-               assr.info()['label'] == assr_name_shared:
-                assr_label = assr_name_shared
-                break
-            if assr.info()['label'] == assr_name:
-                break
+        assrs_by_label = csess.assessors_by_label()
+        if assr_name_shared is not None and \
+           assr_name not in assrs_by_label and \
+           assr_name_shared in assrs_by_label:
+            assr_label = assr_name_shared
 
         return assr_label
 
@@ -460,10 +467,9 @@ class SessionProcessor(Processor):
 
         # Look for existing assessor
         p_assr = None
-        for assr in csess.assessors():
-            if assr.info()['label'] == assessor_name:
-                p_assr = assr
-                break
+        assrs = csess.assessors_by_label().get(assessor_name)
+        if assrs:
+            p_assr = assrs[0]
 
         return p_assr, assessor_name
 
@@ -3,14 +3,18 @@
 from builtins import str
 from builtins import object
 
-from datetime import date
+from contextlib import contextmanager
+from datetime import date, datetime
 import errno
+import functools
+import json
 import logging
 import os
 import shutil
 import time
 
 from . import cluster
+from . import diskq_store
 from .cluster import PBS
 from .errors import (NeedInputsException, NoDataException,
                      ClusterLaunchException)
@@ -19,7 +23,7 @@ from . import assessor_utils
 
 
 __copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
-__all__ = ['Task', 'ClusterTask', 'XnatTask']
+__all__ = ['Task', 'ClusterTask', 'ClusterTaskArray', 'XnatTask']
 DAX_SETTINGS = DAX_Settings()
 # Logger to print logs
 LOGGER = logging.getLogger('dax')
@@ -89,6 +93,8 @@ INPUTS_DIRNAME = 'INPUTS'
 BATCH_DIRNAME = 'BATCH'
 OUTLOG_DIRNAME = 'OUTLOG'
 PBS_DIRNAME = 'PBS'
+JOBPARAMS_DIRNAME = 'JOBPARAMS'
+ARRAY_DIRNAME = 'ARRAY'
 
 # Status and QC status supported by DAX
 SUPPORTED_STATUS = [NO_DATA, NEED_TO_RUN, NEED_INPUTS, JOB_RUNNING, JOB_FAILED,
@@ -113,6 +119,22 @@ def create_flag(flag_path):
     open(flag_path, 'w').close()
 
 
+def buffer_attrs(method):
+    """
+    Decorator for the Task methods setting several attributes on XNAT: the
+     attributes are written with a single attrs.mset when the method returns
+     (see Task.buffered_attrs)
+
+    :param method: Task method to decorate
+    :return: decorated method
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.buffered_attrs():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Task(object):
     """ Class Task to generate/manage the assessor with the cluster """
     def __init__(self, processor, assessor, upload_dir):
@@ -139,14 +161,16 @@ class Task(object):
             else:
                 assessor.create(assessors=self.atype)
 
-            self.set_createdate_today()
-            atype = self.atype.lower()
-            if atype == DEFAULT_DATATYPE.lower():
-                assessor.attrs.mset(
-                    {'%s/proctype' % atype: self.get_processor_name(),
-                     '%s/procversion' % atype: self.get_processor_version()})
+            with self.buffered_attrs():
+                self.set_createdate_today()
+                atype = self.atype.lower()
+                if atype == DEFAULT_DATATYPE.lower():
+                    self.set_attrs(
+                        {'%s/proctype' % atype: self.get_processor_name(),
+                         '%s/procversion' % atype:
+                         self.get_processor_version()})
 
-            self.set_proc_and_qc_status(NEED_INPUTS, JOB_PENDING)
+                self.set_proc_and_qc_status(NEED_INPUTS, JOB_PENDING)
 
         # Cache for convenience
         self.assessor_id = assessor.id()
@@ -170,6 +194,75 @@ class Task(object):
         """
         return self.processor.version
 
+    @contextmanager
+    def buffered_attrs(self):
+        """
+        Hold the attributes set on XNAT by the Task (set_status, set_jobid,
+         ...) in the block and write them with a single attrs.mset at the end
+         of the block. The getters read the values held first.
+
+        If the block raises, the attributes held are discarded: a transition
+         is written whole or not at all.
+
+        :return: None
+        """
+        if getattr(self, 'pending_attrs', None) is not None:
+            # Already buffering, flushed by the outer block
+            yield
+            return
+
+        self.pending_attrs = dict()
+        try:
+            yield
+        except BaseException:
+            self.pending_attrs = None
+            raise
+        pending_attrs, self.pending_attrs = self.pending_attrs, None
+        if pending_attrs:
+            self.assessor.attrs.mset(pending_attrs)
+
+    def get_attr(self, xpath):
+        """
+        Get an attribute of the assessor on XNAT, or the value held if it was
+         set in a buffered_attrs block
+
+        :param xpath: xpath of the attribute
+        :return: value of the attribute
+        """
+        pending_attrs = getattr(self, 'pending_attrs', None) or dict()
+        if xpath in pending_attrs:
+            return pending_attrs[xpath]
+        return self.assessor.attrs.get(xpath)
+
+    def get_attrs(self, xpaths):
+        """
+        Get attributes of the assessor on XNAT with a single attrs.mget, the
+         values held in a buffered_attrs block being read from the buffer
+
+        :param xpaths: list of xpaths of the attributes
+        :return: list of the values in the order of xpaths
+        """
+        pending_attrs = getattr(self, 'pending_attrs', None) or dict()
+        missing = [xpath for xpath in xpaths if xpath not in pending_attrs]
+        values = dict()
+        if missing:
+            values = dict(zip(missing, self.assessor.attrs.mget(missing)))
+        return [pending_attrs[xpath] if xpath in pending_attrs
+                else values[xpath] for xpath in xpaths]
+
+    def set_attrs(self, attrs):
+        """
+        Set attributes of the assessor on XNAT, held until the end of the
+         block if called in buffered_attrs
+
+        :param attrs: dictionary xpath -> value
+        :return: None
+        """
+        if getattr(self, 'pending_attrs', None) is not None:
+            self.pending_attrs.update(attrs)
+        else:
+            self.assessor.attrs.mset(attrs)
+
     def is_open(self):
         """
         Check to see if a task is still in "Open" status as defined in
@@ -192,7 +285,7 @@ class Task(object):
 
         """
         atype = self.atype
-        mgets = self.assessor.attrs.mget([
+        mgets = self.get_attrs([
             '%s/memused' % atype,
             '%s/walltimeused' % atype,
             '%s/jobid' % atype,
@@ -205,6 +298,7 @@ class Task(object):
                 mgets[3].strip(),
                 mgets[4].strip()]
 
+    @buffer_attrs
     def check_job_usage(self):
         """
         The task has now finished, get the amount of memory used, the amount of
@@ -255,7 +349,7 @@ class Task(object):
         :return: String of how much memory was used
 
         """
-        memused = self.assessor.attrs.get('%s/memused' % self.atype)
+        memused = self.get_attr('%s/memused' % self.atype)
         return memused.strip()
 
     def set_memused(self, memused):
@@ -266,7 +360,7 @@ class Task(object):
         :return: None
 
         """
-        self.assessor.attrs.set('%s/memused' % self.atype, memused)
+        self.set_attrs({'%s/memused' % self.atype: memused})
 
     def get_walltime(self):
         """
@@ -275,7 +369,7 @@ class Task(object):
         :return: String of how much walltime was used for a process
 
         """
-        walltime = self.assessor.attrs.get('%s/walltimeused' % self.atype)
+        walltime = self.get_attr('%s/walltimeused' % self.atype)
         return walltime.strip()
 
     def set_walltime(self, walltime):
@@ -287,7 +381,7 @@ class Task(object):
         :return: None
 
         """
-        self.assessor.attrs.set('%s/walltimeused' % self.atype, walltime)
+        self.set_attrs({'%s/walltimeused' % self.atype: walltime})
 
     def get_jobnode(self):
         """
@@ -296,7 +390,7 @@ class Task(object):
         :return: String identifying the node that a job ran on
 
         """
-        jobnode = self.assessor.attrs.get('%s/jobnode' % self.atype)
+        jobnode = self.get_attr('%s/jobnode' % self.atype)
         if jobnode is None:
             jobnode = 'NotFound'
         return jobnode.strip()
@@ -309,7 +403,7 @@ class Task(object):
         :return: None
 
         """
-        self.assessor.attrs.set('%s/jobnode' % self.atype, jobnode)
+        self.set_attrs({'%s/jobnode' % self.atype: jobnode})
 
     def undo_processing(self):
         """
@@ -388,11 +482,14 @@ class Task(object):
         os.remove(os.path.join(self.upload_dir, local_zip))
         shutil.rmtree(os.path.join(self.upload_dir, local_dir))
 
-    def update_status(self):
+    @buffer_attrs
+    def update_status(self, jobs=None):
         """
         Update the satus of a Task object.
 
-        :return: the "new" status (updated) of the Task.
+        :param jobs: cluster.ClusterJobs snapshot of the jobs on the cluster
+                     (query the scheduler for this job if None)
+        :return: tuple (old status, new status) of the Task.
 
         """
         old_status, qcstatus, jobid = self.get_statuses()
@@ -422,7 +519,7 @@ undo_processing...')
             # This is now handled by dax_build
             pass
         elif old_status == JOB_RUNNING:
-            new_status = self.check_running(jobid)
+            new_status = self.check_running(jobid, jobs)
         elif old_status == READY_TO_UPLOAD:
             # TODO: let upload spider handle it???
             # self.check_date()
@@ -446,7 +543,7 @@ undo_processing...')
             else:
                 self.set_status(new_status)
 
-        return new_status
+        return old_status, new_status
 
     def get_jobid(self):
         """
@@ -455,16 +552,17 @@ undo_processing...')
         :return: string of the jobid
 
         """
-        jobid = self.assessor.attrs.get('%s/jobid' % self.atype)
+        jobid = self.get_attr('%s/jobid' % self.atype)
         if jobid is None:
             jobid = 'NotFound'
         return jobid.strip()
 
-    def get_job_status(self, jobid=None):
+    def get_job_status(self, jobid=None, jobs=None):
         """
         Get the status of a job given its jobid as assigned by the scheduler
 
         :param jobid: job id assigned by the scheduler
+        :param jobs: cluster.ClusterJobs snapshot of the jobs on the cluster
         :return: string from call to cluster.job_status or UNKNOWN.
 
         """
@@ -473,10 +571,14 @@ undo_processing...')
             jobid = self.get_jobid()
 
         if jobid != '' and jobid != '0':
-            jobstatus = cluster.job_status(jobid)
+            if jobs is not None:
+                jobstatus = jobs.job_status(jobid)
+            else:
+                jobstatus = cluster.job_status(jobid)
 
         return jobstatus
 
+    @buffer_attrs
     def launch(self, jobdir, job_email=None,
                job_email_options=DAX_SETTINGS.get_email_opts(),
                xnat_host=None, writeonly=False, pbsdir=None,
@@ -555,7 +657,7 @@ undo_processing...')
         :return: String of the date that the job started in "%Y-%m-%d" format
 
         """
-        return self.assessor.attrs.get('%s/jobstartdate' % self.atype)
+        return self.get_attr('%s/jobstartdate' % self.atype)
 
     def set_jobstartdate_today(self):
         """
@@ -577,7 +679,7 @@ undo_processing...')
         :return: None
 
         """
-        self.assessor.attrs.set('%s/jobstartdate' % self.atype, date_str)
+        self.set_attrs({'%s/jobstartdate' % self.atype: date_str})
 
     def get_createdate(self):
         """
@@ -587,7 +689,7 @@ undo_processing...')
          format
 
         """
-        return self.assessor.attrs.get('%s/date' % self.atype)
+        return self.get_attr('%s/date' % self.atype)
 
     def set_createdate(self, date_str):
         """
@@ -597,7 +699,7 @@ undo_processing...')
         :return: String of today's date in "%Y-%m-%d" format
 
         """
-        self.assessor.attrs.set('%s/date' % self.atype, date_str)
+        self.set_attrs({'%s/date' % self.atype: date_str})
         return date_str
 
     def set_createdate_today(self):
@@ -623,8 +725,8 @@ undo_processing...')
             xnat_status = DOES_NOT_EXIST
         elif self.atype.lower() in [DEFAULT_DATATYPE.lower(),
                                     DEFAULT_FS_DATATYPE.lower()]:
-            xnat_status = self.assessor.attrs.get('%s/procstatus'
-                                                  % self.atype.lower())
+            xnat_status = self.get_attr('%s/procstatus'
+                                        % self.atype.lower())
         else:
             xnat_status = 'UNKNOWN_xsiType: %s' % self.atype
         return xnat_status
@@ -642,7 +744,7 @@ undo_processing...')
             jobid = ''
         elif self.atype.lower() in [DEFAULT_DATATYPE.lower(),
                                     DEFAULT_FS_DATATYPE.lower()]:
-            xnat_status, qcstatus, jobid = self.assessor.attrs.mget([
+            xnat_status, qcstatus, jobid = self.get_attrs([
                 '%s/procstatus' % self.atype,
                 '%s/validation/status' % self.atype,
                 '%s/jobid' % self.atype
@@ -662,7 +764,7 @@ undo_processing...')
         :return: None
 
         """
-        self.assessor.attrs.set('%s/procstatus' % self.atype, status)
+        self.set_attrs({'%s/procstatus' % self.atype: status})
 
     def get_qcstatus(self):
         """
@@ -679,8 +781,7 @@ undo_processing...')
             qcstatus = DOES_NOT_EXIST
         elif self.atype.lower() in [DEFAULT_DATATYPE.lower(),
                                     DEFAULT_FS_DATATYPE.lower()]:
-            qcstatus = self.assessor.attrs.get('%s/validation/status'
-                                               % self.atype)
+            qcstatus = self.get_attr('%s/validation/status' % self.atype)
         else:
             qcstatus = 'UNKNOWN_xsiType: %s' % self.atype
 
@@ -694,7 +795,7 @@ undo_processing...')
         :return: None
 
         """
-        self.assessor.attrs.mset({
+        self.set_attrs({
             '%s/validation/status' % self.atype: qcstatus,
             '%s/validation/validated_by' % self.atype: 'NULL',
             '%s/validation/date' % self.atype: 'NULL',
@@ -711,7 +812,7 @@ undo_processing...')
         :return: None
 
         """
-        self.assessor.attrs.mset({
+        self.set_attrs({
             '%s/procstatus' % self.atype: procstatus,
             '%s/validation/status' % self.atype: qcstatus,
         })
@@ -724,7 +825,7 @@ undo_processing...')
         :return: None
 
         """
-        self.assessor.attrs.set('%s/jobid' % self.atype, jobid)
+        self.set_attrs({'%s/jobid' % self.atype: jobid})
 
     def set_launch(self, jobid):
         """
@@ -736,7 +837,7 @@ undo_processing...')
 
         """
         today_str = str(date.today())
-        self.assessor.attrs.mset({
+        self.set_attrs({
             '%s/jobstartdate' % self.atype.lower(): today_str,
             '%s/jobid' % self.atype.lower(): jobid,
             '%s/procstatus' % self.atype.lower(): JOB_RUNNING,
@@ -799,18 +900,19 @@ undo_processing...')
                                 READY_TO_UPLOAD_FLAG_FILENAME)
         return os.path.isfile(flagfile)
 
-    def check_running(self, jobid=None):
+    def check_running(self, jobid=None, jobs=None):
         """
         Check to see if a job specified by the scheduler ID is still running
 
         :param jobid: The ID of the job in question assigned by the scheduler.
+        :param jobs: cluster.ClusterJobs snapshot of the jobs on the cluster
         :return: A String of JOB_RUNNING if the job is running or enqueued and
          JOB_FAILED if the ready flag (see read_flag_exists) does not exist
          in the assessor label folder in the upload directory.
 
         """
         # Check status on cluster
-        jobstatus = self.get_job_status(jobid)
+        jobstatus = self.get_job_status(jobid, jobs)
 
         if not jobstatus or jobstatus in ['R', 'Q']:
             # Still running
@@ -839,6 +941,7 @@ class ClusterTask(Task):
         self.assessor_id = None
         self.diskq = diskq
         self.upload_dir = upload_dir
+        self.store = diskq_store.get_store(diskq)
 
     def get_processor_name(self):
         """
@@ -879,13 +982,11 @@ class ClusterTask(Task):
                  and start date
 
         """
-        memused = self.get_attr('memused')
-        walltime = self.get_attr('walltimeused')
-        jobid = self.get_attr('jobid')
-        jobnode = self.get_attr('jobnode')
-        jobstartdate = self.get_attr('jobstartdate')
+        attrs = self.get_attrs(['memused', 'walltimeused', 'jobid',
+                                'jobnode', 'jobstartdate'])
 
-        return [memused, walltime, jobid, jobnode, jobstartdate]
+        return [attrs['memused'], attrs['walltimeused'], attrs['jobid'],
+                attrs['jobnode'], attrs['jobstartdate']]
 
     def check_job_usage(self):
         """
@@ -1007,18 +1108,20 @@ class ClusterTask(Task):
         """
         raise NotImplementedError()
 
-    def update_status(self):
+    def update_status(self, jobs=None):
         """
         Update the status of a Cluster Task object.
 
-        :return: the "new" status (updated) of the Task.
+        :param jobs: cluster.ClusterJobs snapshot of the jobs on the cluster
+                     (query the scheduler for this job if None)
+        :return: tuple (old status, new status) of the Task.
 
         """
         old_status = self.get_status()
         new_status = old_status
 
         if old_status == JOB_RUNNING:
-            new_status = self.check_running()
+            new_status = self.check_running(jobs)
             if new_status == READY_TO_UPLOAD:
                 new_status = self.complete_task()
             elif new_status == JOB_FAILED:
@@ -1038,7 +1141,7 @@ class ClusterTask(Task):
                         % (old_status, new_status))
             self.set_status(new_status)
 
-        return new_status
+        return old_status, new_status
 
     def get_jobid(self):
         """
@@ -1050,11 +1153,11 @@ class ClusterTask(Task):
         jobid = self.get_attr('jobid')
         return jobid
 
-    def get_job_status(self):
+    def get_job_status(self, jobs=None):
         """
         Get the status of a job given its jobid as assigned by the scheduler
 
-        :param jobid: job id assigned by the scheduler
+        :param jobs: cluster.ClusterJobs snapshot of the jobs on the cluster
         :return: string from call to cluster.job_status or UNKNOWN.
 
         """
@@ -1062,7 +1165,10 @@ class ClusterTask(Task):
         jobid = self.get_jobid()
 
         if jobid and jobid != '0':
-            jobstatus = cluster.job_status(jobid)
+            if jobs is not None:
+                jobstatus = jobs.job_status(jobid)
+            else:
+                jobstatus = cluster.job_status(jobid)
 
         return jobstatus
 
@@ -1221,9 +1327,9 @@ class ClusterTask(Task):
 
         """
         today_str = str(date.today())
-        self.set_attr('jobstartdate', today_str)
-        self.set_attr('jobid', jobid)
-        self.set_attr('procstatus', JOB_RUNNING)
+        self.set_attrs({'jobstartdate': today_str,
+                        'jobid': jobid,
+                        'procstatus': JOB_RUNNING})
 
     def commands(self, jobdir):
         """
@@ -1276,11 +1382,11 @@ class ClusterTask(Task):
         label = self.assessor_label
         return os.path.join(self.upload_dir, label, OUTLOG_DIRNAME)
 
-    def check_running(self):
+    def check_running(self, jobs=None):
         """
         Check to see if a job specified by the scheduler ID is still running
 
-        :param jobid: The ID of the job in question assigned by the scheduler.
+        :param jobs: cluster.ClusterJobs snapshot of the jobs on the cluster
         :return: A String of JOB_RUNNING if the job is running or enqueued and
          JOB_FAILED if the ready flag (see read_flag_exists) does not exist
          in the assessor label folder in the upload directory.
@@ -1291,7 +1397,7 @@ class ClusterTask(Task):
             return READY_TO_UPLOAD
 
         # Check status on cluster
-        jobstatus = self.get_job_status()
+        jobstatus = self.get_job_status(jobs)
 
         if not jobstatus or jobstatus == 'R' or jobstatus == 'Q':
             # Still running
@@ -1318,20 +1424,23 @@ class ClusterTask(Task):
         raise NotImplementedError()
 
     def get_attr(self, name):
-        apath = self.attr_path(name)
+        return self.store.get(self.assessor_label, name)
 
-        if not os.path.exists(apath):
-            return None
-
-        with open(apath, 'r') as f:
-            return f.read().strip()
+    def get_attrs(self, names):
+        return self.store.mget(self.assessor_label, names)
 
     def set_attr(self, name, value):
-        attr_path = self.attr_path(name)
-        attr_dir = os.path.dirname(attr_path)
-        mkdirp(attr_dir)
-        with open(self.attr_path(name), 'w') as f:
-            f.write(str(value) + '\n')
+        self.store.set(self.assessor_label, name, value)
+
+    def set_attrs(self, attrs):
+        """
+        Set several attributes at once (single transaction with the sqlite
+         DISKQ backend)
+
+        :param attrs: dictionary attribute name -> value
+        :return: None
+        """
+        self.store.mset(self.assessor_label, attrs)
 
     def attr_path(self, attr):
         return os.path.join(self.diskq, attr, self.assessor_label)
@@ -1389,10 +1498,7 @@ class ClusterTask(Task):
         return JOB_FAILED
 
     def delete_attr(self, attr):
-        try:
-            os.remove(self.attr_path(attr))
-        except OSError:
-            pass
+        self.store.delete(self.assessor_label, [attr])
 
     def delete_batch(self):
         # Delete batch file
@@ -1401,15 +1507,144 @@ class ClusterTask(Task):
         except OSError:
             pass
 
+    def job_params_path(self):
+        """
+        Method to return the path of the job parameters (commands and
+         resources used to write the batch file) of the task
+
+        :return: A string that is the absolute path to the JSON file.
+        """
+        return os.path.join(self.diskq, JOBPARAMS_DIRNAME,
+                            '%s.json' % self.assessor_label)
+
+    def get_job_params(self):
+        """
+        Get the job parameters written by XnatTask.build_task
+
+        :return: dictionary with the cmds and the PBS parameters, None if
+         the task was built without them
+        """
+        try:
+            with open(self.job_params_path(), 'r') as f_obj:
+                return json.load(f_obj)
+        except (IOError, ValueError):
+            return None
+
     def delete(self):
         # Delete attributes
-        attr_list = ['jobid', 'jobnode', 'procstatus', 'walltimeused',
-                     'memused', 'jobstartdate']
-        for attr in attr_list:
-            self.delete_attr(attr)
+        self.store.delete(self.assessor_label)
 
         self.delete_batch()
 
+        try:
+            os.remove(self.job_params_path())
+        except OSError:
+            pass
+
+
+class ClusterTaskArray(object):
+    """ Group of ClusterTask submitted to the cluster as one job array """
+    def __init__(self, tasks):
+        """
+        Entry point for the ClusterTaskArray class
+
+        :param tasks: list of ClusterTask with the same job parameters
+        :return: None
+        """
+        self.tasks = tasks
+        self.diskq = tasks[0].diskq
+        self.name = 'array_%s_%d' % (datetime.now().strftime('%Y%m%d%H%M%S%f'),
+                                     len(tasks))
+        self.assessor_label = '%s (%s, ...)' % (self.name,
+                                                tasks[0].assessor_label)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def split(self, size):
+        """
+        Split the array in two arrays
+
+        :param size: number of tasks in the first array
+        :return: the two ClusterTaskArray
+        """
+        return (ClusterTaskArray(self.tasks[:size]),
+                ClusterTaskArray(self.tasks[size:]))
+
+    def array_dir(self):
+        """
+        Method to return the directory of the job array
+
+        :return: A string that is the absolute path to the directory with
+         the batch file, the scripts of the elements and the manifest.
+        """
+        return os.path.join(self.diskq, ARRAY_DIRNAME, self.name)
+
+    def launch(self, force_no_qsub=False):
+        """
+        Method to launch the tasks as a job array on the grid. Each task gets
+         the job id of its element so update_status/complete_task work
+         as if it was submitted by itself.
+
+        :raises: cluster.ClusterLaunchException if the jobid is 0 or empty
+         as returned by pbs.submit() method
+        :return: True if the job array was submitted
+        """
+        if force_no_qsub or len(self.tasks) == 1:
+            for cur_task in self.tasks:
+                cur_task.launch(force_no_qsub=force_no_qsub)
+            return True
+
+        params = self.tasks[0].get_job_params()
+        elements = [(cur_task.assessor_label, cur_task.outlog_path(),
+                     cur_task.get_job_params()['cmds'])
+                    for cur_task in self.tasks]
+        kwargs = dict((k, v) for k, v in list(params.items()) if k != 'cmds')
+        array_dir = self.array_dir()
+        batch = cluster.PBSArray(
+            os.path.join(array_dir, '%s%s' % (self.name, JOB_EXTENSION_FILE)),
+            os.path.join(array_dir, '%s.txt' % self.name),
+            elements, **kwargs)
+        LOGGER.info('writing:' + batch.filename)
+        batch.write()
+        jobid, _ = batch.submit()
+
+        if jobid == '' or jobid == '0':
+            LOGGER.error('failed to launch job array on cluster')
+            raise ClusterLaunchException
+
+        for cur_task, element_jobid in zip(self.tasks,
+                                           batch.element_jobids(jobid)):
+            cur_task.set_launch(element_jobid)
+        return True
+
+
+def group_task_arrays(task_list):
+    """
+    Group the ClusterTask with the same job parameters (template, resources,
+     environment) in ClusterTaskArray. Tasks built without job parameters
+     are kept as they are.
+
+    :param task_list: list of ClusterTask
+    :return: list of ClusterTask/ClusterTaskArray
+    """
+    groups = dict()
+    grouped = list()
+    for cur_task in task_list:
+        params = cur_task.get_job_params()
+        if params is None:
+            grouped.append(cur_task)
+            continue
+        key = json.dumps(dict((k, v) for k, v in list(params.items())
+                              if k != 'cmds'), sort_keys=True)
+        if key not in groups:
+            groups[key] = list()
+            grouped.append(groups[key])
+        groups[key].append(cur_task)
+
+    return [ClusterTaskArray(x) if isinstance(x, list) else x
+            for x in grouped]
+
 
 class XnatTask(Task):
     """ Class Task to generate/manage the assessor with the cluster """
@@ -1437,11 +1672,13 @@ class XnatTask(Task):
         """
         raise NotImplementedError()
 
-    def update_status(self):
+    @buffer_attrs
+    def update_status(self, jobs=None):
         """
         Update the satus of an XNAT Task object.
 
-        :return: the "new" status (updated) of the Task.
+        :param jobs: not used, kept for compatibility with Task
+        :return: tuple (old status, new status) of the Task.
 
         """
         old_status, qcstatus, jobid = self.get_statuses()
@@ -1473,7 +1710,7 @@ undo_processing...')
                         % (old_status, new_status))
             self.set_status(new_status)
 
-        return new_status
+        return old_status, new_status
 
     def get_job_status(self):
         raise NotImplementedError()
@@ -1515,6 +1752,23 @@ undo_processing...')
         f_txt = '%s.txt' % self.assessor_label
         return os.path.join(self.diskq, OUTLOG_DIRNAME, f_txt)
 
+    def write_job_params(self, cmds, params):
+        """
+        Write the commands and the parameters of the batch file so the task
+         can be launched as an element of a job array (see ClusterTaskArray)
+
+        :param cmds: list of commands of the job
+        :param params: dictionary of the PBS parameters (PBS.get_params)
+        :return: None
+        """
+        params_dir = os.path.join(self.diskq, JOBPARAMS_DIRNAME)
+        mkdirp(params_dir)
+        job_params = dict(params)
+        job_params['cmds'] = cmds
+        params_file = os.path.join(params_dir, '%s.json' % self.assessor_label)
+        with open(params_file, 'w') as f_obj:
+            json.dump(job_params, f_obj)
+
     def check_running(self):
         """
         Check to see if a job specified by the scheduler ID is still running
@@ -1553,6 +1807,8 @@ undo_processing...')
                         self.processor.job_template)
             LOGGER.info('writing:' + batch_file)
             batch.write()
+            self.write_job_params(cmds, batch.get_params())
+            diskq_store.get_store(self.diskq).add(self.assessor_label)
 
             new_proc_status = JOB_RUNNING
             new_qc_status = JOB_PENDING
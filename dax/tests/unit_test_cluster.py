@@ -0,0 +1,142 @@
+from unittest import TestCase
+
+import os
+import shutil
+import tempfile
+from string import Template
+
+from dax import cluster
+
+
+class FakeSettings(object):
+
+    def get_running_status(self):
+        return 'R'
+
+    def get_queue_status(self):
+        return 'PD'
+
+    def get_complete_status(self):
+        return 'CG'
+
+
+class ClusterJobsTest(TestCase):
+
+    def setUp(self):
+        self.queried = []
+        self.job_status = cluster.job_status
+        self.settings = cluster.DAX_SETTINGS
+        cluster.DAX_SETTINGS = FakeSettings()
+
+        def fake_job_status(jobid):
+            self.queried.append(jobid)
+            return 'C'
+        cluster.job_status = fake_job_status
+
+    def tearDown(self):
+        cluster.job_status = self.job_status
+        cluster.DAX_SETTINGS = self.settings
+
+    def test_short_jobid(self):
+        self.assertEqual(cluster.short_jobid('1234.server.org'), '1234')
+        self.assertEqual(cluster.short_jobid(' 1234\n'), '1234')
+        self.assertEqual(cluster.short_jobid('1234.5'), '1234.5')
+
+    def test_job_state(self):
+        self.assertEqual(cluster.job_state('R'), 'R')
+        self.assertEqual(cluster.job_state('PD'), 'Q')
+        self.assertEqual(cluster.job_state('CG'), 'C')
+        self.assertIsNone(cluster.job_state('unknown_state'))
+
+    def test_job_status_from_snapshot(self):
+        jobs = cluster.ClusterJobs.__new__(cluster.ClusterJobs)
+        jobs.jobs = {'1': 'R', '2': 'Q'}
+        self.assertEqual(jobs.job_status('1.server'), 'R')
+        self.assertEqual(jobs.job_status('2'), 'Q')
+        self.assertEqual(self.queried, [])
+
+        # Not in the snapshot: confirmed with a single query
+        self.assertEqual(jobs.job_status('3'), 'C')
+        self.assertEqual(self.queried, ['3'])
+
+    def test_job_status_without_snapshot(self):
+        jobs = cluster.ClusterJobs.__new__(cluster.ClusterJobs)
+        jobs.jobs = None
+        jobs.job_status('1')
+        jobs.job_status('2')
+        self.assertEqual(self.queried, ['1', '2'])
+
+
+# Output of qstat -g d -u $USER on SGE with the job array 4242 (elements 1
+# and 2 running, 3 and 4 waiting) and two jobs 4250 and 4251
+SGE_QSTAT = """\
+job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID 
+-----------------------------------------------------------------------------------------------------------------
+   4242 0.55500 array_1_4. masispider   r     10/17/2026 09:12:03 all.q@node01.cluster               1 1
+   4242 0.55500 array_1_4. masispider   r     10/17/2026 09:12:03 all.q@node02.cluster               1 2
+   4250 0.55500 proc.pbs   masispider   r     10/17/2026 09:13:41 all.q@node03.cluster               1        
+   4242 0.00000 array_1_4. masispider   qw    10/17/2026 09:11:58                                    1 3
+   4242 0.00000 array_1_4. masispider   qw    10/17/2026 09:11:58                                    1 4
+   4251 0.00000 proc2.pbs  masispider   qw    10/17/2026 09:14:02                                    1        
+"""
+
+
+class FakeSGESettings(object):
+
+    def __init__(self):
+        self.templates = os.path.join(os.path.dirname(cluster.__file__),
+                                      'templates', 'SGE')
+
+    def read(self, filename):
+        with open(os.path.join(self.templates, filename)) as f_obj:
+            return f_obj.read()
+
+    def get_cmd_submit(self):
+        return 'qsub'
+
+    def get_cmd_list_jobs(self):
+        return self.read('cmd_list_jobs.txt')
+
+    def get_cmd_get_job_status(self):
+        return Template(self.read('cmd_get_job_status.txt'))
+
+    def get_running_status(self):
+        return 'r'
+
+    def get_queue_status(self):
+        return 'qw'
+
+    def get_complete_status(self):
+        return ''
+
+
+class SGEJobArrayTest(TestCase):
+
+    def setUp(self):
+        self.bin_dir = tempfile.mkdtemp()
+        for cmd, output in [('qstat', SGE_QSTAT), ('qsub', '')]:
+            path = os.path.join(self.bin_dir, cmd)
+            with open(path, 'w') as f_obj:
+                f_obj.write("#!/bin/sh\ncat <<'EOF'\n%sEOF\n" % output)
+            os.chmod(path, 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join([self.bin_dir, self.path])
+        self.settings = cluster.DAX_SETTINGS
+        cluster.DAX_SETTINGS = FakeSGESettings()
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        cluster.DAX_SETTINGS = self.settings
+        shutil.rmtree(self.bin_dir)
+
+    def test_list_jobs(self):
+        self.assertEqual(cluster.list_jobs(),
+                         {'4242.1': 'R', '4242.2': 'R', '4242.3': 'Q',
+                          '4242.4': 'Q', '4250': 'R', '4251': 'Q'})
+
+    def test_job_status(self):
+        self.assertEqual(cluster.job_status('4242.2'), 'R')
+        self.assertEqual(cluster.job_status('4242.4'), 'Q')
+        self.assertEqual(cluster.job_status('4251'), 'Q')
+        # Element of the array out of the queue
+        self.assertEqual(cluster.job_status('4242.5'), 'C')
@@ -0,0 +1,182 @@
+from unittest import TestCase
+
+from dax import dax_tools_utils, XnatUtils
+
+
+class FakeInterface(object):
+    host = 'http://xnat'
+    user = 'user'
+    pwd = 'pwd'
+
+    def disconnect(self):
+        pass
+
+
+class FakeSettings(object):
+    def __init__(self, upload_threads):
+        self.upload_threads = upload_threads
+
+    def get_upload_threads(self):
+        return self.upload_threads
+
+
+def fake_upload_assessor(xnat, assessor_dict, assessor_path):
+    if not isinstance(xnat, FakeInterface):
+        raise ValueError('no connection')
+    if assessor_dict['label'].endswith('Fail'):
+        raise ValueError('upload failed')
+    return not assessor_dict['label'].endswith('Skip')
+
+
+class UploadAssessorsTest(TestCase):
+
+    def setUp(self):
+        self.saved = (dax_tools_utils.get_assessor_list,
+                      dax_tools_utils.upload_assessor,
+                      dax_tools_utils.DAX_SETTINGS,
+                      XnatUtils.get_interface)
+        dax_tools_utils.get_assessor_list = lambda projects: [
+            'proj-x-subj-x-sess-x-Proc_v1-x-Ok',
+            'proj-x-subj-x-sess-x-Proc_v1-x-Skip',
+            'proj-x-subj-x-sess-x-Proc_v1-x-Fail']
+        dax_tools_utils.upload_assessor = fake_upload_assessor
+        XnatUtils.get_interface = lambda *args: FakeInterface()
+
+    def tearDown(self):
+        (dax_tools_utils.get_assessor_list,
+         dax_tools_utils.upload_assessor,
+         dax_tools_utils.DAX_SETTINGS,
+         XnatUtils.get_interface) = self.saved
+
+    def check_warnings(self, warnings):
+        self.assertEqual(len(warnings), 2)
+        self.assertIn('Skip', warnings[0])
+        self.assertIn('upload failed', warnings[1])
+
+    def test_serial(self):
+        dax_tools_utils.DAX_SETTINGS = FakeSettings('1')
+        self.check_warnings(
+            dax_tools_utils.upload_assessors(FakeInterface(), None))
+
+    def test_pool(self):
+        dax_tools_utils.DAX_SETTINGS = FakeSettings('2')
+        self.check_warnings(
+            dax_tools_utils.upload_assessors(FakeInterface(), None))
+
+    def test_pool_shutdown(self):
+        dax_tools_utils.DAX_SETTINGS = FakeSettings('2')
+        saved_pool = dax_tools_utils.Pool
+        try:
+            # Success: the workers exit normally and close their connection
+            dax_tools_utils.Pool = FakePool
+            self.check_warnings(
+                dax_tools_utils.upload_assessors(FakeInterface(), None))
+            self.assertEqual(FakePool.calls, ['close', 'join'])
+
+            # Error: the workers are killed
+            FakePool.fail = True
+            with self.assertRaises(RuntimeError):
+                dax_tools_utils.upload_assessors(FakeInterface(), None)
+            self.assertEqual(FakePool.calls, ['terminate', 'join'])
+        finally:
+            dax_tools_utils.Pool = saved_pool
+            dax_tools_utils.UPLOAD_WORKER.clear()
+            FakePool.fail = False
+
+
+class FakeAsyncResult(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def get(self):
+        return self.func(*self.args)
+
+
+class FakePool(object):
+    """Pool running the uploads in the process, recording its shutdown"""
+    calls = []
+    fail = False
+
+    def __init__(self, processes, initializer, initargs):
+        FakePool.calls = []
+        dax_tools_utils.UPLOAD_WORKER['intf'] = FakeInterface()
+
+    def apply_async(self, func, args):
+        if FakePool.fail:
+            raise RuntimeError('pool broken')
+        return FakeAsyncResult(func, args)
+
+    def close(self):
+        FakePool.calls.append('close')
+
+    def terminate(self):
+        FakePool.calls.append('terminate')
+
+    def join(self):
+        FakePool.calls.append('join')
+
+
+class FakeReferenceSettings(object):
+    def __init__(self, use_reference=False):
+        self.use_reference = use_reference
+
+    def get_use_reference(self):
+        return self.use_reference
+
+    def get_reference_mounts(self):
+        return [('/data', '/xnat/data'),
+                ('/data/results', '/xnat/results/')]
+
+
+class FakeAssessorObj(object):
+    def out_resource(self, resource):
+        return resource
+
+
+class UploadByReferenceTest(TestCase):
+
+    def setUp(self):
+        self.saved = (dax_tools_utils.DAX_SETTINGS,
+                      XnatUtils.upload_reference,
+                      XnatUtils.check_reference_upload)
+        dax_tools_utils.DAX_SETTINGS = FakeReferenceSettings()
+        self.references = []
+        self.verified = True
+        XnatUtils.upload_reference = \
+            lambda ref, assr, res: self.references.append(ref)
+        XnatUtils.check_reference_upload = lambda path, res: self.verified
+        dax_tools_utils.REFERENCE_MOUNTS_FAILED.clear()
+
+    def tearDown(self):
+        (dax_tools_utils.DAX_SETTINGS,
+         XnatUtils.upload_reference,
+         XnatUtils.check_reference_upload) = self.saved
+        dax_tools_utils.REFERENCE_MOUNTS_FAILED.clear()
+
+    def test_reference_path(self):
+        get_path = dax_tools_utils.get_reference_path
+        self.assertEqual(get_path('/data/results/assr/DATA'),
+                         '/xnat/results/assr/DATA')
+        self.assertEqual(get_path('/data/other/DATA'), '/xnat/data/other/DATA')
+        self.assertIsNone(get_path('/scratch/assr/DATA'))
+        self.assertIsNone(get_path('/database/assr/DATA'))
+
+    def test_fallback(self):
+        upload = dax_tools_utils.upload_resource_by_reference
+        assr = FakeAssessorObj()
+        self.assertFalse(upload(assr, 'DATA', '/scratch/assr/DATA'))
+        self.assertTrue(upload(assr, 'DATA', '/data/results/assr/DATA'))
+
+        # Not verified: the mount is not used anymore
+        self.verified = False
+        self.assertFalse(upload(assr, 'DATA', '/data/results/assr2/DATA'))
+        self.assertFalse(upload(assr, 'DATA', '/data/results/assr3/DATA'))
+        self.assertEqual(len(self.references), 2)
+
+    def test_use_reference_raises(self):
+        dax_tools_utils.DAX_SETTINGS = FakeReferenceSettings(True)
+        self.verified = False
+        self.assertRaises(XnatUtils.XnatUtilsError,
+                          dax_tools_utils.upload_resource_by_reference,
+                          FakeAssessorObj(), 'DATA', '/data/results/a/DATA')
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dax import diskq_store
+from dax.errors import DiskqError
+
+
+LABELS = ['proj1-x-subj1-x-sess1-x-Proc_v1-x-a',
+          'proj1-x-subj1-x-sess1-x-Proc_v1-x-b',
+          'proj2-x-subj2-x-sess2-x-Proc_v1-x-c']
+
+
+class DiskqStoreTest(TestCase):
+
+    def setUp(self):
+        self.diskq = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.diskq, 'BATCH'))
+        self.files = diskq_store.FileDiskqStore(self.diskq)
+        for label in LABELS:
+            open(os.path.join(self.diskq, 'BATCH',
+                              label + diskq_store.JOB_EXTENSION_FILE),
+                 'w').close()
+        self.files.set(LABELS[1], 'procstatus', 'JOB_RUNNING')
+        self.files.mset(LABELS[2], {'procstatus': 'NEED_TO_RUN',
+                                    'jobid': '1234'})
+
+    def tearDown(self):
+        shutil.rmtree(self.diskq)
+
+    def check_store(self, store):
+        self.assertEqual(
+            sorted(store.list_tasks('NEED_TO_RUN',
+                                    default_status='NEED_TO_RUN')),
+            [LABELS[0], LABELS[2]])
+        self.assertEqual(
+            store.list_tasks('NEED_TO_RUN', ['proj1'],
+                             default_status='NEED_TO_RUN'),
+            [LABELS[0]])
+        self.assertEqual(store.list_tasks('JOB_RUNNING'), [LABELS[1]])
+        self.assertEqual(store.get(LABELS[2], 'jobid'), '1234')
+        self.assertEqual(store.mget(LABELS[0], ['jobid', 'procstatus']),
+                         {'jobid': None, 'procstatus': None})
+
+        store.delete(LABELS[2], ['jobid'])
+        self.assertEqual(store.get(LABELS[2], 'jobid'), None)
+        self.assertEqual(store.get(LABELS[2], 'procstatus'), 'NEED_TO_RUN')
+
+    def test_files_store(self):
+        self.check_store(self.files)
+
+    def test_migrate_to_sqlite(self):
+        self.assertEqual(diskq_store.migrate_diskq(self.diskq), 3)
+        store = diskq_store.SqliteDiskqStore(self.diskq)
+        self.check_store(store)
+
+        store.delete(LABELS[0])
+        self.assertEqual(sorted(store.list_tasks()), LABELS[1:])
+        self.assertRaises(DiskqError, store.set, LABELS[1], 'bad;', 1)
+
+    def test_files_index(self):
+        # first listing builds the index from the batch files
+        self.assertEqual(self.files.list_tasks('JOB_RUNNING'), [LABELS[1]])
+        self.files.set(LABELS[0], 'procstatus', 'JOB_RUNNING')
+        self.files.set(LABELS[1], 'procstatus', 'COMPLETE')
+        self.assertEqual(self.files.list_tasks('JOB_RUNNING'), [LABELS[0]])
+        self.assertEqual(self.files.list_tasks(projects=['proj2']),
+                         [LABELS[2]])
+        index_dir = os.path.join(self.diskq, 'INDEX', 'status', 'COMPLETE')
+        self.assertEqual(os.listdir(index_dir), [LABELS[1]])
+
+        # the index is not read again from the attribute files
+        os.remove(os.path.join(self.diskq, 'procstatus', LABELS[1]))
+        self.assertEqual(self.files.list_tasks('COMPLETE'), [LABELS[1]])
+
+        # tasks deleted without the store are dropped from the index
+        os.remove(self.files.batch_path(LABELS[1]))
+        self.assertEqual(self.files.list_tasks('COMPLETE'), [])
+        self.assertEqual(os.listdir(index_dir), [])
+
+        self.files.delete(LABELS[0])
+        self.assertEqual(self.files.list_tasks('JOB_RUNNING'), [])
@@ -0,0 +1,142 @@
+import logging
+import random
+import time
+from unittest import TestCase
+
+from dax import launcher, task, XnatUtils
+
+
+class FakeWorkerInterface(object):
+    def __init__(self):
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class BuildSubjectsParallelTest(TestCase):
+
+    def setUp(self):
+        self.interfaces = []
+        self.get_interface = XnatUtils.get_interface
+
+        def get_interface(*args, **kwargs):
+            intf = FakeWorkerInterface()
+            self.interfaces.append(intf)
+            return intf
+        XnatUtils.get_interface = get_interface
+
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger('dax')
+        self.level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        XnatUtils.get_interface = self.get_interface
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+
+    def test_ordered_logs_and_worker_interfaces(self):
+        lchr = launcher.Launcher.__new__(launcher.Launcher)
+        lchr.build_threads = 3
+        lchr.xnat_host = lchr.xnat_user = lchr.xnat_pass = None
+        used = []
+
+        def build_subject(intf, sessions, sessions_to_update, *args,
+                          **kwargs):
+            used.append(intf)
+            time.sleep(random.random() / 100)
+            launcher.LOGGER.info('built %s' % sessions[0])
+        lchr.build_subject = build_subject
+
+        subjects = [('subj%d' % i, ['sess%d' % i], {}) for i in range(10)]
+        lchr.build_subjects_parallel(subjects, ())
+
+        built = [m for m in self.handler.messages if m.startswith('built')]
+        self.assertEqual(built, ['built sess%d' % i for i in range(10)])
+        self.assertTrue(1 <= len(self.interfaces) <= 3)
+        self.assertEqual(set(used), set(self.interfaces))
+        self.assertTrue(all(i.disconnected for i in self.interfaces))
+
+
+class FakeLaunchTask(object):
+    def __init__(self, label, launched):
+        self.assessor_label = label
+        self.launched = launched
+
+    def launch(self, force_no_qsub=False):
+        self.launched.append(self.assessor_label)
+        return True
+
+
+class LaunchTasksTest(TestCase):
+
+    def setUp(self):
+        self.count_jobs = launcher.cluster.count_jobs
+        self.command_found = launcher.cluster.command_found
+        self.counts = []
+
+        def count_jobs():
+            self.counts.append(len(self.launched))
+            return len(self.launched)
+        launcher.cluster.count_jobs = count_jobs
+        launcher.cluster.command_found = lambda cmd: True
+        self.launched = []
+
+    def tearDown(self):
+        launcher.cluster.count_jobs = self.count_jobs
+        launcher.cluster.command_found = self.command_found
+
+    def test_local_counter(self):
+        lchr = launcher.Launcher.__new__(launcher.Launcher)
+        lchr.launcher_type = 'diskq-combined'
+        lchr.queue_limit = 120
+        tasks = [FakeLaunchTask('assr%d' % i, self.launched)
+                 for i in range(200)]
+        lchr.launch_tasks(tasks)
+
+        self.assertEqual(len(self.launched), 120)
+        self.assertEqual(len(tasks), 80)
+        # initial count, every LAUNCH_RECONCILE_EVERY jobs and at the limit
+        self.assertEqual(self.counts, [0, 50, 100, 120])
+
+
+class FakeUpdateTask(task.ClusterTask):
+    def __init__(self, label, status, new_status):
+        self.assessor_label = label
+        self.status = status
+        self.new_status = new_status
+
+    def get_status(self):
+        raise AssertionError('update_task must not read the status again')
+
+    def update_status(self, jobs=None):
+        if self.new_status is None:
+            raise ValueError('update failed')
+        return self.status, self.new_status
+
+
+class UpdateTaskListTest(TestCase):
+
+    def test_summary(self):
+        lchr = launcher.Launcher.__new__(launcher.Launcher)
+        lchr.update_threads = 3
+        running = task.JOB_RUNNING
+        tasks = [FakeUpdateTask('a', running, task.READY_TO_UPLOAD),
+                 FakeUpdateTask('b', running, running),
+                 FakeUpdateTask('c', running, None),
+                 FakeUpdateTask('d', task.COMPLETE, task.COMPLETE),
+                 FakeUpdateTask('e', running, task.JOB_FAILED)]
+        summary = lchr.update_task_list(tasks)
+        self.assertEqual(summary, {'changed': 2, 'unchanged': 1,
+                                   'errored': 1, 'skipped': 1})
@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dax.listing_cache import ProjectSnapshotCache
+
+
+class ListingCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = ProjectSnapshotCache(
+            os.path.join(self.tmp_dir, 'cache', 'snapshot.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.get('proj1', 'sessions'))
+        rows = [{'ID': 'sess1', 'label': 'label1'}]
+        self.cache.put('proj1', 'sessions', rows)
+        self.assertEqual(self.cache.get('proj1', 'sessions'), rows)
+        self.cache.put('proj1', 'sessions', [])
+        self.assertEqual(self.cache.get('proj1', 'sessions'), [])
+
+    def test_invalidate(self):
+        self.cache.put('proj1', 'sessions', [])
+        self.cache.put('proj2', 'sessions', [])
+        self.cache.invalidate(project='proj1')
+        self.assertIsNone(self.cache.get('proj1', 'sessions'))
+        self.assertEqual(self.cache.get('proj2', 'sessions'), [])
@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dax.mirror_state import MirrorSyncState
+
+
+class MirrorSyncStateTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state = MirrorSyncState(
+            os.path.join(self.tmp_dir, 'mirror', 'sync_state.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_modified(self):
+        sessions = [{'ID': 'sess1', 'last_modified': '2019-01-01'},
+                    {'ID': 'sess2', 'last_modified': '2019-01-02'},
+                    {'ID': 'sess3', 'last_modified': None}]
+        host = 'https://xnat'
+        self.assertEqual(self.state.modified(host, 'proj1', sessions),
+                         sessions)
+
+        self.state.set_synced(host, 'proj1', 'sess1', '2019-01-01')
+        self.state.set_synced(host, 'proj1', 'sess2', '2019-01-01')
+        self.assertEqual(self.state.modified(host, 'proj1', sessions),
+                         sessions[1:])
+
+        # Per host and project
+        self.assertEqual(self.state.modified(host, 'proj2', sessions),
+                         sessions)
+        self.assertEqual(self.state.modified('https://other', 'proj1',
+                                             sessions), sessions)
+
+        self.state.invalidate(host, 'proj1')
+        self.assertEqual(self.state.get_synced(host, 'proj1'), {})
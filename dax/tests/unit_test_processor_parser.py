@@ -1,16 +1,21 @@
 from unittest import TestCase
 
 import copy
+import json
+import threading
 
 import StringIO
 import yaml
 import itertools
 
-from dax.processor_parser import ProcessorParser
+from dax.processor_parser import ProcessorParser, ParserArtefact
+from dax.processor_parser import SelectSessionParameters
 from dax.processors import AutoProcessor
 from dax.tests import unit_test_entity_common as common
 from dax.tests import unit_test_common_processor_yamls as yamls
+from dax import XnatUtils
 from dax import yaml_doc
+from dax.task import JOB_RUNNING, NeedInputsException
 
 
 # test matrix
@@ -178,6 +183,26 @@ class TestSession:
     def assessors(self):
         return self.assessors_
 
+    def scans_by_type(self):
+        scans_by_type = {}
+        for s in self.scans_:
+            scans_by_type.setdefault(s.type(), []).append(s)
+        return scans_by_type
+
+    def assessors_by_proctype(self):
+        assessors_by_proctype = {}
+        for a in self.assessors_:
+            assessors_by_proctype.setdefault(a.type(), []).append(a)
+        return assessors_by_proctype
+
+    def assessors_by_inputs(self):
+        assessors_by_inputs = {}
+        for a in self.assessors_:
+            if a.get_inputs() is not None:
+                key = XnatUtils.serialize_inputs(a.get_inputs())
+                assessors_by_inputs.setdefault(key, []).append(a)
+        return assessors_by_inputs
+
     def project_id(self):
         return self.project_id_
 
@@ -513,10 +538,10 @@ class ProcessorParserUnitTests(TestCase):
         #     ProcessorParser.parse_variables(inputs)
         # print "variables_to_inputs =", variables_to_inputs
 
-        parameter_matrix = \
+        parameter_matrix = list(
             ProcessorParser.generate_parameter_matrix(
                 inputs, iteration_sources, iteration_map,
-                artefacts, artefacts_by_input)
+                artefacts, artefacts_by_input))
         print "parameter_matrix =", parameter_matrix
 
         assessor_parameter_map = \
@@ -813,3 +838,196 @@ class ProcessorParserUnitTests(TestCase):
               "It must be one of 'all', 'some'")]
         self.assertEqual(errors, expected)
 
+
+
+    def test_compare_to_existing(self):
+        def make_assessor(label, proctype, inputs):
+            assessor = TestArtefact()
+            assessor.label_ = label
+            assessor.artefact_type = proctype
+            assessor.inputs = inputs
+            return assessor
+
+        scan_1 = scan_path.format(proj, subj, sess, '1')
+        scan_2 = scan_path.format(proj, subj, sess, '2')
+        parameter_matrix = [{'t1': scan_1, 'all': [scan_1, scan_2]},
+                            {'t1': scan_2, 'all': [scan_1, scan_2]}]
+        csess = TestSession()
+        csess.assessors_ = [
+            make_assessor('asr1', 'proc1',
+                          {u'all': [u'' + scan_1, scan_2], u't1': scan_2}),
+            make_assessor('asr2', 'proc1',
+                          {'t1': scan_2, 'all': [scan_1, scan_2]}),
+            make_assessor('asr3', 'proc1', {'t1': scan_1, 'all': [scan_1]}),
+            make_assessor('asr4', 'proc2', {'t1': scan_1}),
+        ]
+
+        mapping = ProcessorParser.compare_to_existing(
+            [csess], 'proc1', parameter_matrix)
+        self.assertEqual([p for p, _ in mapping], parameter_matrix)
+        self.assertEqual([[a.label() for a in p_assrs]
+                          for _, p_assrs in mapping],
+                         [[], ['asr1', 'asr2']])
+
+        csess.assessors_.append(make_assessor('asr5', 'proc1', None))
+        self.assertIsNone(ProcessorParser.compare_to_existing(
+            [csess], 'proc1', parameter_matrix))
+
+
+    def test_generate_parameter_matrix_filters(self):
+        scans = [scan_path.format(proj, subj, sess, s) for s in '123']
+        inputs = {'a': {'required': True, 'select': ['foreach']},
+                  'b': {'required': True, 'select': ['foreach']},
+                  'c': {'required': False, 'select': ['all']}}
+        artefacts_by_input = {'a': scans, 'b': scans[1:], 'c': scans[:2]}
+        match_filters = [['a', 'b']]
+
+        parameter_matrix = list(ProcessorParser.generate_parameter_matrix(
+            inputs, ['a', 'b', 'c'], {}, {}, artefacts_by_input))
+        self.assertEqual(len(parameter_matrix), 6)
+
+        filtered = list(ProcessorParser.generate_parameter_matrix(
+            inputs, ['a', 'b', 'c'], {}, {}, artefacts_by_input,
+            match_filters))
+        self.assertEqual(
+            filtered,
+            [{'a': scans[1], 'b': scans[1], 'c': scans[:2]},
+             {'a': scans[2], 'b': scans[2], 'c': scans[:2]}])
+        self.assertEqual(
+            filtered,
+            [p for p in parameter_matrix
+             if ProcessorParser.filter_matches(['a', 'b'], p, {})])
+
+        artefacts_by_input['b'] = []
+        self.assertEqual(list(ProcessorParser.generate_parameter_matrix(
+            inputs, ['a', 'b', 'c'], {}, {}, artefacts_by_input,
+            match_filters)), [])
+
+
+    def test_inputs_from_cached_session(self):
+        class FakeCachedArtefact:
+            def __init__(self, entity_type, info, resources):
+                self.entity_type_ = entity_type
+                self.info_ = info
+                self.resources_ = resources
+
+            def entity_type(self):
+                return self.entity_type_
+
+            def info(self):
+                return self.info_
+
+            def resources(self):
+                return self.resources_
+
+        class FakeObject:
+            def __init__(self, intf, path):
+                intf.selected.append(path)
+
+            def files(self):
+                return ['file.txt']
+
+        class FakeInterface:
+            def __init__(self):
+                self.selected = []
+
+            def select(self, path):
+                return FakeObject(self, path)
+
+        class FakeAttrs:
+            def __init__(self, inputs):
+                self.inputs = inputs
+
+            def get(self, name):
+                return json.dumps(self.inputs)
+
+        class FakeAssessor:
+            def __init__(self, inputs):
+                self._intf = FakeInterface()
+                self.attrs = FakeAttrs(inputs)
+
+            def datatype(self):
+                return 'proc:genProcData'
+
+        t1_path = scan_path.format(proj, subj, sess, '1')
+        asr_path = assessor_path.format(proj, subj, sess, 'proc1-asr1')
+        cscan = FakeCachedArtefact('scan', {'quality': 'usable'},
+                                   [TestResource('NIFTI', 2)])
+        cassr = FakeCachedArtefact(
+            'assessor', {'procstatus': 'COMPLETE', 'qcstatus': 'Passed'},
+            [TestResource('DATA', None)])
+
+        class CachedParser(ProcessorParser):
+            def __init__(self):
+                self.parse_results_ = threading.local()
+
+        parser = CachedParser()
+        parser.inputs = {
+            't1': {'artefact_type': 'scan', 'needs_qc': True,
+                   'resources': [{'resource': 'NIFTI'}]},
+            'asr': {'artefact_type': 'assessor', 'needs_qc': False,
+                    'resources': [{'resource': 'DATA'}]}}
+        parser.variables_to_inputs = {}
+        artefacts = {t1_path: ParserArtefact(t1_path, {}, cscan),
+                     asr_path: ParserArtefact(asr_path, {}, cassr)}
+
+        assr = FakeAssessor({'t1': t1_path, 'asr': asr_path})
+        self.assertEqual(parser.has_inputs(assr, artefacts), (1, []))
+        # only the file count missing from the XML is queried on XNAT
+        self.assertEqual(assr._intf.selected,
+                         [assessor_path_r.format(proj, subj, sess,
+                                                 'proc1-asr1', 'DATA')])
+
+        self.assertEqual(parser.find_inputs(assr, artefacts), ({}, []))
+
+        # default to the artefacts parsed by this thread
+        parser.artefacts = artefacts
+        cscan.info_['quality'] = 'unusable'
+        self.assertEqual(parser.has_inputs(assr), (0, [('t1', ' not usable')]))
+
+        cassr.info_['procstatus'] = JOB_RUNNING
+        self.assertRaises(NeedInputsException, parser.find_inputs, assr)
+
+
+    def test_map_artefacts_to_inputs_order(self):
+        csess = TestSession()
+        csess.scans_ = []
+        csess.assessors_ = []
+        for label, proctype in [('asr1', 'proc1'), ('asr2', 'proc2'),
+                                ('asr3', 'proc1')]:
+            assessor = TestArtefact()
+            assessor.test_obj_type = 'assessor'
+            assessor.proj, assessor.subj, assessor.sess = proj, subj, sess
+            assessor.label_ = label
+            assessor.artefact_type = proctype
+            csess.assessors_.append(assessor)
+
+        inputs = {'asrs': {'types': ['proc2', 'proc1'], 'select': ['all'],
+                           'select-session':
+                           SelectSessionParameters('current', 0)}}
+        artefacts_by_input = ProcessorParser.map_artefacts_to_inputs(
+            [csess], inputs, None)
+        self.assertEqual(
+            artefacts_by_input['asrs'],
+            [assessor_path.format(proj, subj, sess, label)
+             for label in ['asr1', 'asr2', 'asr3']])
+
+
+    def test_parse_results_per_thread(self):
+        class ThreadedParser(ProcessorParser):
+            def __init__(self):
+                self.parse_results_ = threading.local()
+
+        parser = ThreadedParser()
+        parser.artefacts = {'a': 1}
+        seen = []
+
+        def worker():
+            seen.append(parser.artefacts)
+            parser.artefacts = {'b': 2}
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [None])
+        self.assertEqual(parser.artefacts, {'a': 1})
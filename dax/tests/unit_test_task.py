@@ -0,0 +1,206 @@
+import json
+import os
+import shutil
+import tempfile
+from string import Template
+from unittest import TestCase
+
+from dax import cluster, task
+
+
+PARAMS = {'walltime_str': '01:00:00', 'mem_mb': 2048, 'ppn': 1,
+          'env': '/tmp/env.sh', 'email': None, 'email_options': 'a',
+          'xnat_host': 'http://xnat', 'job_template': None}
+
+
+class FakeSettings(object):
+
+    def get_job_template(self, filepath=None):
+        return Template('#!/bin/bash\n${job_cmds}\n')
+
+    def get_job_array_option(self):
+        return Template('--array=1-${array_size}')
+
+    def get_job_array_jobid(self):
+        return Template('${jobid}_${index}')
+
+
+class ClusterTaskArrayTest(TestCase):
+
+    def setUp(self):
+        self.diskq = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.diskq, task.BATCH_DIRNAME))
+        os.mkdir(os.path.join(self.diskq, task.JOBPARAMS_DIRNAME))
+        self.settings = cluster.DAX_SETTINGS
+        self.submit_job = cluster.submit_job
+        cluster.DAX_SETTINGS = FakeSettings()
+        self.submitted = []
+
+        def submit_job(filename, outlog=None, force_no_qsub=False,
+                       options=None):
+            self.submitted.append((filename, options))
+            return '123', False
+        cluster.submit_job = submit_job
+
+    def tearDown(self):
+        cluster.DAX_SETTINGS = self.settings
+        cluster.submit_job = self.submit_job
+        shutil.rmtree(self.diskq)
+
+    def make_task(self, label, params):
+        open(os.path.join(self.diskq, task.BATCH_DIRNAME,
+                          label + task.JOB_EXTENSION_FILE), 'w').close()
+        if params is not None:
+            params = dict(params, cmds=['echo %s' % label])
+            with open(os.path.join(self.diskq, task.JOBPARAMS_DIRNAME,
+                                   label + '.json'), 'w') as f_obj:
+                json.dump(params, f_obj)
+        return task.ClusterTask(label, self.diskq, self.diskq)
+
+    def test_group_and_launch(self):
+        tasks = [self.make_task('proj-x-subj-x-sess%d-x-Proc' % i, PARAMS)
+                 for i in range(3)]
+        other = self.make_task('proj-x-subj-x-sess-x-Other',
+                               dict(PARAMS, mem_mb=4096))
+        old = self.make_task('proj-x-subj-x-sess-x-Old', None)
+
+        grouped = task.group_task_arrays(tasks[:2] + [other, old, tasks[2]])
+        self.assertEqual(len(grouped), 3)
+        self.assertEqual(grouped[0].tasks, tasks)
+        self.assertEqual(grouped[1].tasks, [other])
+        self.assertIs(grouped[2], old)
+
+        first, rest = grouped[0].split(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(rest.tasks, [tasks[2]])
+
+        self.assertTrue(grouped[0].launch())
+        self.assertEqual(len(self.submitted), 1)
+        self.assertEqual(self.submitted[0][1], '--array=1-3')
+        for index, cur_task in enumerate(tasks, 1):
+            self.assertEqual(cur_task.get_jobid(), '123_%d' % index)
+            self.assertEqual(cur_task.get_status(), task.JOB_RUNNING)
+
+        array_dir = grouped[0].array_dir()
+        with open(os.path.join(array_dir, cluster.ARRAY_MANIFEST)) as f_obj:
+            manifest = f_obj.read().splitlines()
+        self.assertEqual(manifest[1], '2 %s' % tasks[1].assessor_label)
+        with open(os.path.join(array_dir, '3.sh')) as f_obj:
+            script = f_obj.read()
+        self.assertIn(tasks[2].outlog_path(), script)
+        self.assertIn('echo %s' % tasks[2].assessor_label, script)
+
+    def test_update_status(self):
+        cur_task = self.make_task('proj-x-subj-x-sess-x-Proc', PARAMS)
+        cur_task.set_status('BOGUS')
+        warnings = []
+        warn = task.LOGGER.warn
+        task.LOGGER.warn = warnings.append
+        try:
+            statuses = cur_task.update_status()
+        finally:
+            task.LOGGER.warn = warn
+        self.assertEqual(statuses, ('BOGUS', 'BOGUS'))
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('unknown status', warnings[0])
+
+
+class SubmittedJobidTest(TestCase):
+
+    def test_sge(self):
+        prefix, suffix = 'Your job ', '("'
+        output = 'Your job 1234 ("proc.pbs") has been submitted\n'
+        self.assertEqual(
+            cluster.get_submitted_jobid(output, prefix, suffix).strip(),
+            '1234')
+        output = ('Your job-array 1234.1-10:1 ("array_1_10.pbs") has been '
+                  'submitted\n')
+        self.assertEqual(cluster.get_submitted_jobid(output, prefix, suffix),
+                         '1234')
+
+    def test_slurm(self):
+        output = 'Submitted batch job 5678\n'
+        self.assertEqual(cluster.get_submitted_jobid(
+            output, 'Submitted batch job ', '\n'), '5678')
+
+
+class FakeAttrs(object):
+
+    def __init__(self, values):
+        self.values = values
+        self.msets = []
+
+    def get(self, name):
+        return self.values.get(name, '')
+
+    def mget(self, names):
+        return [self.values.get(name, '') for name in names]
+
+    def mset(self, attrs):
+        self.msets.append(dict(attrs))
+        self.values.update(attrs)
+
+
+class FakeAssessor(object):
+
+    def __init__(self, values):
+        self.attrs = FakeAttrs(values)
+
+
+class TaskBufferedAttrsTest(TestCase):
+
+    def make_task(self, values):
+        cur_task = task.Task.__new__(task.Task)
+        cur_task.atype = 'proc:genprocdata'
+        cur_task.assessor = FakeAssessor(values)
+        cur_task.assessor_label = 'proj-x-subj-x-sess-x-Proc'
+        return cur_task
+
+    def test_single_mset(self):
+        cur_task = self.make_task({})
+        with cur_task.buffered_attrs():
+            cur_task.set_launch('123')
+            cur_task.set_status(task.JOB_FAILED)
+            with cur_task.buffered_attrs():
+                cur_task.set_jobnode('node1')
+            self.assertEqual(cur_task.assessor.attrs.msets, [])
+
+        self.assertEqual(len(cur_task.assessor.attrs.msets), 1)
+        values = cur_task.assessor.attrs.values
+        self.assertEqual(values['proc:genprocdata/procstatus'],
+                         task.JOB_FAILED)
+        self.assertEqual(values['proc:genprocdata/jobid'], '123')
+        self.assertEqual(values['proc:genprocdata/jobnode'], 'node1')
+
+        # Not buffered: written right away
+        cur_task.set_memused('1024')
+        self.assertEqual(len(cur_task.assessor.attrs.msets), 2)
+
+    def test_get_in_block(self):
+        cur_task = self.make_task({'proc:genprocdata/jobid': '1'})
+        cur_task.assessor.exists = lambda: True
+        with cur_task.buffered_attrs():
+            cur_task.set_launch('123')
+            self.assertEqual(cur_task.get_jobid(), '123')
+            self.assertEqual(cur_task.get_statuses(),
+                             (task.JOB_RUNNING, '', '123'))
+        self.assertEqual(cur_task.get_jobid(), '123')
+
+    def test_discard_on_error(self):
+        cur_task = self.make_task({})
+        with self.assertRaises(ValueError):
+            with cur_task.buffered_attrs():
+                cur_task.set_status(task.JOB_FAILED)
+                raise ValueError('transition failed')
+        self.assertEqual(cur_task.assessor.attrs.msets, [])
+        self.assertIsNone(cur_task.pending_attrs)
+
+    def test_check_job_usage(self):
+        cur_task = self.make_task({'proc:genprocdata/jobid': '123',
+                                   'proc:genprocdata/jobstartdate':
+                                   '2000-01-01'})
+        cur_task.check_job_usage()
+        self.assertEqual(cur_task.assessor.attrs.msets, [{
+            'proc:genprocdata/walltimeused': 'NotFound',
+            'proc:genprocdata/memused': 'NotFound',
+            'proc:genprocdata/jobnode': 'NotFound'}])
@@ -2,9 +2,13 @@
 from unittest import TestCase
 
 import itertools
+import os
+import shutil
+import tempfile
 
 
 from dax import XnatUtils
+from dax.listing_cache import ProjectSnapshotCache
 
 
 class InterfaceTempUnitTests(TestCase):
@@ -92,3 +96,169 @@ class InterfaceTempUnitTests(TestCase):
                     t[1],
                     XnatUtils.InterfaceTemp.object_type_from_path(instr),
                     'unexpected object type')
+
+
+class FakeListingInterface(XnatUtils.InterfaceTemp):
+    """InterfaceTemp answering the listing queries from local dictionaries"""
+    def __init__(self, responses):
+        self.responses = responses
+        self.queries = []
+        self.listing_cache = None
+        self.listing_context = None
+
+    def _get_json(self, uri):
+        self.queries.append(uri)
+        for prefix, rows in self.responses:
+            if prefix in uri:
+                return [dict(row) for row in rows]
+        return []
+
+
+def get_listing_responses():
+    base = {'URI': '', 'subject_label': 'subj1', 'subject_ID': 'S1',
+            'modality': '', 'project': 'proj1', 'date': '',
+            'xsiType': 'xnat:mrSessionData'}
+    subj = {'ID': 'S1', 'project': 'proj1', 'label': 'subj1',
+            'handedness': 'R', 'gender': 'F', 'yob': '1980', 'dob': '',
+            'src': ''}
+    return [('/experiments?', [dict(base, ID='E1', label='sess1')]),
+            ('/subjects?', [subj])]
+
+
+class InterfaceTempListingTests(TestCase):
+
+    def test_listing_context_memoizes(self):
+        intf = FakeListingInterface(get_listing_responses())
+        with XnatUtils.ProjectListingContext(intf) as context:
+            self.assertIs(intf.listing_context, context)
+            sessions = context.get_sessions('proj1')
+            intf.get_sessions_index('proj1')
+            intf.get_sessions('proj1')
+            self.assertEqual(len(sessions), 1)
+            self.assertEqual(len(intf.queries), 3)
+        self.assertIsNone(intf.listing_context)
+
+        intf.get_sessions('proj1')
+        self.assertEqual(len(intf.queries), 6)
+
+    def test_get_sessions_by_type(self):
+        base = {'URI': '', 'subject_label': 'subj1', 'subject_ID': 'S1',
+                'modality': '', 'project': 'proj1', 'date': ''}
+        mr = dict(base, ID='E1', label='sess1', xsiType='xnat:mrSessionData')
+        ct = dict(base, ID='E2', label='sess2', xsiType='xnat:ctSessionData')
+        other = dict(base, ID='E3', label='sess3',
+                     xsiType='xnat:qcAssessmentData')
+        mr_type = dict(mr, **{'xnat:mrsessiondata/age': '30',
+                              'xnat:mrsessiondata/meta/last_modified':
+                              '2018-02-01 00:00:00',
+                              'xnat:mrsessiondata/original': 'orig'})
+        ct_type = dict(ct, **{'xnat:ctsessiondata/age': '31'})
+        other_type = dict(other, **{
+            'xnat:qcassessmentdata/meta/last_modified':
+            '2018-01-01 00:00:00'})
+        subj = {'ID': 'S1', 'project': 'proj1', 'label': 'subj1',
+                'handedness': 'R', 'gender': 'F', 'yob': '1980', 'dob': '',
+                'src': ''}
+        intf = FakeListingInterface([
+            ('?columns=xsiType', [mr, ct, other]),
+            ('/experiments?columns=ID,', [mr_type, ct_type, other_type]),
+            ('/subjects?', [subj])])
+
+        sessions = intf.get_sessions('proj1')
+
+        # types, sessions of all the types, subjects
+        self.assertEqual(len(intf.queries), 3)
+        for stype in ['xnat:mrsessiondata', 'xnat:ctsessiondata',
+                      'xnat:qcassessmentdata']:
+            self.assertIn('%s/meta/last_modified' % stype, intf.queries[1])
+        self.assertEqual([s['session_label'] for s in sessions],
+                         ['sess1', 'sess2', 'sess3'])
+        self.assertEqual([s['session_type'] for s in sessions],
+                         ['MR', 'CT', 'xnat:qcassessmentdata'])
+        self.assertEqual(sessions[0]['last_modified'], '2018-02-01 00:00:00')
+        self.assertEqual(sessions[0]['last_updated'], 'orig')
+        self.assertEqual(sessions[1]['age'], '31')
+        self.assertEqual(sessions[2]['last_modified'], '2018-01-01 00:00:00')
+        self.assertEqual(sessions[2]['gender'], 'F')
+        self.assertEqual(sorted(intf.get_sessions_index('proj1').keys()),
+                         ['E1', 'E2', 'E3'])
+
+    def test_listing_cache_sessions(self):
+        def session(sess_id, subj_id, label, last_modified):
+            return {'ID': sess_id, 'URI': '', 'subject_label': subj_id,
+                    'subject_ID': subj_id, 'modality': '',
+                    'project': 'proj1', 'date': '', 'label': label,
+                    'xsiType': 'xnat:mrSessionData',
+                    'xnat:mrsessiondata/meta/last_modified': last_modified}
+
+        def responses(sessions):
+            return [
+                ('/subjects/S1/experiments?',
+                 [sess for sess in sessions if sess['subject_ID'] == 'S1']),
+                ('/subjects/S2/experiments?',
+                 [sess for sess in sessions if sess['subject_ID'] == 'S2']),
+                ('?columns=xsiType', sessions),
+                ('?columns=ID,subject_ID,xsiType', sessions),
+                ('/experiments?columns=ID,', sessions),
+                ('/subjects?', [])]
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            sessions = [session('E1', 'S1', 'sess1', '1'),
+                        session('E2', 'S2', 'sess2', '1')]
+            intf = FakeListingInterface(responses(sessions))
+            intf.listing_cache = ProjectSnapshotCache(
+                os.path.join(tmp_dir, 'snapshot.db'))
+            self.assertEqual(len(intf.get_sessions('proj1')), 2)
+            self.assertEqual(len(intf.queries), 3)
+
+            # Nothing changed: last_modified dates and subjects only
+            intf.queries = []
+            self.assertEqual(len(intf.get_sessions('proj1')), 2)
+            self.assertEqual(len(intf.queries), 2)
+            self.assertIn('xnat:mrsessiondata/meta/last_modified',
+                          intf.queries[0])
+
+            # E2 changed: only the sessions of S2 are queried again
+            sessions = [session('E1', 'S1', 'sess1-not-queried', '1'),
+                        session('E2', 'S2', 'sess2-new', '2')]
+            intf.responses = responses(sessions)
+            intf.queries = []
+            self.assertEqual(
+                [sess['label'] for sess in intf.get_sessions('proj1')],
+                ['sess1', 'sess2-new'])
+            self.assertEqual(len(intf.queries), 3)
+            self.assertIn('/subjects/S2/experiments?', intf.queries[1])
+
+            # E1 removed
+            intf.responses = responses(sessions[1:])
+            self.assertEqual(
+                [sess['label'] for sess in intf.get_sessions('proj1')],
+                ['sess2-new'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_get_sessions_last_modified(self):
+        class FakeInspect(object):
+            def datatypes(self):
+                return []
+
+        base = {'URI': '', 'subject_label': 'subj1', 'subject_ID': 'S1',
+                'project': 'proj1', 'date': ''}
+        mr = dict(base, ID='E1', label='sess1', xsiType='xnat:mrSessionData')
+        other = dict(base, ID='E2', label='sess2',
+                     xsiType='xnat:qcAssessmentData')
+        intf = FakeListingInterface([
+            ('?columns=xsiType', [mr, other]),
+            ('/experiments?columns=ID,', [dict(mr, **{
+                'xnat:mrsessiondata/meta/last_modified':
+                '2018-02-01 00:00:00'}), other])])
+        intf.inspect = FakeInspect()
+
+        sessions = intf.get_sessions_last_modified('proj1')
+        self.assertEqual(len(intf.queries), 2)
+        self.assertNotIn('xnat:qcassessmentdata', intf.queries[1])
+        self.assertEqual(sessions, [
+            {'ID': 'E1', 'label': 'sess1', 'subject_label': 'subj1',
+             'xsiType': 'xnat:mrSessionData',
+             'last_modified': '2018-02-01 00:00:00'}])
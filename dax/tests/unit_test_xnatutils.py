@@ -1,6 +1,11 @@
 from unittest import TestCase
 
+import hashlib
 import json
+import os
+import shutil
+import tempfile
+import threading
 
 from dax import XnatUtils
 from dax import assessor_utils
@@ -55,3 +60,441 @@ class XnatUtilsUnitTest(TestCase):
             name = assessor_utils.full_label(*test_entries[t])
             self.assertEqual(test_names[t], name)
 
+    def test_compile_type_matcher(self):
+        matcher = XnatUtils.compile_type_matcher(['T1*', 'FLAIR'])
+        self.assertIs(matcher,
+                      XnatUtils.compile_type_matcher(['T1*', 'FLAIR']))
+        self.assertTrue(matcher.match('T1_MPRAGE'))
+        self.assertTrue(matcher.match('FLAIR'))
+        self.assertFalse(matcher.match('FLAIR_2'))
+        self.assertFalse(matcher.match('DTI'))
+        self.assertFalse(XnatUtils.compile_type_matcher([]).match('T1'))
+
+        matcher = XnatUtils.compile_type_matcher(['T[12]$', 'DTI'],
+                                                 full_regex=True)
+        self.assertTrue(matcher.match('T2'))
+        self.assertTrue(matcher.match('DTI_b1000'))
+        self.assertFalse(matcher.match('T3'))
+
+    def test_filter_list_dicts_regex(self):
+        scans = [{'type': 'T1'}, {'type': 'T2'}, {'type': 'DTI'}]
+        self.assertEqual(XnatUtils.filter_list_dicts_regex(
+            scans, 'type', ['T*', 'T1']), scans[:2])
+        self.assertEqual(XnatUtils.filter_list_dicts_regex(
+            scans, 'type', 'T*', nor=True), scans[2:])
+
+
+
+class FakeAttrs(object):
+    def __init__(self, intf):
+        self.intf = intf
+
+    def get(self, name):
+        return self.intf.last_modified
+
+
+class FakeExperiment(object):
+    def __init__(self, intf, label):
+        self.intf = intf
+        self.label = label
+        self.attrs = FakeAttrs(intf)
+
+    def get(self):
+        self.intf.fetched.append(self.label)
+        return ('<xnat:MRSession xmlns:xnat="http://nrg.wustl.edu/xnat" '
+                'ID="%s" label="%s" project="proj1"/>'
+                % (self.label, self.label))
+
+
+class FakePrefetchInterface(object):
+    def __init__(self):
+        self.host = self.user = self.pwd = None
+        self.fetched = []
+        self.disconnected = False
+        self.last_modified = '2019-01-01 10:00:00.0'
+
+    def select_experiment(self, proj, subj, sess):
+        return FakeExperiment(self, sess)
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+class SessionPrefetcherUnitTest(TestCase):
+
+    def setUp(self):
+        self.interfaces = []
+        self.get_interface = XnatUtils.get_interface
+
+        def get_interface(*args, **kwargs):
+            intf = FakePrefetchInterface()
+            self.interfaces.append(intf)
+            return intf
+        XnatUtils.get_interface = get_interface
+
+    def tearDown(self):
+        XnatUtils.get_interface = self.get_interface
+
+    def test_get_element_datatype(self):
+        xml = '<{tag} xmlns:xnat="http://nrg.wustl.edu/xnat"/>'
+        tests = [('xnat:MRSession', 'xnat:mrSessionData'),
+                 ('xnat:PETSession', 'xnat:petSessionData'),
+                 ('xnat:CTSession', 'xnat:ctSessionData')]
+        for tag, datatype in tests:
+            element = XnatUtils.ET.fromstring(xml.format(tag=tag))
+            self.assertEqual(XnatUtils.get_element_datatype(element), datatype)
+
+    def test_load_parallel(self):
+        intf = FakePrefetchInterface()
+        sessions = [{'ID': 'ID%d' % i, 'project_label': 'proj1',
+                     'subject_label': 'subj1', 'session_label': 'sess%d' % i,
+                     'xsiType': 'xnat:mrSessionData',
+                     'insert_date': '2019-01-0%d' % i} for i in range(1, 6)]
+        with XnatUtils.SessionPrefetcher(intf, 3) as prefetcher:
+            csesses = prefetcher.load(intf, sessions)
+
+        self.assertEqual([c.label() for c in csesses],
+                         ['sess%d' % i for i in range(1, 6)])
+        self.assertEqual(csesses[0].creation_timestamp(), '2019-01-01')
+        self.assertEqual(csesses[0].datatype(), 'xnat:mrSessionData')
+        self.assertEqual(intf.fetched, [])
+        self.assertTrue(1 <= len(self.interfaces) <= 3)
+        self.assertTrue(all(i.disconnected for i in self.interfaces))
+        fetched = sum([i.fetched for i in self.interfaces], [])
+        self.assertEqual(sorted(fetched), ['sess%d' % i for i in range(1, 6)])
+
+    def test_load_shared_pool(self):
+        pools = []
+        thread_pool = XnatUtils.ThreadPool
+
+        def counting_pool(*args, **kwargs):
+            pools.append(1)
+            return thread_pool(*args, **kwargs)
+
+        intf = FakePrefetchInterface()
+        sessions = [{'ID': 'ID%d' % i, 'project_label': 'proj1',
+                     'subject_label': 'subj1', 'session_label': 'sess%d' % i,
+                     'xsiType': 'xnat:mrSessionData',
+                     'insert_date': '2019-01-0%d' % i} for i in range(1, 4)]
+        XnatUtils.ThreadPool = counting_pool
+        try:
+            with XnatUtils.SessionPrefetcher(intf, 2) as prefetcher:
+                threads = [threading.Thread(target=prefetcher.load,
+                                            args=(intf, sessions))
+                           for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertIsNotNone(prefetcher.pool)
+            self.assertIsNone(prefetcher.pool)
+        finally:
+            XnatUtils.ThreadPool = thread_pool
+        self.assertEqual(len(pools), 1)
+
+    def test_load_lazy(self):
+        intf = FakePrefetchInterface()
+        sessions = [{'ID': 'ID%d' % i, 'project_label': 'proj1',
+                     'subject_label': 'subj1', 'session_label': 'sess%d' % i,
+                     'xsiType': 'xnat:mrSessionData',
+                     'insert_date': '2019-01-0%d' % i} for i in range(1, 4)]
+        prefetcher = XnatUtils.SessionPrefetcher(intf)
+        csesses = prefetcher.load(intf, sessions, prefetch=['ID2'])
+
+        self.assertEqual(intf.fetched, ['sess2'])
+        self.assertEqual([c.label() for c in csesses],
+                         ['sess1', 'sess2', 'sess3'])
+        self.assertEqual(csesses[0].creation_timestamp(), '2019-01-01')
+        self.assertEqual(intf.fetched, ['sess2'])
+        self.assertEqual(csesses[2].scans(), [])
+        self.assertEqual(intf.fetched, ['sess2', 'sess3'])
+
+
+class CachedImageSessionUnitTest(TestCase):
+
+    def test_reload_if_modified(self):
+        intf = FakePrefetchInterface()
+        csess = XnatUtils.CachedImageSession.from_listing(
+            intf, {'project_label': 'proj1', 'subject_label': 'subj1',
+                   'session_label': 'sess1', 'xsiType': 'xnat:mrSessionData',
+                   'insert_date': '2019-01-01',
+                   'last_modified': '2019-01-01 10:00:00.0'})
+        self.assertTrue(csess.reload_if_modified())
+        self.assertFalse(csess.reload_if_modified())
+        intf.last_modified = '2019-01-02 10:00:00.0'
+        self.assertTrue(csess.reload_if_modified())
+        self.assertEqual(intf.fetched, ['sess1', 'sess1'])
+
+    def test_add_assessor(self):
+        intf = FakePrefetchInterface()
+        csess = XnatUtils.CachedImageSession(
+            intf, 'proj1', 'subj1', 'sess1', datatype='xnat:mrSessionData',
+            creation_timestamp='2019-01-01')
+        self.assertEqual(csess.assessors(), [])
+        csess.add_assessor('proc:genProcData', 'guid1', 'guid1',
+                           {'proc:genprocdata/proctype': 'Proc_v1',
+                            'proc:genprocdata/inputs': '{"a": "b"}',
+                            'proc:genprocdata/date': '2019-01-01'})
+        csess.update_assessor('proj1-x-subj1-x-sess1-x-guid1',
+                              'NEED_TO_RUN', 'Job Pending')
+        assessors = csess.assessors()
+        self.assertEqual(len(assessors), 1)
+        info = assessors[0].info()
+        self.assertEqual(info['proctype'], 'Proc_v1')
+        self.assertEqual(info['inputs'], {'a': 'b'})
+        self.assertEqual(info['procstatus'], 'NEED_TO_RUN')
+        self.assertEqual(info['qcstatus'], 'Job Pending')
+        self.assertEqual(assessors[0].get('xnat:date'), '2019-01-01')
+        self.assertEqual(intf.fetched, ['sess1'])
+
+    def test_indexes(self):
+        intf = FakePrefetchInterface()
+        csess = XnatUtils.CachedImageSession(
+            intf, 'proj1', 'subj1', 'sess1', datatype='xnat:mrSessionData',
+            creation_timestamp='2019-01-01')
+        self.assertEqual(csess.assessors_by_proctype(), {})
+        for label, proctype in [('guid1', 'Proc_v1'), ('guid2', 'Proc_v2'),
+                                ('guid3', 'Proc_v1')]:
+            csess.add_assessor('proc:genProcData', label, label,
+                               {'proc:genprocdata/proctype': proctype,
+                                'proc:genprocdata/inputs':
+                                '{"scan": "%s", "a": "b"}' % label})
+
+        by_proctype = csess.assessors_by_proctype()
+        self.assertEqual(list(by_proctype), ['Proc_v1', 'Proc_v2'])
+        self.assertEqual([a.label() for a in by_proctype['Proc_v1']],
+                         ['guid1', 'guid3'])
+        self.assertIs(by_proctype, csess.assessors_by_proctype())
+
+        key = XnatUtils.serialize_inputs({'a': 'b', 'scan': 'guid2'})
+        self.assertEqual(
+            [a.label() for a in csess.assessors_by_inputs()[key]], ['guid2'])
+        self.assertEqual(
+            list(csess.assessors_by_label()), ['guid1', 'guid2', 'guid3'])
+        self.assertEqual(csess.scans_by_type(), {})
+
+
+class FakeUploadFile(object):
+    def __init__(self, resource, path):
+        self.resource = resource
+        self.path = path
+
+    def put(self, src, overwrite=False, params=None):
+        if self.path in self.resource.failing:
+            raise IOError('connection reset')
+        self.resource.uploaded.append(self.path)
+
+
+class FakeUploadResource(object):
+    _intf = None
+
+    def __init__(self, failing):
+        self.failing = failing
+        self.uploaded = []
+        self.deleted = 0
+        self.created = False
+
+    def exists(self):
+        return self.created
+
+    def create(self):
+        self.created = True
+
+    def delete(self):
+        self.deleted += 1
+
+    def file(self, path):
+        return FakeUploadFile(self, path)
+
+
+class UploadFolderFilesUnitTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'sub'))
+        for fpath in ['a.txt', 'b.txt', os.path.join('sub', 'c.txt')]:
+            with open(os.path.join(self.directory, fpath), 'w') as f_obj:
+                f_obj.write(fpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resume(self):
+        res_obj = FakeUploadResource(failing=['b.txt'])
+        self.assertFalse(XnatUtils.upload_folder_files_to_obj(
+            self.directory, res_obj, removeall=True))
+        self.assertEqual(res_obj.uploaded, ['a.txt', 'sub/c.txt'])
+        progress = os.path.join(self.directory,
+                                XnatUtils.UPLOAD_PROGRESS_FILENAME)
+        self.assertTrue(os.path.isfile(progress))
+
+        # Resume: only the missing file, the resource is not removed
+        res_obj.failing = []
+        res_obj.uploaded = []
+        self.assertTrue(XnatUtils.upload_folder_files_to_obj(
+            self.directory, res_obj, removeall=True))
+        self.assertEqual(res_obj.uploaded, ['b.txt'])
+        self.assertEqual(res_obj.deleted, 0)
+        self.assertFalse(os.path.isfile(progress))
+
+
+class FakeCatalogInterface(object):
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+
+    def _get_json(self, uri):
+        self.requests.append(uri)
+        return self.files
+
+
+class FakeCatalogResource(object):
+    _uri = '/data/experiments/E1/scans/1/resources/DICOM'
+
+    def __init__(self, files):
+        self._intf = FakeCatalogInterface(files)
+
+    def exists(self):
+        return True
+
+
+class ResourceCatalogUnitTest(TestCase):
+
+    @staticmethod
+    def entry(fpath, size, digest):
+        uri = '/data/experiments/E1/scans/1/resources/123/files/%s' % fpath
+        return {'Name': os.path.basename(fpath), 'URI': uri,
+                'Size': size, 'digest': digest}
+
+    def test_diff(self):
+        src_res = FakeCatalogResource([
+            self.entry('same.dcm', '10', 'aaa'),
+            self.entry('sub/size.dcm', '10', 'bbb'),
+            self.entry('digest.dcm', '10', 'ccc'),
+            self.entry('nodigest.dcm', '10', ''),
+            self.entry('missing.dcm', '10', 'ddd')])
+        dst_res = FakeCatalogResource([
+            self.entry('same.dcm', '10', 'aaa'),
+            self.entry('sub/size.dcm', '12', 'bbb'),
+            self.entry('digest.dcm', '10', 'xxx'),
+            self.entry('nodigest.dcm', 10, 'eee')])
+        src_catalog = XnatUtils.get_resource_catalog(src_res)
+        self.assertEqual(src_res._intf.requests, [src_res._uri + '/files'])
+        self.assertIn('sub/size.dcm', src_catalog)
+
+        dst_catalog = XnatUtils.get_resource_catalog(dst_res)
+        self.assertEqual(
+            XnatUtils.diff_resource_catalogs(src_catalog, dst_catalog),
+            ['digest.dcm', 'missing.dcm', 'sub/size.dcm'])
+
+    def test_diff_download_manifest(self):
+        catalog = {'a.dcm': {'Size': '10', 'digest': 'aaa'},
+                   'b.dcm': {'Size': '10', 'digest': 'bbb'},
+                   'c.dcm': {'Size': '10', 'digest': ''}}
+        manifest = {'a.dcm': ('10', 'aaa', '20180101000000'),
+                    'b.dcm': ('10', 'old', '20180101000000')}
+        self.assertEqual(XnatUtils.diff_download_manifest(catalog, manifest),
+                         ['b.dcm', 'c.dcm'])
+
+
+class FakeDownloadResponse(object):
+    def __init__(self, content, status_code):
+        self.content = content
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+    def close(self):
+        pass
+
+
+class FakeDownloadInterface(object):
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+
+    def _get_json(self, uri):
+        return [{'Name': os.path.basename(fpath), 'URI': '/files/' + fpath,
+                 'Size': str(len(content)), 'digest': digest}
+                for fpath, (content, digest) in self.files.items()]
+
+    def get(self, uri, stream=False, headers=None):
+        self.requests.append((uri, headers))
+        content = self.files[uri.split('/files/', 1)[1]][0]
+        if headers:
+            offset = int(headers['Range'][6:-1])
+            return FakeDownloadResponse(content[offset:], 206)
+        return FakeDownloadResponse(content, 200)
+
+
+def md5(content):
+    return hashlib.md5(content.encode()).hexdigest()
+
+
+class FakeDownloadResource(FakeCatalogResource):
+    def __init__(self, files):
+        self._intf = FakeDownloadInterface(files)
+
+
+class DownloadResourceFilesUnitTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_manifest_and_resume(self):
+        res_obj = FakeDownloadResource({'a.txt': ('aaaa', md5('aaaa')),
+                                        'sub/b.txt': ('bbbb', md5('bbbb'))})
+        # Partial file from an interrupted download
+        part = os.path.join(self.directory, 'a.txt' +
+                            XnatUtils.DOWNLOAD_PART_EXT)
+        with open(part, 'w') as f_obj:
+            f_obj.write('aa')
+
+        fpaths = XnatUtils.download_resource_files(self.directory, res_obj)
+        self.assertEqual(len(fpaths), 2)
+        self.assertEqual(res_obj._intf.requests,
+                         [('/files/a.txt', {'Range': 'bytes=2-'}),
+                          ('/files/sub/b.txt', None)])
+        with open(os.path.join(self.directory, 'a.txt')) as f_obj:
+            self.assertEqual(f_obj.read(), 'aaaa')
+        self.assertFalse(os.path.exists(part))
+
+        # Identical files: nothing downloaded
+        res_obj._intf.requests = []
+        self.assertEqual(
+            XnatUtils.download_resource_files(self.directory, res_obj), [])
+        self.assertEqual(res_obj._intf.requests, [])
+
+        # Changed on XNAT (same size, new digest)
+        res_obj._intf.files['a.txt'] = ('cccc', md5('cccc'))
+        fpaths = XnatUtils.download_resource_files(self.directory, res_obj)
+        self.assertEqual(fpaths, [os.path.join(self.directory, 'a.txt')])
+        manifest = XnatUtils.read_download_manifest(os.path.join(
+            self.directory, XnatUtils.DOWNLOAD_MANIFEST_FILENAME))
+        self.assertEqual(sorted(manifest), ['a.txt', 'sub/b.txt'])
+        self.assertEqual(manifest['a.txt'][:2], ('4', md5('cccc')))
+
+    def test_stale_partial_file(self):
+        res_obj = FakeDownloadResource({'a.txt': ('cccc', md5('cccc'))})
+        # Partial file of an older version of the file: resumed, then
+        # downloaded again because of its digest
+        part = os.path.join(self.directory, 'a.txt' +
+                            XnatUtils.DOWNLOAD_PART_EXT)
+        with open(part, 'w') as f_obj:
+            f_obj.write('aaa')
+
+        fpaths = XnatUtils.download_resource_files(self.directory, res_obj)
+        self.assertEqual(fpaths, [os.path.join(self.directory, 'a.txt')])
+        self.assertEqual(res_obj._intf.requests,
+                         [('/files/a.txt', {'Range': 'bytes=3-'}),
+                          ('/files/a.txt', None)])
+        with open(fpaths[0]) as f_obj:
+            self.assertEqual(f_obj.read(), 'cccc')
+        self.assertFalse(os.path.exists(part))